@@ -1,17 +1,32 @@
-from flask import Flask, request, jsonify, session
+from flask import Blueprint, Flask, Response, request, jsonify, session, g
 from flask_cors import CORS
 from flask_session import Session
 from datetime import timedelta, datetime
 import os
+import re
 from dotenv import load_dotenv
 from functools import wraps
 import jwt
 import bcrypt
 import json
-from pymongo import MongoClient
 from bson.objectid import ObjectId
-import random
-import string
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from app_logging import configure_logging, get_logger
+from commission_config import get_current_rates
+from database import db, init_process
+from forex_prices import format_tick, get_price, price_book, stream_prices
+from instrumentation import init_instrumentation, query_budget
+from investment_history import entry_time, find_user_history, format_history_entry
+from leaderboard import ORDERINGS, WINDOWS, get_leaderboard, record_leaderboard_earnings
+from investment_lifecycle import (
+    close_investment as close_open_investment, format_investment, maturity_date, parse_term_days, payout
+)
+from metrics import init_metrics
+from user_cache import get_user_snapshot, invalidate_user
+from user_events import publish_user_event, stream_user_events
+from portfolio import DEFAULT_SERIES_POINTS, get_portfolio_series, invalidate_portfolio_series
+from referral_codes import allocate_referral_code
+from referral_earnings import get_referral_earnings, get_referral_earnings_total, record_referral_earning
 
 def custom_json_encoder(obj):
     if isinstance(obj, ObjectId):
@@ -32,79 +47,57 @@ class CustomJSONProvider(json.JSONEncoder):
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__)
-
-# Configure JSON encoder
-app.json_encoder = CustomJSONProvider
-
-# Configure CORS
-CORS(app, 
-     supports_credentials=True, 
-     origins=[os.getenv('FRONTEND_URL', 'http://localhost:5173')],
-     allow_headers=["Content-Type", "Authorization"],
-     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
-
-# Configure session
-app.config['SECRET_KEY'] = os.getenv('JWT_SECRET', 'your-secret-key')
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
-<<<<<<< HEAD
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['SESSION_COOKIE_SECURE'] = True
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-<<<<<<< HEAD
-app.config['SESSION_COOKIE_DOMAIN'] = '134.122.23.155'  # Set to your domain
-app.config['SESSION_COOKIE_PATH'] = '/'
-=======
->>>>>>> parent of feab65f (deposit, withdraw and other features)
-=======
->>>>>>> parent of 9343a10 (deposit, withdraw and other features klo)
-Session(app)
-
-# MongoDB connection
-mongo_uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/secure_auth_glass')
-mongo_client = MongoClient(mongo_uri)
-db = mongo_client.get_default_database()
-
-# Initialize commission rates if not exists
-def init_commission_rates():
-    if db.commission_rates.count_documents({}) == 0:
-        db.commission_rates.insert_one({
-            'forex_rewards': {
-                'EUR/USD': 100,
-                'GBP/USD': 300,
-                'USD/JPY': 500,
-                'USD/CHF': 600,
-                'AUD/USD': 700,
-                'EUR/GBP': 1000,
-                'EUR/AUD': 1500,
-                'USD/CAD': 2500,
-                'NZD/USD': 5000
-            },
-            'daily_commission': {
-                'level1': 0.10,  # 10% ROI
-                'level2': 0.05,  # 5% ROI
-                'level3': 0.02   # 2% ROI
-            },
-            'created_at': datetime.utcnow(),
-            'updated_at': datetime.utcnow()
-        })
+logger = get_logger()
+
+# Server error code for an aggregation stage it does not know, e.g. $documents before 5.1
+UNRECOGNIZED_PIPELINE_STAGE = 40324
+
+# Digits with an optional leading + and the usual separators
+PHONE_PATTERN = re.compile(r'\+?[0-9][0-9 ()-]{5,19}')
+
+# Routes live on a blueprint so the app is only built by create_app()
+api = Blueprint('api', __name__)
+
+def create_app():
+    """Build the Flask app; Mongo is connected lazily, once per process"""
+    app = Flask(__name__)
+
+    # Structured JSON logging with request ids, written off the request path
+    configure_logging(app)
+
+    # Configure JSON encoder
+    app.json_encoder = CustomJSONProvider
+
+    # Configure CORS
+    CORS(app, 
+         supports_credentials=True, 
+         origins=[os.getenv('FRONTEND_URL', 'http://localhost:5173')],
+         allow_headers=["Content-Type", "Authorization"],
+         methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+
+    # Configure session
+    app.config['SECRET_KEY'] = os.getenv('JWT_SECRET', 'your-secret-key')
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    app.config['SESSION_COOKIE_SECURE'] = True
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_DOMAIN'] = '134.122.23.155'  # Set to your domain
+    app.config['SESSION_COOKIE_PATH'] = '/'
+    Session(app)
+
+    # Per-route Mongo command metrics and query budgets
+    init_instrumentation(app)
 
-# Call initialization when app starts
-init_commission_rates()
-
-# Forex referral rewards
-FOREX_REFERRAL_REWARDS = {
-    'EUR/USD': 100,
-    'GBP/USD': 300,
-    'USD/JPY': 500,
-    'USD/CHF': 600,
-    'AUD/USD': 700,
-    'EUR/GBP': 1000,
-    'EUR/AUD': 1500,
-    'USD/CAD': 2500,
-    'NZD/USD': 5000
-}
+    # Prometheus request metrics served on /metrics
+    init_metrics(app)
+
+    app.register_blueprint(api)
+
+    # gunicorn does this in post_worker_init; other servers get it on first request
+    app.before_request(init_process)
+
+    return app
 
 # Authentication decorator
 def login_required(f):
@@ -112,236 +105,120 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return jsonify({'error': 'Authentication required'}), 401
+        # Projected, short-lived snapshot; never use it to guard a balance write
+        g.user = get_user_snapshot(db, session['user_id'])
+        if not g.user or not g.user.get('isActive', True):
+            return jsonify({'error': 'Authentication required'}), 401
         return f(*args, **kwargs)
     return decorated_function
 
-def generate_referral_code():
-    import random
-    import string
-    # Generate a 6-character referral code using uppercase letters and numbers
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(random.choices(characters, k=6))
+def format_session_user(user):
+    """Public view of a user document returned by the auth endpoints"""
+    session_user = {
+        '_id': str(user['_id']),
+        'username': user['username'],
+        'phone': user['phone'],
+        'balance': user.get('balance', 0),
+        'referralCode': user['referralCode'],
+        'isActive': user.get('isActive', True),
+        'createdAt': user['createdAt'].isoformat() if isinstance(user['createdAt'], datetime) else user['createdAt'],
+        'updatedAt': user['updatedAt'].isoformat() if isinstance(user['updatedAt'], datetime) else user['updatedAt']
+    }
+    
+    if user.get('referredBy'):
+        session_user['referredBy'] = str(user['referredBy'])
+    return session_user
+
+def format_referral(ref, level, one_time_rewards, daily_commissions, referral_count):
+    """Referred user row as returned by GET /api/referral/history"""
+    return {
+        '_id': str(ref['_id']),
+        'username': ref.get('username', ''),
+        'phone': ref.get('phone', ''),
+        'joinedAt': ref['createdAt'].isoformat() if isinstance(ref.get('createdAt'), datetime) else ref.get('createdAt', ''),
+        'isActive': ref.get('isActive', False),
+        'referralCount': referral_count,
+        'level': level,
+        'earnings': {
+            'oneTimeRewards': float(one_time_rewards),
+            'dailyCommissions': float(daily_commissions),
+            'total': float(one_time_rewards + daily_commissions)
+        }
+    }
+
+def normalize_phone(phone):
+    """Phone number as the string stored on users, or None if it is not a valid one.
+
+    The unique phone index only covers strings, so anything else must never
+    reach the users collection.
+    """
+    if not isinstance(phone, str):
+        return None
+    phone = phone.strip()
+    return phone if PHONE_PATTERN.fullmatch(phone) else None
+
+def duplicate_key_field(error):
+    """First field of the unique index a DuplicateKeyError was raised for"""
+    key_pattern = (error.details or {}).get('keyPattern')
+    if key_pattern:
+        return next(iter(key_pattern))
+    # Older servers only name the index in the message, e.g. "index: phone_1 dup key"
+    match = re.search(r'index: (\w+?)_-?1', str(error))
+    return match.group(1) if match else None
+
+def insert_user(user, referral_code=None):
+    """Insert a new user, resolving referredBy from referral_code in the same command.
+
+    One aggregation builds the document with $documents, looks the referrer up
+    and $merges the result into users, so registration costs one round trip
+    whether or not a referral code was given. Servers older than MongoDB 5.1
+    (no $documents) fall back to a lookup followed by the insert.
+    """
+    user = dict(user, _id=ObjectId())
+    if not referral_code or not isinstance(referral_code, str):
+        db.users.insert_one(user)
+        return user['_id']
+
+    try:
+        db.aggregate([
+            {'$documents': [user]},
+            {'$lookup': {
+                'from': 'users',
+                'pipeline': [
+                    {'$match': {'referralCode': referral_code}},
+                    {'$project': {'_id': 1}},
+                    {'$limit': 1}
+                ],
+                'as': 'referrer'
+            }},
+            {'$set': {'referredBy': {'$ifNull': [{'$first': '$referrer._id'}, None]}}},
+            {'$unset': 'referrer'},
+            {'$merge': {'into': 'users', 'on': '_id', 'whenMatched': 'fail', 'whenNotMatched': 'insert'}}
+        ])
+    except OperationFailure as e:
+        if e.code != UNRECOGNIZED_PIPELINE_STAGE:
+            raise
+        referrer = db.users.find_one({'referralCode': referral_code}, {'_id': 1})
+        user['referredBy'] = referrer['_id'] if referrer else None
+        db.users.insert_one(user)
+    return user['_id']
 
 def calculate_referral_earnings(user_id):
     """Calculate earnings from referrals based on levels"""
     try:
-        print(f"Calculating referral earnings for user: {user_id}")
-        
-        # Get all referral rewards (one-time rewards + daily commissions)
-        total_rewards = db.referral_history.aggregate([
-            {'$match': {'referrerId': ObjectId(user_id)}},
-            {'$group': {
-                '_id': None,
-                'total': {'$sum': '$amount'}
-            }}
-        ]).next()
+        # Running totals kept by the reward and commission writers
+        total_rewards = get_referral_earnings_total(db, ObjectId(user_id))
         
         return {
-            'total': round(total_rewards.get('total', 0), 2)
+            'total': round(total_rewards, 2)
         }
     except Exception as e:
-        print(f"Error calculating referral earnings: {str(e)}")
+        logger.exception('Error calculating referral earnings', extra={'user_id': str(user_id)})
         return {'total': 0}
 
-def calculate_daily_referral_commissions():
-    """Calculate and distribute daily commissions based on referred users' investment earnings"""
-    try:
-        # Get current commission rates
-        commission_rates = db.commission_rates.find_one({}, sort=[('created_at', -1)])
-        if not commission_rates:
-            print("No commission rates found")
-            return
-            
-        daily_rates = commission_rates['daily_commission']
-        
-        # Get yesterday's date (UTC)
-        yesterday = datetime.utcnow() - timedelta(days=1)
-        yesterday_start = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-        yesterday_end = yesterday_start + timedelta(days=1)
-        
-        # Track processed commissions to avoid duplicates
-        processed_commissions = set()
-        
-        # Get all active investments from yesterday
-        active_investments = db.investments.find({
-            'status': 'active',
-            'createdAt': {'$lt': yesterday_end}
-        })
-        
-        for investment in active_investments:
-            user_id = investment['userId']
-            amount = investment['amount']
-            daily_roi = investment.get('dailyRoi', 0)
-            daily_roi_earnings = amount * (daily_roi / 100)
-            
-            # Get user's referral chain
-            user = db.users.find_one({'_id': user_id})
-            if not user or not user.get('referredBy'):
-                continue
-                
-            # Process Level 1 (direct referrer)
-            level1_referrer_id = user['referredBy']
-            commission_key = f"{str(level1_referrer_id)}_{str(user_id)}_{yesterday.date()}"
-            
-            if commission_key not in processed_commissions:
-                level1_commission = daily_roi_earnings * daily_rates['level1']
-                
-                # Record commission with historical rate
-                db.referral_history.insert_one({
-                    'referrerId': level1_referrer_id,
-                    'referredId': user_id,
-                    'level': 1,
-                    'type': 'daily_commission',
-                    'amount': level1_commission,
-                    'rate': daily_rates['level1'],
-                    'baseAmount': daily_roi_earnings,
-                    'date': yesterday_start,
-                    'createdAt': datetime.utcnow()
-                })
-                
-                # Update user's earnings
-                db.users.update_one(
-                    {'_id': level1_referrer_id},
-                    {'$inc': {'referralEarnings': level1_commission}}
-                )
-                
-                processed_commissions.add(commission_key)
-                
-                # Process Level 2
-                level1_user = db.users.find_one({'_id': level1_referrer_id})
-                if level1_user and level1_user.get('referredBy'):
-                    level2_referrer_id = level1_user['referredBy']
-                    level2_commission_key = f"{str(level2_referrer_id)}_{str(user_id)}_{yesterday.date()}"
-                    
-                    if level2_commission_key not in processed_commissions:
-                        level2_commission = daily_roi_earnings * daily_rates['level2']
-                        
-                        db.referral_history.insert_one({
-                            'referrerId': level2_referrer_id,
-                            'referredId': user_id,
-                            'level': 2,
-                            'type': 'daily_commission',
-                            'amount': level2_commission,
-                            'rate': daily_rates['level2'],
-                            'baseAmount': daily_roi_earnings,
-                            'date': yesterday_start,
-                            'createdAt': datetime.utcnow()
-                        })
-                        
-                        db.users.update_one(
-                            {'_id': level2_referrer_id},
-                            {'$inc': {'referralEarnings': level2_commission}}
-                        )
-                        
-                        processed_commissions.add(level2_commission_key)
-                        
-                        # Process Level 3
-                        level2_user = db.users.find_one({'_id': level2_referrer_id})
-                        if level2_user and level2_user.get('referredBy'):
-                            level3_referrer_id = level2_user['referredBy']
-                            level3_commission_key = f"{str(level3_referrer_id)}_{str(user_id)}_{yesterday.date()}"
-                            
-                            if level3_commission_key not in processed_commissions:
-                                level3_commission = daily_roi_earnings * daily_rates['level3']
-                                
-                                db.referral_history.insert_one({
-                                    'referrerId': level3_referrer_id,
-                                    'referredId': user_id,
-                                    'level': 3,
-                                    'type': 'daily_commission',
-                                    'amount': level3_commission,
-                                    'rate': daily_rates['level3'],
-                                    'baseAmount': daily_roi_earnings,
-                                    'date': yesterday_start,
-                                    'createdAt': datetime.utcnow()
-                                })
-                                
-                                db.users.update_one(
-                                    {'_id': level3_referrer_id},
-                                    {'$inc': {'referralEarnings': level3_commission}}
-                                )
-                                
-                                processed_commissions.add(level3_commission_key)
-        
-        print(f"Daily commission calculation completed for {yesterday.date()}")
-        
-    except Exception as e:
-        print(f"Error calculating daily commissions: {str(e)}")
-        raise e
-
-def calculate_daily_roi_earnings():
-    """Calculate and distribute daily ROI earnings for all active investments (weekdays only)"""
-    try:
-        current_time = datetime.utcnow()
-        
-        # Check if it's a weekend (5 = Saturday, 6 = Sunday)
-        if current_time.weekday() in [5, 6]:
-            print(f"Skipping ROI calculation for {current_time.date()} as it's a weekend")
-            return
-            
-        print(f"Starting daily ROI calculation for {current_time.date()}")
-        
-        # Get all active investments
-        active_investments = list(db.investments.find({'status': 'active'}))
-        print(f"Processing {len(active_investments)} active investments")
-        
-        for investment in active_investments:
-            try:
-                # Get investment details
-                user_id = investment['userId']
-                amount = float(investment.get('amount', 0))
-                daily_roi = float(investment.get('dailyROI', 0))
-                current_profit = float(investment.get('profit', 0))
-                
-                # Calculate today's earnings
-                daily_earnings = amount * (daily_roi / 100)
-                new_profit = current_profit + daily_earnings
-                
-                print(f"Investment {investment['_id']}: Amount={amount}, ROI={daily_roi}%, Earnings={daily_earnings}")
-                
-                # Update investment profit
-                db.investments.update_one(
-                    {'_id': investment['_id']},
-                    {
-                        '$set': {
-                            'profit': new_profit,
-                            'lastProfitUpdate': current_time
-                        }
-                    }
-                )
-                
-                # Add to user's balance
-                db.users.update_one(
-                    {'_id': user_id},
-                    {'$inc': {'balance': daily_earnings}}
-                )
-                
-                # Record the earnings in history
-                db.investment_history.insert_one({
-                    'investmentId': investment['_id'],
-                    'userId': user_id,
-                    'type': 'roi_earning',
-                    'amount': daily_earnings,
-                    'date': current_time.date().isoformat(),
-                    'createdAt': current_time,
-                    'balance': new_profit
-                })
-                
-                print(f"Credited {daily_earnings} to user {user_id}, new investment profit: {new_profit}")
-                
-            except Exception as inv_error:
-                print(f"Error processing investment {investment.get('_id')}: {str(inv_error)}")
-                continue
-        
-        print(f"Daily ROI calculation completed for {current_time.date()}")
-        return True
-        
-    except Exception as e:
-        print(f"Error calculating daily ROI: {str(e)}")
-        return False
-
 # Auth routes
-@app.route('/api/auth/register', methods=['POST'])
+@api.route('/api/auth/register', methods=['POST'])
+@query_budget(2)
 def register():
     try:
         data = request.get_json()
@@ -352,19 +229,12 @@ def register():
 
         if not all([username, phone, password]):
             return jsonify({'error': 'Missing required fields'}), 400
+        phone = normalize_phone(phone)
+        if phone is None:
+            return jsonify({'error': 'Invalid phone number'}), 400
 
-        if db.users.find_one({'phone': phone}):
-            return jsonify({'error': 'Phone number already registered'}), 400
-
-        # Generate a unique referral code for the new user
-        new_referral_code = generate_referral_code()
-        while db.users.find_one({'referralCode': new_referral_code}):
-            new_referral_code = generate_referral_code()
-
-        # Find referrer if referral code was provided
-        referrer = None
-        if referral_code:
-            referrer = db.users.find_one({'referralCode': referral_code})
+        # Allocated from a counter, so no lookup is needed to know it is free
+        new_referral_code = allocate_referral_code(db)
 
         current_time = datetime.utcnow()
         
@@ -375,15 +245,26 @@ def register():
             'password': bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
             'balance': 0,
             'referralCode': new_referral_code,
-            'referredBy': ObjectId(referrer['_id']) if referrer else None,
+            'referredBy': None,
             'isActive': True,
             'createdAt': current_time,
             'updatedAt': current_time,
             '__v': 0
         }
         
-        result = db.users.insert_one(user)
-        user_id = result.inserted_id
+        # Unique indexes on phone and referralCode replace the pre-check queries
+        while True:
+            try:
+                user_id = insert_user(user, referral_code)
+                break
+            except DuplicateKeyError as e:
+                field = duplicate_key_field(e)
+                if field == 'phone':
+                    return jsonify({'error': 'Phone number already registered'}), 400
+                # Only a code handed out before the allocator existed can clash
+                if field != 'referralCode':
+                    raise
+                user['referralCode'] = new_referral_code = allocate_referral_code(db)
         
         session_user = {
             '_id': str(user_id),
@@ -399,10 +280,11 @@ def register():
         session['user_id'] = str(user_id)
         return jsonify({'user': session_user}), 201
     except Exception as e:
-        print(f"Registration error: {str(e)}")
+        logger.exception('Registration error')
         return jsonify({'error': 'Registration failed'}), 500
 
-@app.route('/api/auth/login', methods=['POST'])
+@api.route('/api/auth/login', methods=['POST'])
+@query_budget(1)
 def login():
     try:
         data = request.get_json()
@@ -411,6 +293,9 @@ def login():
 
         if not all([phone, password]):
             return jsonify({'error': 'Missing required fields'}), 400
+        # Looked up exactly as stored: older accounts may predate the format check
+        if not isinstance(phone, str):
+            return jsonify({'error': 'Invalid credentials'}), 401
 
         user = db.users.find_one({'phone': phone})
         if not user:
@@ -420,79 +305,56 @@ def login():
         if not bcrypt.checkpw(password.encode('utf-8'), stored_password.encode('utf-8')):
             return jsonify({'error': 'Invalid credentials'}), 401
 
-        session_user = {
-            '_id': str(user['_id']),
-            'username': user['username'],
-            'phone': user['phone'],
-            'balance': user.get('balance', 0),
-            'referralCode': user['referralCode'],
-            'isActive': user.get('isActive', True),
-            'createdAt': user['createdAt'].isoformat() if isinstance(user['createdAt'], datetime) else user['createdAt'],
-            'updatedAt': user['updatedAt'].isoformat() if isinstance(user['updatedAt'], datetime) else user['updatedAt']
-        }
-        
-        if user.get('referredBy'):
-            session_user['referredBy'] = str(user['referredBy'])
-        
         session['user_id'] = str(user['_id'])
-        return jsonify({'user': session_user})
+        return jsonify({'user': format_session_user(user)})
     except Exception as e:
-        print(f"Login error: {str(e)}")
+        logger.exception('Login error')
         return jsonify({'error': 'Login failed'}), 500
 
-@app.route('/api/auth/verify', methods=['GET'])
+@api.route('/api/auth/verify', methods=['GET'])
 @login_required
+@query_budget(1)
 def verify():
     try:
-        user_id = session.get('user_id')
-        if not user_id:
-            return jsonify({'error': 'Authentication required'}), 401
-            
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        session_user = {
-            '_id': str(user['_id']),
-            'username': user['username'],
-            'phone': user['phone'],
-            'balance': user.get('balance', 0),
-            'referralCode': user['referralCode'],
-            'isActive': user.get('isActive', True),
-            'createdAt': user['createdAt'].isoformat() if isinstance(user['createdAt'], datetime) else user['createdAt'],
-            'updatedAt': user['updatedAt'].isoformat() if isinstance(user['updatedAt'], datetime) else user['updatedAt']
-        }
-        
-        if user.get('referredBy'):
-            session_user['referredBy'] = str(user['referredBy'])
-        
-        return jsonify({'user': session_user})
+        # login_required has already loaded the (cached) user snapshot
+        return jsonify({'user': format_session_user(g.user)})
     except Exception as e:
-        print(f"Verify error: {str(e)}")
+        logger.exception('Verify error')
         return jsonify({'error': 'Verification failed'}), 500
 
-@app.route('/api/auth/logout', methods=['POST'])
+@api.route('/api/auth/logout', methods=['POST'])
 def logout():
     try:
         session.clear()
         return jsonify({'message': 'Logged out successfully'})
     except Exception as e:
-        print(f"Logout error: {str(e)}")
+        logger.exception('Logout error')
         return jsonify({'error': 'Logout failed'}), 500
 
 # User routes
-@app.route('/api/users/profile', methods=['PUT'])
+@api.route('/api/users/profile', methods=['PUT'])
 @login_required
+@query_budget(3)
 def update_profile():
     data = request.get_json()
-    user = db.users.find_one_and_update(
-        {'_id': ObjectId(session['user_id'])},
-        {'$set': data},
-        return_document=True
-    )
+    if 'phone' in data:
+        data['phone'] = normalize_phone(data['phone'])
+        if data['phone'] is None:
+            return jsonify({'error': 'Invalid phone number'}), 400
+    try:
+        user = db.users.find_one_and_update(
+            {'_id': ObjectId(session['user_id'])},
+            {'$set': data},
+            return_document=True
+        )
+    except DuplicateKeyError as e:
+        if duplicate_key_field(e) != 'phone':
+            raise
+        return jsonify({'error': 'Phone number already registered'}), 400
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
+    invalidate_user(session['user_id'])
     
     user['_id'] = str(user['_id'])
     session_user = user.copy()
@@ -500,16 +362,18 @@ def update_profile():
     return jsonify({'user': session_user})
 
 # Transaction routes
-@app.route('/api/transactions', methods=['GET'])
+@api.route('/api/transactions', methods=['GET'])
 @login_required
+@query_budget(2)
 def get_transactions():
     transactions = list(db.transactions.find({'user_id': session['user_id']}))
     for t in transactions:
         t['_id'] = str(t['_id'])
     return jsonify({'transactions': transactions})
 
-@app.route('/api/transactions/deposit', methods=['POST'])
+@api.route('/api/transactions/deposit', methods=['POST'])
 @login_required
+@query_budget(2)
 def initiate_deposit():
     data = request.get_json()
     amount = data.get('amount')
@@ -528,8 +392,9 @@ def initiate_deposit():
     transaction['_id'] = str(result.inserted_id)
     return jsonify({'transaction': transaction})
 
-@app.route('/api/transactions/deposit/<transaction_id>/confirm', methods=['POST'])
+@api.route('/api/transactions/deposit/<transaction_id>/confirm', methods=['POST'])
 @login_required
+@query_budget(6)
 def confirm_deposit(transaction_id):
     transaction = db.transactions.find_one_and_update(
         {'_id': ObjectId(transaction_id), 'user_id': session['user_id']},
@@ -540,100 +405,113 @@ def confirm_deposit(transaction_id):
     if not transaction:
         return jsonify({'error': 'Transaction not found'}), 404
     
-    db.users.update_one(
+    user = db.users.find_one_and_update(
         {'_id': ObjectId(session['user_id'])},
-        {'$inc': {'balance': transaction['amount']}}
+        {'$inc': {'balance': transaction['amount']}},
+        projection={'balance': 1},
+        return_document=True
     )
+    invalidate_user(session['user_id'])
+    invalidate_portfolio_series(session['user_id'])
+    publish_user_event(db, session['user_id'], 'balance', {
+        'balance': user.get('balance', 0) if user else None,
+        'delta': transaction['amount'],
+        'reason': 'deposit'
+    })
     
     transaction['_id'] = str(transaction['_id'])
     return jsonify({'transaction': transaction})
 
 # Investment routes
-@app.route('/api/investments', methods=['GET'])
+@api.route('/api/investments', methods=['GET'])
 @login_required
+@query_budget(2)
 def get_investments():
     try:
         user_id = session['user_id']
-        print(f"Getting investments for user: {user_id}")
-        
-        # Get all investments for the user - try both field names
-        investments = list(db.investments.find({
-            '$or': [
-                {'userId': ObjectId(user_id)},
-                {'user_id': ObjectId(user_id)}
-            ]
-        }))
-        print(f"Raw investments from DB: {investments}")
+        # Legacy field names are rewritten by migrate_investments.py, so a single
+        # indexed equality query covers every investment
+        investments = list(db.investments.find({'userId': ObjectId(user_id)}))
         
         # Format investments for response
         formatted_investments = []
         for inv in investments:
             try:
-                # Handle both field name formats
-                user_id_field = inv.get('userId', inv.get('user_id'))
-                forex_pair = inv.get('forexPair', inv.get('pair', ''))
-                entry_price = inv.get('entryPrice', inv.get('entry_price', 0))
-                current_price = inv.get('currentPrice', inv.get('current_price', entry_price))
-                daily_roi = inv.get('dailyROI', inv.get('daily_roi', 0))
-                created_at = inv.get('createdAt', inv.get('created_at', datetime.utcnow()))
-                
-                formatted_inv = {
-                    'id': str(inv['_id']),
-                    'userId': str(user_id_field) if user_id_field else str(user_id),
-                    'forexPair': forex_pair,
-                    'amount': float(inv.get('amount', 0)),
-                    'dailyROI': float(daily_roi),
-                    'entryPrice': float(entry_price),
-                    'currentPrice': float(current_price),
-                    'status': inv.get('status', 'active'),
-                    'profit': float(inv.get('profit', 0)),
-                    'createdAt': created_at.isoformat() if isinstance(created_at, datetime) else str(created_at)
-                }
+                formatted_inv = format_investment(inv, user_id)
                 formatted_investments.append(formatted_inv)
-                print(f"Formatted investment: {formatted_inv}")
             except Exception as format_error:
-                print(f"Error formatting investment {inv.get('_id')}: {str(format_error)}")
-                print(f"Raw investment data: {inv}")
+                logger.warning('Error formatting investment', extra={
+                    'investment_id': str(inv.get('_id')),
+                    'error': str(format_error)
+                })
                 continue
         
-        print(f"Successfully formatted {len(formatted_investments)} investments")
+        logger.debug('Formatted investments', extra={'count': len(formatted_investments)})
         return jsonify({'investments': formatted_investments})
         
     except Exception as e:
-        import traceback
-        print(f"Get investments error: {str(e)}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception('Get investments error')
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/investments/earnings', methods=['GET'])
+@api.route('/api/investments/earnings', methods=['GET'])
 @login_required
+@query_budget(3)
 def get_investment_earnings():
     try:
-        # Get all investments for the user
-        investments = list(db.investments.find({'userId': session['user_id']}))
+        user_id = ObjectId(session['user_id'])
+        days = max(1, min(request.args.get('days', 30, type=int), 365))
         
-        # Calculate total earnings
-        total_earnings = sum(float(inv.get('profit', 0)) for inv in investments)
-        active_investments = sum(1 for inv in investments if inv.get('status', '').lower() == 'open')
+        # Totals, active count and per-pair breakdown in a single aggregation
+        by_pair = list(db.investments.aggregate([
+            {'$match': {'userId': user_id}},
+            {'$group': {
+                '_id': '$forexPair',
+                'profit': {'$sum': '$profit'},
+                'invested': {'$sum': '$amount'},
+                'count': {'$sum': 1},
+                'active': {'$sum': {'$cond': [{'$eq': ['$status', 'active']}, 1, 0]}}
+            }},
+            {'$sort': {'_id': 1}}
+        ]))
+        
+        # Daily earnings come from the rollup maintained by the ROI job
+        history = db.earnings_daily.find(
+            {'userId': user_id},
+            {'_id': 0, 'date': 1, 'amount': 1}
+        ).sort('date', -1).limit(days)
         
         earnings_data = {
-            'total_earnings': total_earnings,
-            'active_investments': active_investments,
-            'earnings_history': []  # You can implement historical earnings if needed
+            'total_earnings': float(sum(p['profit'] for p in by_pair)),
+            'total_invested': float(sum(p['invested'] for p in by_pair)),
+            'active_investments': sum(p['active'] for p in by_pair),
+            'by_pair': [
+                {
+                    'forexPair': p['_id'] or '',
+                    'profit': float(p['profit']),
+                    'invested': float(p['invested']),
+                    'count': p['count'],
+                    'active': p['active']
+                }
+                for p in by_pair
+            ],
+            'earnings_history': [
+                {'date': h['date'], 'amount': float(h['amount'])}
+                for h in reversed(list(history))
+            ]
         }
         
         return jsonify(earnings_data)
     except Exception as e:
-        print(f"Get earnings error: {str(e)}")
+        logger.exception('Get earnings error')
         return jsonify({'error': 'Failed to fetch earnings'}), 500
 
-@app.route('/api/investments', methods=['POST'])
+@api.route('/api/investments', methods=['POST'])
 @login_required
 def create_investment():
     try:
         user_id = session['user_id']
         data = request.get_json()
-        print(f"Creating investment for user {user_id} with data: {data}")
+        logger.debug('Creating investment', extra={'request_data': data})
 
         # Validate required fields
         if not all(key in data for key in ['pair', 'amount', 'dailyROI']):
@@ -648,10 +526,18 @@ def create_investment():
         if amount <= 0:
             return jsonify({'error': 'Invalid amount'}), 400
 
+        try:
+            term_days = parse_term_days(data.get('termDays'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         if amount > user.get('balance', 0):
             return jsonify({'error': 'Insufficient balance'}), 400
 
         forex_pair = data['pair']
+        entry_price = get_price(forex_pair)
+        if entry_price is None:
+            return jsonify({'error': 'Price unavailable for this pair, try again shortly'}), 503
 
         # Create the investment
         current_time = datetime.utcnow()
@@ -660,29 +546,37 @@ def create_investment():
             'forexPair': forex_pair,
             'amount': amount,
             'dailyROI': float(data['dailyROI']),
-            'entryPrice': 1.0000,
-            'currentPrice': 1.0000,
+            'entryPrice': entry_price,
+            'currentPrice': entry_price,
             'status': 'active',
             'profit': 0,
+            'termDays': term_days,
+            'maturesAt': maturity_date(current_time, term_days),
             'createdAt': current_time
         }
 
-        print(f"Inserting investment: {investment}")
         result = db.investments.insert_one(investment)
-        print(f"Investment created with ID: {result.inserted_id}")
+        logger.info('Investment created', extra={
+            'investment_id': str(result.inserted_id),
+            'forex_pair': forex_pair,
+            'amount': amount
+        })
         
         # Update user's balance
         db.users.update_one(
             {'_id': ObjectId(user_id)},
             {'$inc': {'balance': -amount}}
         )
+        invalidate_user(user_id)
+        invalidate_portfolio_series(user_id)
 
         # Calculate and credit referral rewards
         if user.get('referredBy'):
             referrer = db.users.find_one({'_id': user['referredBy']})
             if referrer:
                 # One-time reward for the specific forex pair
-                one_time_reward = FOREX_REFERRAL_REWARDS.get(forex_pair, 0)
+                rates = get_current_rates(db)
+                one_time_reward = rates['forex_rewards'].get(forex_pair, 0) if rates else 0
                 
                 # Check if this is the first investment for this pair
                 existing_investments = db.investments.find_one({
@@ -697,18 +591,35 @@ def create_investment():
                         {'_id': referrer['_id']},
                         {'$inc': {'balance': one_time_reward}}
                     )
-                    print(f"Credited one-time reward {one_time_reward} to referrer {referrer['_id']} for {forex_pair}")
+                    invalidate_user(referrer['_id'])
+                    publish_user_event(db, referrer['_id'], 'referral_reward', {
+                        'type': 'one_time_reward',
+                        'referredId': str(user_id),
+                        'forexPair': forex_pair,
+                        'amount': one_time_reward
+                    })
+                    publish_user_event(db, referrer['_id'], 'balance', {
+                        'delta': one_time_reward,
+                        'reason': 'referral_reward'
+                    })
                     
                     # Record the reward in referral history
                     db.referral_history.insert_one({
                         'referrerId': referrer['_id'],
-                        'userId': ObjectId(user_id),
+                        'referredId': ObjectId(user_id),
                         'type': 'one_time_reward',
                         'forexPair': forex_pair,
                         'amount': one_time_reward,
+                        'rateVersion': rates['version'],
                         'createdAt': current_time
                     })
-                    print(f"Recorded one-time reward: {one_time_reward} for {forex_pair}")
+                    record_referral_earning(db, referrer['_id'], ObjectId(user_id), 'one_time_reward', one_time_reward)
+                    record_leaderboard_earnings(db, {referrer['_id']: one_time_reward}, current_time)
+                    logger.info('Credited one-time referral reward', extra={
+                        'referrer_id': str(referrer['_id']),
+                        'forex_pair': forex_pair,
+                        'amount': one_time_reward
+                    })
 
                 # Daily commission calculation will be handled by a separate cron job
                 # that calculates earnings based on the daily ROI of referred users' investments
@@ -727,118 +638,106 @@ def create_investment():
             'currentPrice': investment['currentPrice'],
             'status': investment['status'],
             'profit': investment['profit'],
+            'termDays': term_days,
+            'maturesAt': investment['maturesAt'].isoformat(),
             'createdAt': current_time.isoformat(),
             'userBalance': updated_user.get('balance', 0)
         }
 
-        print(f"Returning investment response: {investment_response}")
+        publish_user_event(db, user_id, 'investment', {'action': 'created', 'investment': investment_response})
+        publish_user_event(db, user_id, 'balance', {
+            'balance': investment_response['userBalance'],
+            'delta': -amount,
+            'reason': 'investment'
+        })
+
         return jsonify({
             'message': 'Investment created successfully',
             'investment': investment_response
         })
 
     except Exception as e:
-        import traceback
-        print(f"Create investment error: {str(e)}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.exception('Create investment error')
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/investments/<investment_id>/close', methods=['POST'])
+@api.route('/api/investments/<investment_id>/close', methods=['POST'])
 @login_required
 def close_investment(investment_id):
     try:
-        # Find the investment
-        investment = db.investments.find_one({
-            '_id': ObjectId(investment_id),
-            'user_id': session['user_id'],
-            'status': 'open'
-        })
-        
-        if not investment:
+        user_id = session['user_id']
+        if not ObjectId.is_valid(investment_id):
             return jsonify({'error': 'Investment not found or already closed'}), 404
-        
-        # Calculate final profit (in a real app, you'd get the current price from a forex API)
-        current_price = investment['currentPrice']
-        amount = investment['amount']
-        profit = float(investment.get('profit', 0))
-        
-        # Update investment status
-        db.investments.update_one(
-            {'_id': ObjectId(investment_id)},
-            {
-                '$set': {
-                    'status': 'closed',
-                    'currentPrice': current_price,
-                    'profit': profit
-                }
-            }
-        )
-        
-        # Add profit to user balance
-        db.users.update_one(
-            {'_id': ObjectId(session['user_id'])},
-            {'$inc': {'balance': amount + profit}}
-        )
-        
-        # Get updated investment
-        updated_investment = db.investments.find_one({'_id': ObjectId(investment_id)})
-        updated_investment['_id'] = str(updated_investment['_id'])
-        updated_investment['createdAt'] = updated_investment['createdAt'].isoformat() if isinstance(updated_investment['createdAt'], datetime) else updated_investment['createdAt']
-        
-        return jsonify(updated_investment)
+
+        # One conditional close plus the balance credit, in one transaction
+        result = close_open_investment(db, investment_id, user_id)
+        if result is None:
+            return jsonify({'error': 'Investment not found or already closed'}), 404
+        investment, balance = result
+
+        invalidate_user(user_id)
+        invalidate_portfolio_series(user_id)
+        investment_response = format_investment(investment, str(user_id))
+        publish_user_event(db, user_id, 'investment', {'action': 'closed', 'investment': investment_response})
+        publish_user_event(db, user_id, 'balance', {'balance': balance, 'delta': payout(investment), 'reason': 'close'})
+
+        investment_response['userBalance'] = balance
+        return jsonify(investment_response)
     except Exception as e:
-        print(f"Close investment error: {str(e)}")
+        logger.exception('Close investment error')
         return jsonify({'error': 'Failed to close investment'}), 500
 
-@app.route('/api/investments/history', methods=['GET'])
+@api.route('/api/investments/history', methods=['GET'])
 @login_required
+@query_budget(3)
 def get_investment_history():
     try:
         user_id = session['user_id']
-        
-        # Get investment history for the user
-        history = list(db.investment_history.find(
-            {'userId': user_id},
-            {'_id': 0}  # Exclude MongoDB _id from results
-        ).sort('createdAt', -1))  # Sort by newest first
-        
-        # Format dates and numbers
-        for entry in history:
-<<<<<<< HEAD
-            entry['date'] = entry['date']
-            entry['amount'] = float(entry.get('amount', 0))
-            entry['balance'] = float(entry.get('balance', 0))
-=======
-            formatted_entry = {
-                'date': entry['date'],
-                'amount': float(entry.get('amount', 0)),
-                'type': entry.get('type', ''),
-                'balance': float(entry.get('balance', 0))
-            }
-            formatted_history.append(formatted_entry)
->>>>>>> parent of 9343a10 (deposit, withdraw and other features klo)
-            
-            # Remove MongoDB specific fields
-            entry.pop('createdAt', None)
-            entry.pop('userId', None)
+
+        # Optional ISO date range, e.g. ?from=2024-01-01&to=2024-02-01
+        query = {}
+        try:
+            created_range = {}
+            if request.args.get('from'):
+                created_range['$gte'] = datetime.fromisoformat(request.args['from'])
+            if request.args.get('to'):
+                created_range['$lt'] = datetime.fromisoformat(request.args['to'])
+        except ValueError:
+            return jsonify({'error': 'Invalid date range'}), 400
+        if created_range:
+            query['createdAt'] = created_range
+
+        # Get investment history for the user, newest first
+        history = [
+            format_history_entry(entry)
+            for entry in sorted(find_user_history(db, user_id, query), key=entry_time, reverse=True)
+        ]
             
         return jsonify({'history': history})
     except Exception as e:
-        print(f"Error fetching investment history: {str(e)}")
+        logger.exception('Error fetching investment history')
         return jsonify({'error': 'Failed to fetch investment history'}), 500
 
+@api.route('/api/portfolio/series', methods=['GET'])
+@login_required
+@query_budget(7)
+def get_portfolio_value_series():
+    try:
+        points = request.args.get('points', DEFAULT_SERIES_POINTS, type=int)
+        series = get_portfolio_series(db, session['user_id'], points)
+        return jsonify({'series': series})
+    except Exception as e:
+        logger.exception('Error fetching portfolio series')
+        return jsonify({'error': 'Failed to fetch portfolio series'}), 500
+
 # Referral routes
-@app.route('/api/referral/stats', methods=['GET'])
+@api.route('/api/referral/stats', methods=['GET'])
 @login_required
 def get_referral_stats():
     try:
         user_id = session['user_id']
-        print(f"Getting referral stats for user: {user_id}")
-        
         # Get all users who were referred by the current user
         level1_referrals = list(db.users.find({'referredBy': ObjectId(user_id)}))
         level1_count = len(level1_referrals)
-        print(f"Found {level1_count} level 1 referrals")
         
         # Get level 2 referrals (users referred by your referrals)
         level2_count = 0
@@ -847,19 +746,15 @@ def get_referral_stats():
             level2_refs = list(db.users.find({'referredBy': ref['_id']}))
             level2_count += len(level2_refs)
             level2_ids.extend([ref['_id'] for ref in level2_refs])
-        print(f"Found {level2_count} level 2 referrals")
         
         # Get level 3 referrals
         level3_count = 0
         for ref_id in level2_ids:
             level3_refs = list(db.users.find({'referredBy': ref_id}))
             level3_count += len(level3_refs)
-        print(f"Found {level3_count} level 3 referrals")
         
         # Calculate earnings
         earnings = calculate_referral_earnings(user_id)
-        print(f"Calculated earnings: {earnings}")
-        
         stats = {
             'counts': {
                 'level1': level1_count,
@@ -870,134 +765,113 @@ def get_referral_stats():
             'earnings': earnings
         }
         
-        print(f"Final referral stats: {stats}")
+        logger.debug('Referral stats', extra={'stats': stats})
         return jsonify(stats)
     except Exception as e:
-        print(f"Get referral stats error: {str(e)}")
+        logger.exception('Get referral stats error')
         return jsonify({'error': 'Failed to fetch referral stats'}), 500
 
-@app.route('/api/referral/history', methods=['GET'])
+@api.route('/api/referral/history', methods=['GET'])
 @login_required
 def get_referral_history():
     try:
         user_id = session.get('user_id')
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
         # Get all referrals (direct and indirect)
         referrals = []
+        # Earnings per referred user, from the precomputed summary
+        earnings = get_referral_earnings(db, ObjectId(user_id))
+        no_earnings = {'oneTimeRewards': 0, 'dailyCommissions': 0}
+
+        def referral_row(ref, level):
+            ref_earnings = earnings.get(ref['_id'], no_earnings)
+            return format_referral(
+                ref, level, ref_earnings['oneTimeRewards'], ref_earnings['dailyCommissions'],
+                db.users.count_documents({'referredBy': ref['_id']})
+            )
         
         # Get level 1 (direct) referrals
         level1_refs = list(db.users.find({'referredBy': ObjectId(user_id)}))
         for ref in level1_refs:
-            # Get earnings for this referral
-            one_time_rewards = sum(reward.get('amount', 0) 
-                for reward in db.referral_history.find({
-                    'referrerId': ObjectId(user_id),
-                    'userId': ref['_id'],  
-                    'type': 'one_time_reward'
-                })
-            )
-            
-            daily_commissions = sum(reward.get('amount', 0)
-                for reward in db.referral_history.find({
-                    'referrerId': ObjectId(user_id),
-                    'userId': ref['_id'],  
-                    'type': 'daily_commission'
-                })
-            )
-            
-            referrals.append({
-                '_id': str(ref['_id']),
-                'username': ref.get('username', ''),
-                'phone': ref.get('phone', ''),
-                'joinedAt': ref['createdAt'].isoformat() if isinstance(ref.get('createdAt'), datetime) else ref.get('createdAt', ''),
-                'isActive': ref.get('isActive', False),
-                'referralCount': db.users.count_documents({'referredBy': ref['_id']}),
-                'level': 1,
-                'earnings': {
-                    'oneTimeRewards': float(one_time_rewards),
-                    'dailyCommissions': float(daily_commissions),
-                    'total': float(one_time_rewards + daily_commissions)
-                }
-            })
+            referrals.append(referral_row(ref, 1))
             
             # Get level 2 referrals
             level2_refs = list(db.users.find({'referredBy': ref['_id']}))
             for l2_ref in level2_refs:
-                l2_one_time = sum(reward.get('amount', 0)
-                    for reward in db.referral_history.find({
-                        'referrerId': ObjectId(user_id),
-                        'userId': l2_ref['_id'],  
-                        'type': 'one_time_reward'
-                    })
-                )
-                
-                l2_daily = sum(reward.get('amount', 0)
-                    for reward in db.referral_history.find({
-                        'referrerId': ObjectId(user_id),
-                        'userId': l2_ref['_id'],  
-                        'type': 'daily_commission'
-                    })
-                )
-                
-                referrals.append({
-                    '_id': str(l2_ref['_id']),
-                    'username': l2_ref.get('username', ''),
-                    'phone': l2_ref.get('phone', ''),
-                    'joinedAt': l2_ref['createdAt'].isoformat() if isinstance(l2_ref.get('createdAt'), datetime) else l2_ref.get('createdAt', ''),
-                    'isActive': l2_ref.get('isActive', False),
-                    'referralCount': db.users.count_documents({'referredBy': l2_ref['_id']}),
-                    'level': 2,
-                    'earnings': {
-                        'oneTimeRewards': float(l2_one_time),
-                        'dailyCommissions': float(l2_daily),
-                        'total': float(l2_one_time + l2_daily)
-                    }
-                })
+                referrals.append(referral_row(l2_ref, 2))
                 
                 # Get level 3 referrals
                 level3_refs = list(db.users.find({'referredBy': l2_ref['_id']}))
                 for l3_ref in level3_refs:
-                    l3_one_time = sum(reward.get('amount', 0)
-                        for reward in db.referral_history.find({
-                            'referrerId': ObjectId(user_id),
-                            'userId': l3_ref['_id'],  
-                            'type': 'one_time_reward'
-                        })
-                    )
-                    
-                    l3_daily = sum(reward.get('amount', 0)
-                        for reward in db.referral_history.find({
-                            'referrerId': ObjectId(user_id),
-                            'userId': l3_ref['_id'],  
-                            'type': 'daily_commission'
-                        })
-                    )
-                    
-                    referrals.append({
-                        '_id': str(l3_ref['_id']),
-                        'username': l3_ref.get('username', ''),
-                        'phone': l3_ref.get('phone', ''),
-                        'joinedAt': l3_ref['createdAt'].isoformat() if isinstance(l3_ref.get('createdAt'), datetime) else l3_ref.get('createdAt', ''),
-                        'isActive': l3_ref.get('isActive', False),
-                        'referralCount': db.users.count_documents({'referredBy': l3_ref['_id']}),
-                        'level': 3,
-                        'earnings': {
-                            'oneTimeRewards': float(l3_one_time),
-                            'dailyCommissions': float(l3_daily),
-                            'total': float(l3_one_time + l3_daily)
-                        }
-                    })
+                    referrals.append(referral_row(l3_ref, 3))
 
         return jsonify({'referrals': referrals})
         
     except Exception as e:
-        print(f"Get referral history error: {str(e)}")
+        logger.exception('Get referral history error')
         return jsonify({'error': 'Failed to fetch referral history'}), 500
 
+@api.route('/api/referral/leaderboard', methods=['GET'])
+@login_required
+@query_budget(3)
+def get_referral_leaderboard():
+    window = request.args.get('window', 'all')
+    ordering = request.args.get('sort', 'earnings')
+    if window not in WINDOWS or ordering not in ORDERINGS:
+        return jsonify({'error': 'Invalid window or sort'}), 400
+    try:
+        rows = get_leaderboard(db, window, ordering, request.args.get('limit', 20, type=int))
+        return jsonify({
+            'window': window,
+            'sort': ordering,
+            'leaders': [dict(row, isYou=row['userId'] == session['user_id']) for row in rows]
+        })
+    except Exception as e:
+        logger.exception('Get referral leaderboard error')
+        return jsonify({'error': 'Failed to fetch leaderboard'}), 500
+
+@api.route('/api/events/stream', methods=['GET'])
+@login_required
+def stream_events():
+    # EventSource resends the last id it saw in Last-Event-ID when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    return Response(stream_user_events(db, session['user_id'], last_event_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api.route('/api/forex/prices', methods=['GET'])
+def get_forex_prices():
+    try:
+        # ?history=N adds the last N ticks per pair from the in-memory ring buffer
+        history = min(request.args.get('history', 0, type=int), 1000)
+        prices = []
+        for pair, tick in sorted(price_book.snapshot().items()):
+            entry = format_tick(tick)
+            if history > 0:
+                entry['history'] = [
+                    {'ts': ts.isoformat(), 'price': price}
+                    for ts, price in price_book.history(pair, history)
+                ]
+            prices.append(entry)
+        return jsonify({'prices': prices})
+    except Exception as e:
+        logger.exception('Get forex prices error')
+        return jsonify({'error': 'Failed to fetch prices'}), 500
+
+@api.route('/api/forex/stream', methods=['GET'])
+def stream_forex_prices():
+    # Served from the in-process price book; no Mongo access per client
+    return Response(stream_prices(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 if __name__ == '__main__':
     from scheduler import start_scheduler
+    from forex_prices import start_price_producer
+    app = create_app()
+    init_process()
     scheduler = start_scheduler()
+    start_price_producer(db)
     app.run(port=5000)
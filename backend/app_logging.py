@@ -0,0 +1,187 @@
+"""Structured, non-blocking logging.
+
+Application code logs through the standard logging module. Records are put on
+an in-memory queue by a QueueHandler and formatted as JSON and written by a
+QueueListener running on a native OS thread, so request greenlets never wait
+on stdout or the log file.
+
+Every record logged during a request carries its request id (taken from the
+X-Request-ID header or generated) and url rule. DEBUG records are gated twice:
+the logger level comes from LOG_LEVEL, and inside requests DEBUG records are
+only kept for a sample of requests per route, configured with
+LOG_DEBUG_SAMPLE_RATE (default for all routes) and LOG_DEBUG_SAMPLE_ROUTES
+("/api/investments=0.1,/api/referral/stats=1").
+"""
+from datetime import datetime, timezone
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+from flask import g, has_request_context, request
+
+LOGGER_NAME = 'secure_auth'
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _original(module, name, default):
+    """The unpatched stdlib object when gevent has monkey-patched the module"""
+    try:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    except ImportError:
+        return default
+
+
+_NativeThread = _original('threading', 'Thread', threading.Thread)
+_NativeSimpleQueue = _original('queue', 'SimpleQueue', queue.SimpleQueue)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with request context and `extra` fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Formatted by StructuredQueueHandler before the record was queued
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the traceback out of `msg`.
+
+    The stock prepare() formats the record, so the traceback ends up appended
+    to `msg` and exc_info/exc_text are cleared. Here the message is merged
+    with its args and the traceback is rendered into exc_text on the logging
+    thread, while the frames are still alive, and both stay separate fields.
+    """
+
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds request id and route, and drops DEBUG records of unsampled requests"""
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        record.request_id = g.get('request_id')
+        record.route = request.url_rule.rule if request.url_rule else request.path
+        if record.levelno <= logging.DEBUG and not g.get('log_debug', False):
+            return False
+        return True
+
+
+class NativeQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose worker is a real thread even under gevent"""
+
+    def start(self):
+        self._thread = thread = _NativeThread(target=self._monitor, name='log-writer')
+        thread.daemon = True
+        thread.start()
+
+
+def _parse_sample_routes(value):
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        route, _, rate = item.partition('=')
+        try:
+            rates[route.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+_listener = None
+
+
+def configure_logging(app=None):
+    """Route application logging through the queue and install request hooks"""
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+
+    if _listener is None:
+        log_queue = _NativeSimpleQueue()
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(JsonFormatter())
+        _listener = NativeQueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+        # The writer thread does not survive fork; give each child its own
+        os.register_at_fork(after_in_child=_restart_listener)
+
+        queue_handler = StructuredQueueHandler(log_queue)
+        queue_handler.addFilter(RequestContextFilter())
+        logger.addHandler(queue_handler)
+        logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        logger.propagate = False
+
+    if app is not None:
+        default_rate = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0'))
+        route_rates = _parse_sample_routes(os.getenv('LOG_DEBUG_SAMPLE_ROUTES', ''))
+
+        @app.before_request
+        def assign_request_id():
+            g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+            route = request.url_rule.rule if request.url_rule else request.path
+            rate = route_rates.get(route, default_rate)
+            g.log_debug = rate > 0 and random.random() < rate
+
+        @app.after_request
+        def echo_request_id(response):
+            if g.get('request_id'):
+                response.headers['X-Request-ID'] = g.request_id
+            return response
+
+    return logger
+
+
+def get_logger(name=None):
+    """Child of the application logger, e.g. get_logger('jobs')"""
+    return logging.getLogger(f'{LOGGER_NAME}.{name}' if name else LOGGER_NAME)
+
+
+def _restart_listener():
+    global _listener
+    if _listener is not None:
+        _listener = NativeQueueListener(_listener.queue, *_listener.handlers, respect_handler_level=True)
+        _listener.start()
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,92 @@
+"""Fill the earnings_daily rollup from investment_history.
+
+earnings_daily is maintained by the daily ROI job, so it only holds the days
+since that job started writing it. This one-off tool recomputes every
+(userId, date) total from the ROI entries in investment_history with one
+$group and $merges them into earnings_daily, replacing the amount of rows
+that already exist. It is idempotent and can be re-run at any time, but not
+while the ROI job is running.
+
+Entries in either layout are read: the time-series one (meta.userId, day
+derived from createdAt) and the legacy one (top-level userId, sometimes a
+string, and an ISO `date`). While migrate_investment_history.py is part way
+through, entries are split between two collections; finish the migration
+first.
+
+    python backfill_earnings_daily.py
+    python backfill_earnings_daily.py --dry-run
+"""
+import argparse
+import os
+import time
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from investment_history import COLLECTION, LEGACY_COLLECTION, migration_completed
+
+_USER_ID = {'$ifNull': ['$meta.userId', {'$ifNull': ['$userId', '$user_id']}]}
+
+
+def backfill_pipeline():
+    """ROI entries grouped into earnings_daily rows"""
+    return [
+        {'$match': {'type': {'$in': ['roi_earning', None]}}},
+        {'$project': {
+            'userId': {'$cond': [
+                {'$eq': [{'$type': _USER_ID}, 'string']}, {'$toObjectId': _USER_ID}, _USER_ID
+            ]},
+            'date': {'$cond': [
+                {'$eq': [{'$type': '$createdAt'}, 'date']},
+                {'$dateToString': {'date': '$createdAt', 'format': '%Y-%m-%d'}},
+                {'$ifNull': ['$date', {'$substrBytes': ['$createdAt', 0, 10]}]}
+            ]},
+            'amount': {'$toDouble': {'$ifNull': ['$amount', 0]}}
+        }},
+        {'$match': {'userId': {'$ne': None}, 'date': {'$ne': None}}},
+        {'$group': {'_id': {'userId': '$userId', 'date': '$date'}, 'amount': {'$sum': '$amount'}}},
+        {'$project': {
+            '_id': 0,
+            'userId': '$_id.userId',
+            'date': '$_id.date',
+            'amount': 1,
+            'updatedAt': '$$NOW'
+        }}
+    ]
+
+
+def backfill_earnings_daily(db, dry_run=False):
+    """Recompute earnings_daily from investment_history; returns the number of rows"""
+    started = time.monotonic()
+    if LEGACY_COLLECTION in db.list_collection_names() and not migration_completed(db):
+        raise RuntimeError(f'{LEGACY_COLLECTION} has not been fully migrated; '
+                           f'run migrate_investment_history.py first')
+
+    pipeline = backfill_pipeline()
+    if dry_run:
+        rows = sum(1 for _ in db[COLLECTION].aggregate(pipeline, allowDiskUse=True))
+    else:
+        pipeline.append({'$merge': {
+            'into': 'earnings_daily',
+            'on': ['userId', 'date'],
+            'whenMatched': 'merge',
+            'whenNotMatched': 'insert'
+        }})
+        list(db[COLLECTION].aggregate(pipeline, allowDiskUse=True))
+        rows = db.earnings_daily.count_documents({})
+    print(f"Backfilled {rows} earnings_daily rows in {time.monotonic() - started:.1f}s"
+          f"{' (dry run)' if dry_run else ''}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill earnings_daily from investment_history')
+    parser.add_argument('--dry-run', action='store_true', help='Aggregate without writing')
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/secure_auth_glass'))
+    db = client.get_default_database()
+    backfill_earnings_daily(db, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
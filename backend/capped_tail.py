@@ -0,0 +1,79 @@
+"""Resumable tailing of a capped collection written by many processes.
+
+A tailable cursor returns documents in insertion (natural) order, but
+ObjectIds minted by different processes are not ordered by insertion, so
+"everything with an _id greater than the last one seen" both skips and
+repeats documents when a cursor has to be re-opened.
+
+tail_capped() keeps its tailable cursor open for as long as the server
+allows. When it has to open a new one (the cursor died or the read failed)
+it re-scans the documents whose `ts` is within RESUME_WINDOW of the newest
+one it handled and skips the ids it has already seen. The window has to
+cover the clock skew between publishers and the time a document takes
+from being stamped to being inserted.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import os
+import time
+from pymongo import CursorType
+from pymongo.errors import PyMongoError
+from app_logging import get_logger
+
+logger = get_logger('capped_tail')
+
+RESUME_WINDOW = timedelta(seconds=float(os.getenv('CAPPED_TAIL_RESUME_WINDOW', '60')))
+
+
+class SeenIds:
+    """Ids handled within the resume window, oldest first"""
+
+    def __init__(self, window=RESUME_WINDOW):
+        self.window = window
+        self._ids = OrderedDict()
+        self.newest = None
+
+    def add(self, doc_id, ts):
+        """Record one document; False if it was already seen"""
+        if doc_id in self._ids:
+            return False
+        self._ids[doc_id] = ts
+        if ts is not None and (self.newest is None or ts > self.newest):
+            self.newest = ts
+            # Ids older than the window can no longer come back from a re-scan
+            while self._ids and next(iter(self._ids.values())) < self.newest - self.window:
+                self._ids.popitem(last=False)
+        return True
+
+    def resume_from(self):
+        return (self.newest or datetime.utcnow()) - self.window
+
+
+def tail_capped(collection, handle, stopped=None, name=None, seen=None):
+    """Call handle(doc) for every document inserted into `collection` from now on
+
+    `seen` holds documents the caller already handled itself (e.g. while
+    warming a cache); tailing resumes from the newest of them. Without it,
+    documents already within the window count as handled.
+    """
+    name = name or collection.name
+    if seen is None:
+        seen = SeenIds()
+        try:
+            for doc in collection.find({'ts': {'$gte': seen.resume_from()}}, {'_id': 1, 'ts': 1}):
+                seen.add(doc['_id'], doc.get('ts'))
+        except PyMongoError:
+            logger.exception('Failed to read recent documents', extra={'collection': name})
+
+    while stopped is None or not stopped.is_set():
+        query = {'ts': {'$gte': seen.resume_from()}}
+        try:
+            cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(1000)
+            while cursor.alive and (stopped is None or not stopped.is_set()):
+                for doc in cursor:
+                    if seen.add(doc['_id'], doc.get('ts')):
+                        handle(doc)
+        except PyMongoError:
+            logger.exception('Tailable cursor failed, retrying', extra={'collection': name})
+        # An empty capped collection returns a dead cursor immediately
+        time.sleep(0.1 if seen.newest is not None else 1)
@@ -0,0 +1,156 @@
+"""Versioned, in-memory commission rate and reward configuration.
+
+Every change to referral rewards or daily commission rates is a new document
+in `commission_rates` with an increasing `version` and an `effectiveFrom`
+date; documents are never edited in place. Each process loads the whole
+history once and serves lookups from memory, both for request paths (current
+rates) and for jobs, which ask for the rates effective on the day they are
+computing so past commissions can be recomputed at historical rates.
+
+publish_commission_rates() inserts a new version and broadcasts a reload over
+the invalidation bus; as a fallback each process also checks the latest
+version every COMMISSION_CONFIG_REFRESH seconds.
+"""
+from bisect import bisect_right
+from datetime import datetime
+import os
+import threading
+import time
+from pymongo.errors import DuplicateKeyError
+from invalidation_bus import publish_invalidation, register_invalidation_handler
+
+DEFAULT_FOREX_REWARDS = {
+    'EUR/USD': 100,
+    'GBP/USD': 300,
+    'USD/JPY': 500,
+    'USD/CHF': 600,
+    'AUD/USD': 700,
+    'EUR/GBP': 1000,
+    'EUR/AUD': 1500,
+    'USD/CAD': 2500,
+    'NZD/USD': 5000
+}
+
+DEFAULT_DAILY_COMMISSION = {
+    'level1': 0.10,  # 10% ROI
+    'level2': 0.05,  # 5% ROI
+    'level3': 0.02   # 2% ROI
+}
+
+REFRESH_INTERVAL = float(os.getenv('COMMISSION_CONFIG_REFRESH', '300'))
+EPOCH = datetime(1970, 1, 1)
+
+
+def _normalize(doc):
+    """Rates document as served to callers; legacy documents count as version 0"""
+    return {
+        'version': doc.get('version', 0),
+        'effectiveFrom': doc.get('effectiveFrom') or EPOCH,
+        'forex_rewards': dict(doc.get('forex_rewards', {})),
+        'daily_commission': dict(doc.get('daily_commission', {}))
+    }
+
+
+class CommissionConfig:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = []
+        self._effective = []
+        self._loaded_at = None
+        self._stale = True
+
+    def mark_stale(self, key=None):
+        self._stale = True
+
+    def _load(self, db):
+        docs = [_normalize(doc) for doc in db.commission_rates.find({})]
+        docs.sort(key=lambda d: (d['effectiveFrom'], d['version']))
+        self._versions = docs
+        self._effective = [d['effectiveFrom'] for d in docs]
+        self._loaded_at = time.monotonic()
+        self._stale = False
+
+    def _ensure_fresh(self, db):
+        if not self._stale and time.monotonic() - self._loaded_at < REFRESH_INTERVAL:
+            return
+        with self._lock:
+            if self._stale or self._loaded_at is None:
+                self._load(db)
+                return
+            if time.monotonic() - self._loaded_at < REFRESH_INTERVAL:
+                return
+            latest = db.commission_rates.find_one({}, {'version': 1}, sort=[('version', -1)])
+            latest_version = latest.get('version', 0) if latest else None
+            known_version = max((d['version'] for d in self._versions), default=None)
+            if latest_version != known_version:
+                self._load(db)
+            else:
+                self._loaded_at = time.monotonic()
+
+    def rates_at(self, db, when):
+        """Rates document effective at `when`, or None if none was effective yet"""
+        self._ensure_fresh(db)
+        versions = self._versions
+        index = bisect_right(self._effective, when) - 1
+        return versions[index] if index >= 0 else None
+
+    def current(self, db):
+        return self.rates_at(db, datetime.utcnow())
+
+    def history(self, db):
+        self._ensure_fresh(db)
+        return list(self._versions)
+
+
+commission_config = CommissionConfig()
+register_invalidation_handler('commission_rates', commission_config.mark_stale)
+
+
+def get_current_rates(db):
+    """Rates in effect now, served from memory"""
+    return commission_config.current(db)
+
+
+def get_rates_at(db, when):
+    """Rates that were in effect at `when`, for (re)computing past commissions"""
+    return commission_config.rates_at(db, when)
+
+
+def publish_commission_rates(db, forex_rewards, daily_commission, effective_from=None):
+    """Store a new rates version and tell every worker to reload"""
+    now = datetime.utcnow()
+    while True:
+        latest = db.commission_rates.find_one({}, {'version': 1}, sort=[('version', -1)])
+        version = (latest.get('version', 0) if latest else 0) + 1
+        try:
+            db.commission_rates.insert_one({
+                'version': version,
+                'effectiveFrom': effective_from or now,
+                'forex_rewards': forex_rewards,
+                'daily_commission': daily_commission,
+                'created_at': now,
+                'updated_at': now
+            })
+            break
+        except DuplicateKeyError:
+            # Another writer took this version number
+            continue
+    publish_invalidation('commission_rates')
+    return version
+
+
+def init_commission_rates(db):
+    """Create the indexes and seed version 1 when no rates exist yet"""
+    db.commission_rates.create_index('version', unique=True, partialFilterExpression={'version': {'$exists': True}})
+    if db.commission_rates.count_documents({}, limit=1) == 0:
+        try:
+            db.commission_rates.insert_one({
+                'version': 1,
+                'effectiveFrom': EPOCH,
+                'forex_rewards': DEFAULT_FOREX_REWARDS,
+                'daily_commission': DEFAULT_DAILY_COMMISSION,
+                'created_at': datetime.utcnow(),
+                'updated_at': datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            pass
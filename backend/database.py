@@ -0,0 +1,292 @@
+"""Lazily created, fork-safe MongoDB access.
+
+Nothing here talks to Mongo at import time. The client is created on first
+use in each process and re-created if the process has forked since (a
+MongoClient must not be shared across fork), so importing the app or the
+jobs never opens sockets in the gunicorn master.
+
+init_process() does the per-process startup work: connect, create indexes,
+seed the commission rates, start the invalidation bus, the forex price feed
+and the user event hub, and warm up the connection pool. gunicorn calls it
+from post_worker_init; the app also calls it before the first request so
+other servers behave the same.
+
+Pool sizing, timeouts, compression and read/write concerns come from MONGO_*
+environment variables (see mongo_client_options); unset variables keep the
+pymongo defaults or whatever the connection string specifies. Pool checkout
+waits and saturation are exported to Prometheus by PoolMetricsListener.
+"""
+import os
+import threading
+import time
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import MongoClient, monitoring
+from pymongo.errors import OperationFailure
+from werkzeug.local import LocalProxy
+from app_logging import get_logger
+from commission_config import init_commission_rates
+from dedupe_users import duplicate_values
+from forex_prices import start_price_feed
+from instrumentation import RouteCommandListener, background_commands
+from investment_history import ensure_investment_history_collection
+from invalidation_bus import start_invalidation_bus
+from referral_earnings import ensure_referral_earnings_summary
+from user_events import start_user_events
+
+logger = get_logger('database')
+
+DEFAULT_MONGODB_URI = 'mongodb://localhost:27017/secure_auth_glass'
+
+POOL_CHECKOUT_WAIT = Histogram(
+    'mongo_pool_checkout_wait_seconds', 'Time spent waiting to check a connection out of the pool',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+POOL_CHECKOUT_FAILED = Counter(
+    'mongo_pool_checkout_failed_total', 'Pool checkouts that failed',
+    ['reason']
+)
+POOL_CONNECTIONS = Gauge(
+    'mongo_pool_connections', 'Pooled connections per worker by state',
+    ['state'],
+    multiprocess_mode='liveall'
+)
+POOL_WAITING = Gauge(
+    'mongo_pool_waiting', 'Operations waiting for a pooled connection per worker',
+    multiprocess_mode='liveall'
+)
+POOL_MAX_SIZE = Gauge(
+    'mongo_pool_max_size', 'Configured maxPoolSize per worker',
+    multiprocess_mode='liveall'
+)
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Exports checkout wait times and pool saturation.
+
+    Checkout events fire on the greenlet doing the checkout, so a
+    greenlet-local start time pairs each started event with its outcome.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        POOL_CONNECTIONS.labels('open').inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        POOL_CONNECTIONS.labels('open').dec()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        POOL_WAITING.inc()
+
+    def connection_check_out_failed(self, event):
+        self._finish_wait()
+        POOL_CHECKOUT_FAILED.labels(str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        self._finish_wait()
+        POOL_CONNECTIONS.labels('checked_out').inc()
+
+    def connection_checked_in(self, event):
+        POOL_CONNECTIONS.labels('checked_out').dec()
+
+    def _finish_wait(self):
+        started = getattr(self._local, 'started', None)
+        if started is not None:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+            self._local.started = None
+        POOL_WAITING.dec()
+
+
+def _env_int(name):
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else None
+
+
+def mongo_client_options():
+    """MongoClient keyword arguments for this deployment, from MONGO_* variables"""
+    options = {
+        'maxPoolSize': _env_int('MONGO_MAX_POOL_SIZE'),
+        'minPoolSize': _env_int('MONGO_MIN_POOL_SIZE'),
+        'maxConnecting': _env_int('MONGO_MAX_CONNECTING'),
+        'maxIdleTimeMS': _env_int('MONGO_MAX_IDLE_TIME_MS'),
+        'waitQueueTimeoutMS': _env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        'serverSelectionTimeoutMS': _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+        'connectTimeoutMS': _env_int('MONGO_CONNECT_TIMEOUT_MS'),
+        'socketTimeoutMS': _env_int('MONGO_SOCKET_TIMEOUT_MS'),
+        # e.g. "zstd,snappy,zlib"; zstd needs `zstandard`, snappy `python-snappy`
+        'compressors': os.getenv('MONGO_COMPRESSORS') or None,
+        'readPreference': os.getenv('MONGO_READ_PREFERENCE') or None
+    }
+    options = {key: value for key, value in options.items() if value is not None}
+
+    if os.getenv('MONGO_READ_CONCERN'):
+        options['readConcernLevel'] = os.getenv('MONGO_READ_CONCERN')
+    write_concern = os.getenv('MONGO_WRITE_CONCERN')
+    if write_concern:
+        options['w'] = int(write_concern) if write_concern.isdigit() else write_concern
+    if os.getenv('MONGO_WRITE_JOURNAL'):
+        options['journal'] = os.getenv('MONGO_WRITE_JOURNAL').lower() in ('1', 'true', 'yes')
+    return options
+
+
+_lock = threading.Lock()
+_init_lock = threading.Lock()
+_client = None
+_database = None
+_client_pid = None
+_initialized_pid = None
+
+
+def get_client():
+    """MongoClient owned by the current process"""
+    global _client, _database, _client_pid
+    pid = os.getpid()
+    if _client_pid != pid:
+        with _lock:
+            if _client_pid != pid:
+                # A client inherited from the parent is left alone; closing it
+                # would tear down sockets the parent still uses
+                _client = MongoClient(
+                    os.getenv('MONGODB_URI', DEFAULT_MONGODB_URI),
+                    event_listeners=[RouteCommandListener(), PoolMetricsListener()],
+                    **mongo_client_options()
+                )
+                _database = _client.get_default_database()
+                POOL_MAX_SIZE.set(_client.options.pool_options.max_pool_size)
+                _client_pid = pid
+    return _client
+
+
+def get_db():
+    """Default database of the current process' client"""
+    if _client_pid != os.getpid():
+        get_client()
+    return _database
+
+
+# Module-level handle used throughout the app: `db.users.find_one(...)`
+db = LocalProxy(get_db)
+
+# Standalone servers reject sessions with transactions
+ILLEGAL_OPERATION = 20
+_transactions_supported = True
+
+
+def run_transaction(callback):
+    """callback(session) in a transaction, retried on transient errors.
+
+    On a standalone server, which has no transactions, callback(None) runs
+    the same writes without one. The first write of a transaction is what
+    fails there, so nothing has been written when falling back.
+    """
+    global _transactions_supported
+    if _transactions_supported:
+        try:
+            with get_client().start_session() as session:
+                return session.with_transaction(callback)
+        except OperationFailure as e:
+            if e.code != ILLEGAL_OPERATION:
+                raise
+            _transactions_supported = False
+            logger.warning('MongoDB does not support transactions; writing without them')
+    return callback(None)
+
+
+class UniqueIndexError(RuntimeError):
+    """A unique index the app relies on for correctness could not be built"""
+
+
+def init_indexes(database):
+    """Indexes backing the per-user read paths"""
+    database.investments.create_index([('userId', 1), ('forexPair', 1)])
+    ensure_investment_history_collection(database)
+    database.earnings_daily.create_index([('userId', 1), ('date', 1)], unique=True)
+    database.referral_history.create_index([('referrerId', 1), ('referredId', 1)])
+    # Compaction: old daily rows by date, and one bucket per referral and month
+    database.referral_history.create_index([('type', 1), ('date', 1)])
+    database.referral_history.create_index(
+        [('referrerId', 1), ('referredId', 1), ('month', 1)],
+        unique=True, partialFilterExpression={'bucket': True}
+    )
+    # Buckets are recomputed from the archived rows of their month
+    database.referral_history_archive.create_index([('referrerId', 1), ('referredId', 1), ('date', 1)])
+    database.referral_earnings_summary.create_index([('referrerId', 1), ('referredId', 1)], unique=True)
+    ensure_referral_earnings_summary(database)
+    # Leaderboard: one row per referrer and period, top K by either ordering, old periods expire
+    database.referral_leaderboard.create_index([('window', 1), ('period', 1), ('referrerId', 1)], unique=True)
+    for ordering in ('earnings', 'downline'):
+        database.referral_leaderboard.create_index([('window', 1), ('period', 1), (ordering, -1), ('referrerId', 1)])
+    database.referral_leaderboard.create_index('expiresAt', expireAfterSeconds=0)
+    # Leaderboard downline sync: registrations since its last run
+    database.users.create_index('createdAt')
+    # Nightly maturity sweep: active investments due by a date
+    database.investments.create_index([('status', 1), ('maturesAt', 1)])
+    # Registration relies on these instead of pre-check queries, so a worker
+    # must not serve requests without them
+    for field in ('phone', 'referralCode'):
+        try:
+            database.users.create_index(field, unique=True, partialFilterExpression={field: {'$type': 'string'}})
+        except OperationFailure as e:
+            shared = [duplicate['value'] for duplicate in duplicate_values(database, field, limit=10)]
+            logger.exception('Could not create a unique users index; existing values are duplicated',
+                             extra={'field': field, 'duplicates': shared})
+            raise UniqueIndexError(
+                f'Unique index on users.{field} could not be built; shared values include {shared}. '
+                f'Run `python dedupe_users.py` to list every one and resolve them before starting the app'
+            ) from e
+
+
+def warm_up_pool(connections):
+    """Open `connections` pooled sockets before the first request needs them"""
+    client = get_client()
+
+    def ping():
+        try:
+            client.admin.command('ping')
+        except Exception:
+            logger.exception('Connection pool warm-up failed')
+
+    # Concurrent pings force the pool to open one socket each
+    threads = [threading.Thread(target=ping) for _ in range(max(connections, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def init_process():
+    """One-time Mongo startup for this process; cheap to call again"""
+    global _initialized_pid
+    pid = os.getpid()
+    if _initialized_pid == pid:
+        return
+    # Not part of whichever request happens to trigger it
+    with _init_lock, background_commands():
+        if _initialized_pid == pid:
+            return
+        database = get_db()
+        init_indexes(database)
+        init_commission_rates(database)
+        start_invalidation_bus(database)
+        start_price_feed(database)
+        start_user_events(database)
+        warm_up_pool(int(os.getenv('MONGO_WARMUP_CONNECTIONS', '4')))
+        _initialized_pid = pid
+    logger.info('Mongo initialized', extra={'pid': pid})
@@ -0,0 +1,75 @@
+"""Find (and where safe, resolve) duplicate users.phone and users.referralCode values.
+
+Workers refuse to start while the unique phone or referralCode index cannot
+be built, which happens when existing users share a value. This tool lists
+every shared value with the users holding it, oldest first:
+
+    python dedupe_users.py
+
+Shared referral codes can be resolved automatically: with
+--fix-referral-codes every holder but the oldest gets a freshly allocated
+code. referredBy stores user ids, so existing referrals are unaffected; only
+the code those users share changes. Shared phone numbers need a decision
+about which account keeps the number and are only reported.
+"""
+import argparse
+import os
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from referral_codes import allocate_referral_code
+
+UNIQUE_FIELDS = ('phone', 'referralCode')
+
+
+def duplicate_values(db, field, limit=None):
+    """[{'value', 'users': [{'_id', 'username', 'createdAt'}]}] for values held by more than one user"""
+    pipeline = [
+        # Only strings are covered by the unique index
+        {'$match': {field: {'$type': 'string'}}},
+        {'$sort': {'createdAt': 1, '_id': 1}},
+        {'$group': {
+            '_id': f'${field}',
+            'users': {'$push': {'_id': '$_id', 'username': '$username', 'createdAt': '$createdAt'}},
+            'count': {'$sum': 1}
+        }},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$sort': {'count': -1, '_id': 1}},
+        {'$project': {'_id': 0, 'value': '$_id', 'users': 1}}
+    ]
+    if limit:
+        pipeline.append({'$limit': limit})
+    return list(db.users.aggregate(pipeline, allowDiskUse=True))
+
+
+def fix_referral_codes(db, duplicates):
+    """Give every holder of a shared code but the oldest a new one; returns the number of users changed"""
+    changed = 0
+    for duplicate in duplicates:
+        for user in duplicate['users'][1:]:
+            db.users.update_one({'_id': user['_id']}, {'$set': {'referralCode': allocate_referral_code(db)}})
+            changed += 1
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report duplicate users.phone and users.referralCode values')
+    parser.add_argument('--fix-referral-codes', action='store_true',
+                        help='Reassign shared referral codes, keeping them on the oldest user')
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/secure_auth_glass'))
+    db = client.get_default_database()
+
+    for field in UNIQUE_FIELDS:
+        duplicates = duplicate_values(db, field)
+        print(f"{field}: {len(duplicates)} shared values")
+        for duplicate in duplicates:
+            holders = ', '.join(f"{user['_id']} ({user.get('username', '')})" for user in duplicate['users'])
+            print(f"  {duplicate['value']!r}: {holders}")
+        if field == 'referralCode' and duplicates and args.fix_referral_codes:
+            print(f"Reassigned referral codes of {fix_referral_codes(db, duplicates)} users")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Server-side forex prices: one producer, in-memory books, SSE fan-out.
+
+A single producer (started by the scheduler process, or standalone with
+`python forex_prices.py`) reads ticks from a pluggable source and appends
+them to the capped `forex_ticks` collection. FOREX_PRICE_SOURCE selects the
+source:
+
+    simulator                 random walk around BASE_PRICES (default)
+    replay:/path/ticks.jsonl  {"pair", "price", "ts"} per line, or a CSV
+                              with ts,pair,price columns, paced by the
+                              timestamps and looped
+
+Every process tails `forex_ticks` with capped_tail, like the invalidation
+bus, and keeps a PriceBook: the latest tick and a ring buffer of the
+last FOREX_PRICE_BUFFER ticks per pair. Request paths read prices from that
+book, so they never query Mongo for a price.
+
+The SSE stream fans out from the book. Each tick bumps a sequence number and
+wakes the waiting clients. Every client remembers the last sequence it sent
+and on waking sends only the newest tick of each pair changed since then, so
+a slow client skips intermediate ticks instead of queueing them.
+"""
+from collections import deque
+import csv
+from datetime import datetime
+import json
+import os
+import random
+import threading
+import time
+from prometheus_client import Counter, Gauge
+from pymongo.errors import CollectionInvalid, PyMongoError
+from app_logging import get_logger
+from capped_tail import SeenIds, tail_capped
+
+logger = get_logger('forex_prices')
+
+COLLECTION = 'forex_ticks'
+CAPPED_SIZE_BYTES = 8 * 1024 * 1024
+CAPPED_MAX_DOCS = 50000
+BUFFER_SIZE = int(os.getenv('FOREX_PRICE_BUFFER', '1000'))
+# Prices older than this are not used to open or close investments
+MAX_PRICE_AGE = float(os.getenv('FOREX_PRICE_MAX_AGE', '300'))
+STREAM_HEARTBEAT = 15
+
+BASE_PRICES = {
+    'EUR/USD': 1.0921,
+    'GBP/USD': 1.2650,
+    'USD/JPY': 148.35,
+    'USD/CHF': 0.8650,
+    'AUD/USD': 0.6580,
+    'EUR/GBP': 0.8635,
+    'EUR/AUD': 1.6580,
+    'USD/CAD': 1.3450,
+    'NZD/USD': 0.6120
+}
+
+TICKS_APPLIED = Counter(
+    'forex_ticks_applied_total', 'Forex ticks applied to the in-process price book'
+)
+STREAM_CLIENTS = Gauge(
+    'forex_stream_clients', 'Connected forex price stream clients',
+    multiprocess_mode='livesum'
+)
+
+
+class SimulatedPriceSource:
+    """Geometric random walk around BASE_PRICES, one tick per pair per interval"""
+
+    def __init__(self, interval=1.0, volatility=0.0002, seed=None):
+        self.interval = interval
+        self.volatility = volatility
+        self.rng = random.Random(seed)
+        self.prices = dict(BASE_PRICES)
+
+    def ticks(self):
+        while True:
+            now = datetime.utcnow()
+            for pair, price in self.prices.items():
+                price *= 1 + self.rng.gauss(0, self.volatility)
+                self.prices[pair] = price
+                yield {'pair': pair, 'price': round(price, 5), 'ts': now}
+            time.sleep(self.interval)
+
+
+class ReplayPriceSource:
+    """Replays recorded ticks from a JSON-lines or CSV file in real time"""
+
+    def __init__(self, path, speed=1.0, loop=True):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+
+    def _read(self):
+        with open(self.path, newline='') as f:
+            rows = csv.DictReader(f) if self.path.endswith('.csv') else (json.loads(line) for line in f if line.strip())
+            for row in rows:
+                yield row['pair'], float(row['price']), datetime.fromisoformat(row['ts'])
+
+    def ticks(self):
+        while True:
+            previous = None
+            for pair, price, recorded_at in self._read():
+                if previous is not None and recorded_at > previous:
+                    time.sleep((recorded_at - previous).total_seconds() / self.speed)
+                previous = recorded_at
+                yield {'pair': pair, 'price': price, 'ts': datetime.utcnow()}
+            if not self.loop:
+                return
+
+
+def price_source_from_env():
+    spec = os.getenv('FOREX_PRICE_SOURCE', 'simulator')
+    if spec.startswith('replay:'):
+        return ReplayPriceSource(spec[len('replay:'):], speed=float(os.getenv('FOREX_REPLAY_SPEED', '1')))
+    if spec == 'simulator':
+        return SimulatedPriceSource(interval=float(os.getenv('FOREX_SIMULATOR_INTERVAL', '1')))
+    raise ValueError(f'Unknown FOREX_PRICE_SOURCE {spec!r}')
+
+
+def _ensure_collection(db):
+    try:
+        db.create_collection(COLLECTION, capped=True, size=CAPPED_SIZE_BYTES, max=CAPPED_MAX_DOCS)
+    except CollectionInvalid:
+        pass
+
+
+def run_price_producer(db, source, batch_interval=0.2):
+    """Append ticks from `source` to forex_ticks; runs until the source ends"""
+    _ensure_collection(db)
+    batch = []
+    flushed = time.monotonic()
+    for tick in source.ticks():
+        batch.append(tick)
+        if time.monotonic() - flushed >= batch_interval or len(batch) >= len(BASE_PRICES):
+            try:
+                db[COLLECTION].insert_many(batch, ordered=True)
+            except PyMongoError:
+                logger.exception('Failed to publish forex ticks', extra={'ticks': len(batch)})
+            batch = []
+            flushed = time.monotonic()
+    if batch:
+        db[COLLECTION].insert_many(batch, ordered=True)
+
+
+def start_price_producer(db):
+    thread = threading.Thread(
+        target=run_price_producer, args=(db, price_source_from_env()), name='forex-producer', daemon=True
+    )
+    thread.start()
+    return thread
+
+
+class PriceBook:
+    """Latest tick and a bounded tick history per pair, for this process"""
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.seq = 0
+        self._latest = {}
+        self._buffers = {}
+        self._changed = threading.Event()
+
+    def apply(self, pair, price, ts):
+        self.seq += 1
+        tick = {'pair': pair, 'price': price, 'ts': ts, 'seq': self.seq}
+        self._latest[pair] = tick
+        buffer = self._buffers.get(pair)
+        if buffer is None:
+            buffer = self._buffers[pair] = deque(maxlen=self.buffer_size)
+        buffer.append((ts, price))
+        TICKS_APPLIED.inc()
+        # Wake every waiting client at once, then arm a fresh event for the next tick
+        changed, self._changed = self._changed, threading.Event()
+        changed.set()
+
+    def latest(self, pair):
+        return self._latest.get(pair)
+
+    def snapshot(self):
+        return dict(self._latest)
+
+    def history(self, pair, limit=None):
+        buffer = self._buffers.get(pair, ())
+        ticks = list(buffer)
+        return ticks[-limit:] if limit else ticks
+
+    def changes_since(self, seq):
+        """Newest tick of every pair that changed after `seq`"""
+        return [tick for tick in self._latest.values() if tick['seq'] > seq]
+
+    def wait(self, seq, timeout):
+        """Block (cooperatively under gevent) until a tick newer than `seq` arrives"""
+        changed = self._changed
+        if self.seq > seq:
+            return True
+        return changed.wait(timeout)
+
+
+class PriceFeed:
+    """Tails forex_ticks into the process' PriceBook"""
+
+    def __init__(self, book):
+        self.book = book
+        self._pid = None
+        self._thread = None
+
+    def start(self, db):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        _ensure_collection(db)
+        self._thread = threading.Thread(target=self._tail, args=(db[COLLECTION],), name='forex-feed', daemon=True)
+        self._thread.start()
+
+    def _warm(self, collection):
+        """Fill the ring buffers from the most recent ticks already stored; returns their SeenIds"""
+        recent = list(collection.find({}, sort=[('$natural', -1)], limit=self.book.buffer_size * len(BASE_PRICES)))
+        seen = SeenIds()
+        for tick in reversed(recent):
+            self._apply(tick)
+            seen.add(tick['_id'], tick['ts'])
+        return seen
+
+    def _apply(self, tick):
+        self.book.apply(tick['pair'], tick['price'], tick['ts'])
+
+    def _tail(self, collection):
+        seen = None
+        try:
+            seen = self._warm(collection)
+        except PyMongoError:
+            logger.exception('Failed to load recent forex ticks')
+        tail_capped(collection, self._apply, seen=seen)
+
+
+price_book = PriceBook()
+price_feed = PriceFeed(price_book)
+
+
+def start_price_feed(db):
+    price_feed.start(db)
+
+
+def get_price(pair, max_age=MAX_PRICE_AGE):
+    """Latest price for `pair`, or None when there is no sufficiently recent tick"""
+    tick = price_book.latest(pair)
+    if tick is None or (datetime.utcnow() - tick['ts']).total_seconds() > max_age:
+        return None
+    return tick['price']
+
+
+def format_tick(tick):
+    return {'pair': tick['pair'], 'price': tick['price'], 'ts': tick['ts'].isoformat()}
+
+
+def stream_prices(book=price_book, heartbeat=STREAM_HEARTBEAT):
+    """SSE body: a snapshot of every pair, then coalesced changes as they arrive"""
+    STREAM_CLIENTS.inc()
+    try:
+        seq = book.seq
+        yield f'retry: 3000\nevent: snapshot\ndata: {json.dumps([format_tick(t) for t in book.snapshot().values()])}\n\n'
+        while True:
+            if not book.wait(seq, heartbeat):
+                yield ': keepalive\n\n'
+                continue
+            changes = book.changes_since(seq)
+            seq = book.seq
+            if changes:
+                yield f'event: ticks\ndata: {json.dumps([format_tick(t) for t in changes])}\n\n'
+    finally:
+        STREAM_CLIENTS.dec()
+
+
+if __name__ == '__main__':
+    # Standalone producer, e.g. for load tests or when the scheduler is not running
+    from dotenv import load_dotenv
+    from app_logging import configure_logging
+    from database import get_db
+    load_dotenv()
+    configure_logging()
+    run_price_producer(get_db(), price_source_from_env())
@@ -1,7 +1,38 @@
+import os
+import shutil
+import sys
+
 bind = "0.0.0.0:5000"
 workers = 4
 worker_class = "gevent"
 timeout = 120
 errorlog = '/var/log/secure-auth.log'
 accesslog = '/var/log/secure-auth.log'
-loglevel = 'debug'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+# Workers write Prometheus samples here so /metrics can aggregate all of them.
+# Must be set before prometheus_client is imported by the app.
+prometheus_multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/secure-auth-metrics')
+
+def on_starting(server):
+    # Samples from a previous run would otherwise be summed into the new one
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def post_worker_init(worker):
+    # Runs in the worker after gevent has patched it and the app is loaded:
+    # create this worker's own Mongo client and warm its pool before serving
+    from gunicorn.arbiter import Arbiter
+    from database import UniqueIndexError, init_process
+    from hub_monitor import start_hub_monitor
+    try:
+        init_process()
+    except UniqueIndexError:
+        # Respawning would fail the same way: stop the master instead
+        worker.log.exception('Worker failed to initialize')
+        sys.exit(Arbiter.WORKER_BOOT_ERROR)
+    start_hub_monitor()
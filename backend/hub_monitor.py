@@ -0,0 +1,110 @@
+"""Opt-in detector for code that blocks the gevent hub.
+
+Under the gevent worker a greenlet that does CPU work or blocking I/O without
+yielding (bcrypt, a large JSON encode, file-backed sessions, a slow log
+write) stalls every other request on that worker. With GEVENT_HUB_MONITOR=1,
+gevent's monitor thread checks every GEVENT_MAX_BLOCKING_TIME seconds
+(default 0.1) whether the hub has switched greenlets; when it has not, this
+module logs the blocked greenlet's stack and counts the block against the
+innermost application frame (file:line function), exported as
+gevent_hub_blocked_total{callsite}. A long block is seen by several checks
+in a row: each one is counted, so the counter approximates blocked time in
+units of the threshold, but the stack is logged once.
+
+gunicorn starts the monitor per worker from post_worker_init; it does nothing
+unless enabled, and nothing at all outside gevent.
+"""
+import os
+import sys
+import time
+import warnings
+from prometheus_client import Counter
+from app_logging import get_logger
+
+logger = get_logger('hub_monitor')
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+UNKNOWN_CALLSITE = '<unknown>'
+
+HUB_BLOCKED = Counter(
+    'gevent_hub_blocked_total', 'Monitor checks that found the gevent hub blocked for GEVENT_MAX_BLOCKING_TIME',
+    ['callsite']
+)
+
+
+def _is_app_frame(filename):
+    return filename.startswith(BACKEND_DIR) and 'site-packages' not in filename
+
+
+def blocking_callsite(frame):
+    """Innermost application frame of a stack as 'file:line function'"""
+    innermost = frame
+    while frame is not None:
+        if _is_app_frame(frame.f_code.co_filename):
+            filename = os.path.relpath(frame.f_code.co_filename, BACKEND_DIR)
+            return f'{filename}:{frame.f_lineno} {frame.f_code.co_name}'
+        frame = frame.f_back
+    if innermost is None:
+        return UNKNOWN_CALLSITE
+    return f'{os.path.basename(innermost.f_code.co_filename)}:{innermost.f_lineno} {innermost.f_code.co_name}'
+
+
+class HubBlockedHandler:
+    """zope.event subscriber for gevent's EventLoopBlocked"""
+
+    def __init__(self, hub_thread_ident):
+        self.hub_thread_ident = hub_thread_ident
+        self._last_greenlet = None
+        self._last_reported = 0.0
+
+    def __call__(self, event):
+        from gevent.events import EventLoopBlocked
+        if not isinstance(event, EventLoopBlocked):
+            return
+        # Runs on the monitor thread while the hub thread is (usually) still blocked
+        frame = sys._current_frames().get(self.hub_thread_ident)
+        callsite = blocking_callsite(frame)
+        HUB_BLOCKED.labels(callsite).inc()
+
+        now = time.monotonic()
+        continued = event.greenlet is self._last_greenlet and now - self._last_reported < 2 * event.blocking_time
+        self._last_greenlet = event.greenlet
+        self._last_reported = now
+        if continued:
+            return
+        logger.warning('gevent hub blocked', extra={
+            'callsite': callsite,
+            'threshold_seconds': event.blocking_time,
+            'greenlet': repr(event.greenlet),
+            'stack': '\n'.join(event.info)
+        })
+
+
+_handler = None
+
+
+def start_hub_monitor():
+    """Start gevent's monitor thread for this process when GEVENT_HUB_MONITOR=1"""
+    global _handler
+    if os.getenv('GEVENT_HUB_MONITOR') != '1':
+        return False
+    from gevent import config, get_hub, monkey
+    if not monkey.is_module_patched('socket'):
+        logger.warning('GEVENT_HUB_MONITOR is set but the process is not running under gevent')
+        return False
+
+    import gevent.events
+    config.monitor_thread = True
+    config.max_blocking_time = float(os.getenv('GEVENT_MAX_BLOCKING_TIME', '0.1'))
+    hub = get_hub()
+    if _handler is not None and _handler in gevent.events.subscribers:
+        gevent.events.subscribers.remove(_handler)
+    _handler = HubBlockedHandler(hub.thread_ident)
+    gevent.events.subscribers.append(_handler)
+
+    with warnings.catch_warnings():
+        # The memory monitor that comes with it needs psutil; blocking detection does not
+        warnings.simplefilter('ignore')
+        hub.start_periodic_monitoring_thread()
+    logger.info('gevent hub monitor started', extra={'max_blocking_time': config.max_blocking_time})
+    return True
@@ -0,0 +1,222 @@
+"""Mongo command instrumentation attributed to Flask routes.
+
+A pymongo CommandListener records every command issued by this worker along
+with its duration, keyed by the route (url rule) of the request that issued
+it. Commands issued outside a request (jobs, startup) are recorded under
+BACKGROUND_ROUTE, and so are commands issued inside a background_commands()
+block, such as the per-process Mongo startup that runs on a worker's first
+request when gunicorn has not already done it.
+
+Routes can declare how many commands they are expected to issue with the
+query_budget decorator. A request that goes over budget is logged and counted,
+and in test mode (app.testing or MONGO_QUERY_BUDGET_STRICT=1) it raises
+QueryBudgetExceeded so N+1 regressions fail the test that triggered them.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import hmac
+import os
+import threading
+from flask import g, has_request_context, jsonify, request
+from prometheus_client import Counter, Histogram
+from pymongo import monitoring
+from app_logging import get_logger
+
+logger = get_logger('instrumentation')
+
+BACKGROUND_ROUTE = '<background>'
+
+# Upper bounds, in milliseconds, of the command latency histogram buckets
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+# Cross-worker copies of the same numbers, served by /metrics
+MONGO_COMMANDS = Counter(
+    'mongo_commands_total', 'Mongo commands issued',
+    ['route', 'command', 'outcome']
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    'mongo_command_duration_seconds', 'Mongo command latency',
+    ['route'],
+    buckets=tuple(bound / 1000 for bound in LATENCY_BUCKETS_MS[:-1])
+)
+QUERY_BUDGET_EXCEEDED = Counter(
+    'mongo_query_budget_exceeded_total', 'Requests that issued more Mongo commands than their route budget',
+    ['route']
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in test mode when a route issues more commands than it declared"""
+
+
+class RouteCommandStats:
+    """Per-route command counts and latency histograms for this worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def _route(self, route):
+        stats = self._routes.get(route)
+        if stats is None:
+            stats = self._routes[route] = {
+                'commands': {},
+                'count': 0,
+                'failures': 0,
+                'total_ms': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS_MS),
+                'requests': 0,
+                'budget_exceeded': 0
+            }
+        return stats
+
+    def record_command(self, route, command_name, duration_ms, failed=False):
+        with self._lock:
+            stats = self._route(route)
+            stats['count'] += 1
+            stats['commands'][command_name] = stats['commands'].get(command_name, 0) + 1
+            stats['total_ms'] += duration_ms
+            if failed:
+                stats['failures'] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if duration_ms <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def record_request(self, route, over_budget=False):
+        with self._lock:
+            stats = self._route(route)
+            stats['requests'] += 1
+            if over_budget:
+                stats['budget_exceeded'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            routes = {}
+            for route, stats in self._routes.items():
+                cumulative = 0
+                histogram = []
+                for bound, count in zip(LATENCY_BUCKETS_MS, stats['buckets']):
+                    cumulative += count
+                    histogram.append({'le': '+Inf' if bound == float('inf') else bound, 'count': cumulative})
+                routes[route] = {
+                    'commands': dict(stats['commands']),
+                    'count': stats['count'],
+                    'failures': stats['failures'],
+                    'total_ms': round(stats['total_ms'], 3),
+                    'requests': stats['requests'],
+                    'commands_per_request': round(stats['count'] / stats['requests'], 2) if stats['requests'] else None,
+                    'budget_exceeded': stats['budget_exceeded'],
+                    'latency_ms': histogram
+                }
+            return routes
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+command_stats = RouteCommandStats()
+
+
+# Per thread (greenlet under gevent): inside a background_commands() block
+_background = threading.local()
+
+
+@contextmanager
+def background_commands():
+    """Record commands issued in the block as background work, outside any route budget"""
+    previous = getattr(_background, 'active', False)
+    _background.active = True
+    try:
+        yield
+    finally:
+        _background.active = previous
+
+
+def current_route():
+    """Url rule of the active request, or BACKGROUND_ROUTE outside a request"""
+    if has_request_context() and not getattr(_background, 'active', False):
+        return request.url_rule.rule if request.url_rule else request.path
+    return BACKGROUND_ROUTE
+
+
+class RouteCommandListener(monitoring.CommandListener):
+    """Attributes each Mongo command and its duration to the active route.
+
+    pymongo publishes succeeded/failed events on the thread (greenlet under
+    gevent) that issued the command, so the Flask request context is the one
+    of the request that triggered it.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def _record(self, event, failed):
+        route = current_route()
+        command_stats.record_command(route, event.command_name, event.duration_micros / 1000, failed)
+        MONGO_COMMANDS.labels(route, event.command_name, 'failed' if failed else 'succeeded').inc()
+        MONGO_COMMAND_LATENCY.labels(route).observe(event.duration_micros / 1e6)
+        # getMore continues a query already counted, so it does not use budget
+        if route != BACKGROUND_ROUTE and event.command_name != 'getMore':
+            g.mongo_commands = g.get('mongo_commands', 0) + 1
+
+
+def query_budget(max_commands):
+    """Declare the maximum number of Mongo commands a route may issue per request"""
+    def decorator(f):
+        f.query_budget = max_commands
+        return f
+    return decorator
+
+
+def _strict_budgets(app):
+    return app.testing or os.getenv('MONGO_QUERY_BUDGET_STRICT') == '1'
+
+
+def internal_only(f):
+    """Restrict an endpoint to loopback callers or holders of METRICS_TOKEN"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = os.getenv('METRICS_TOKEN')
+        if token:
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not hmac.compare_digest(supplied, token):
+                return jsonify({'error': 'Not found'}), 404
+        elif request.remote_addr not in ('127.0.0.1', '::1'):
+            return jsonify({'error': 'Not found'}), 404
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def init_instrumentation(app):
+    """Enforce declared query budgets and expose per-route command metrics"""
+
+    @app.after_request
+    def check_query_budget(response):
+        if request.url_rule is None:
+            return response
+        view = app.view_functions.get(request.endpoint)
+        # login_required and friends use functools.wraps, so the budget set on
+        # the inner function is visible on the registered view
+        budget = getattr(view, 'query_budget', None)
+        used = g.get('mongo_commands', 0)
+        over_budget = budget is not None and used > budget
+        command_stats.record_request(request.url_rule.rule, over_budget)
+        if over_budget:
+            QUERY_BUDGET_EXCEEDED.labels(request.url_rule.rule).inc()
+            if _strict_budgets(app):
+                raise QueryBudgetExceeded(f"{request.url_rule.rule} issued {used} Mongo commands, budget is {budget}")
+            logger.warning('Query budget exceeded', extra={'used': used, 'budget': budget})
+        return response
+
+    @app.route('/internal/metrics/mongo', methods=['GET'])
+    @internal_only
+    def mongo_command_metrics():
+        return jsonify({'routes': command_stats.snapshot()})
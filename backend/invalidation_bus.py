@@ -0,0 +1,127 @@
+"""Cross-worker cache invalidation over a capped collection.
+
+Every gunicorn worker (on every node) keeps its own in-process caches, so an
+eviction in one worker has to reach all the others. Writers call publish(),
+which evicts locally right away and appends an event to the capped
+`cache_invalidations` collection. Each worker tails that collection with a
+tailable, await-data cursor from a background thread (see capped_tail) and
+applies events published by other processes as they arrive.
+
+Events carry a namespace (one per cache, e.g. 'user') and an optional key;
+a key of None clears the whole namespace. Fan-out lag (publish to apply) is
+exported as the cache_invalidation_lag_seconds histogram.
+"""
+from datetime import datetime
+import os
+import socket
+import threading
+from prometheus_client import Counter, Histogram
+from pymongo.errors import CollectionInvalid, PyMongoError
+from app_logging import get_logger
+from capped_tail import tail_capped
+
+logger = get_logger('invalidation_bus')
+
+COLLECTION = 'cache_invalidations'
+CAPPED_SIZE_BYTES = 16 * 1024 * 1024
+CAPPED_MAX_DOCS = 100000
+
+INVALIDATIONS_PUBLISHED = Counter(
+    'cache_invalidations_published_total', 'Cache invalidation events published',
+    ['namespace']
+)
+INVALIDATIONS_APPLIED = Counter(
+    'cache_invalidations_applied_total', 'Cache invalidation events applied from other processes',
+    ['namespace']
+)
+INVALIDATION_LAG = Histogram(
+    'cache_invalidation_lag_seconds', 'Delay between publishing an invalidation and applying it in another worker',
+    ['namespace'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+
+class InvalidationBus:
+    def __init__(self):
+        self.origin = f'{socket.gethostname()}:{os.getpid()}'
+        self._handlers = {}
+        self._db = None
+        self._pid = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def register(self, namespace, handler):
+        """Call handler(key) when an invalidation for namespace arrives"""
+        self._handlers.setdefault(namespace, []).append(handler)
+
+    def _apply(self, namespace, key):
+        for handler in self._handlers.get(namespace, ()):
+            try:
+                handler(key)
+            except Exception:
+                logger.exception('Invalidation handler failed', extra={'namespace': namespace})
+
+    def publish(self, namespace, key=None):
+        """Evict locally, then broadcast to every other worker"""
+        self._apply(namespace, key)
+        if self._db is None:
+            return
+        INVALIDATIONS_PUBLISHED.labels(namespace).inc()
+        try:
+            self._db[COLLECTION].insert_one({
+                'ns': namespace,
+                'key': None if key is None else str(key),
+                'origin': self.origin,
+                'ts': datetime.utcnow()
+            })
+        except PyMongoError:
+            # Other workers fall back to their cache TTLs
+            logger.exception('Failed to publish invalidation', extra={'namespace': namespace})
+
+    def start(self, db):
+        """Create the capped collection if needed and start tailing it"""
+        if self._thread is not None and self._thread.is_alive() and os.getpid() == self._pid:
+            return
+        self._db = db
+        self._pid = os.getpid()
+        # A process forked from a publisher must not skip its parent's events
+        self.origin = f'{socket.gethostname()}:{self._pid}'
+        try:
+            db.create_collection(COLLECTION, capped=True, size=CAPPED_SIZE_BYTES, max=CAPPED_MAX_DOCS)
+        except CollectionInvalid:
+            pass
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._tail, name='invalidation-bus', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _tail(self):
+        # Only events published after startup matter; caches start empty
+        tail_capped(self._db[COLLECTION], self._receive, self._stopped)
+
+    def _receive(self, event):
+        if event.get('origin') == self.origin:
+            return
+        namespace = event.get('ns')
+        self._apply(namespace, event.get('key'))
+        INVALIDATIONS_APPLIED.labels(namespace).inc()
+        INVALIDATION_LAG.labels(namespace).observe(
+            max((datetime.utcnow() - event['ts']).total_seconds(), 0)
+        )
+
+
+bus = InvalidationBus()
+
+
+def publish_invalidation(namespace, key=None):
+    bus.publish(namespace, key)
+
+
+def register_invalidation_handler(namespace, handler):
+    bus.register(namespace, handler)
+
+
+def start_invalidation_bus(db):
+    bus.start(db)
@@ -0,0 +1,139 @@
+"""Investment accrual history in a MongoDB time-series collection.
+
+`investment_history` gets one entry per active investment per business day.
+It is a time-series collection with `createdAt` as the time field and
+`meta: {userId, investmentId}` as the meta field, so entries of the same
+investment are stored together in compressed buckets and a user's history
+over a date range is a scan of that user's buckets, not a filter on a
+string date.
+
+Entries are written as:
+
+    {'createdAt': datetime, 'meta': {'userId': ObjectId, 'investmentId': ObjectId},
+     'type': 'roi_earning', 'amount': float, 'balance': float}
+
+The calendar day is derived from createdAt when the history is read.
+Databases created before this layout keep a regular collection until
+migrate_investment_history.py has converted it. The migration renames it to
+investment_history_legacy and copies it across while the app runs. A process
+that starts before the copy has completed reads through find_user_history(),
+which matches both layouts (top-level userId, as an ObjectId or a string,
+and meta.userId) in both collections and drops entries seen twice, so no
+history disappears before, during or after the rename. It switches to
+meta-only queries of the time-series collection on its next start.
+"""
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo.errors import CollectionInvalid
+from app_logging import get_logger
+
+logger = get_logger('investment_history')
+
+COLLECTION = 'investment_history'
+LEGACY_COLLECTION = COLLECTION + '_legacy'
+MIGRATION_ID = 'investment_history_timeseries'
+TIMESERIES_OPTIONS = {'timeField': 'createdAt', 'metaField': 'meta', 'granularity': 'hours'}
+INSERT_BATCH_SIZE = 1000
+
+# Set at startup while legacy entries may still be outside the time-series collection
+_legacy_layout = False
+
+
+def history_entry(user_id, investment_id, entry_type, amount, created_at, balance):
+    return {
+        'createdAt': created_at,
+        'meta': {'userId': user_id, 'investmentId': investment_id},
+        'type': entry_type,
+        'amount': amount,
+        'balance': balance
+    }
+
+
+def is_timeseries(db, name=COLLECTION):
+    info = next(iter(db.list_collections(filter={'name': name})), None)
+    return info is not None and info.get('type') == 'timeseries'
+
+
+def create_history_collection(db, name=COLLECTION):
+    """Create the time-series collection and its per-user index; False if `name` exists"""
+    try:
+        db.create_collection(name, timeseries=TIMESERIES_OPTIONS)
+    except CollectionInvalid:
+        return False
+    db[name].create_index([('meta.userId', 1), ('createdAt', -1)])
+    return True
+
+
+def migration_completed(db):
+    return bool((db.migrations.find_one({'_id': MIGRATION_ID}) or {}).get('completedAt'))
+
+
+def ensure_investment_history_collection(db):
+    global _legacy_layout
+    regular = not (create_history_collection(db) or is_timeseries(db))
+    _legacy_layout = regular or (LEGACY_COLLECTION in db.list_collection_names() and not migration_completed(db))
+    if _legacy_layout:
+        logger.warning('investment_history has not been fully migrated; reading legacy rows until '
+                       'migrate_investment_history.py has completed')
+
+
+def user_history_filter(user_id):
+    """Query for one user's entries, matching legacy rows until the migration has run"""
+    user_oid = ObjectId(user_id)
+    if not _legacy_layout:
+        return {'meta.userId': user_oid}
+    return {'$or': [{'meta.userId': user_oid}, {'userId': {'$in': [user_oid, str(user_oid)]}}]}
+
+
+def entry_time(entry):
+    """Creation time of an entry in either layout"""
+    created_at = entry.get('createdAt')
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    if not isinstance(created_at, datetime):
+        # Fall back to the day recorded on the row, then to the _id's timestamp
+        created_at = datetime.fromisoformat(entry['date']) if entry.get('date') else entry['_id'].generation_time
+    return created_at.replace(tzinfo=None)
+
+
+def find_user_history(db, user_id, query=None, projection=None):
+    """One user's entries matching `query`, unordered.
+
+    Until the migration has completed this also reads the legacy collection;
+    entries already copied are in both and are returned once.
+    """
+    query = dict(user_history_filter(user_id), **(query or {}))
+    entries = list(db[COLLECTION].find(query, projection))
+    if _legacy_layout:
+        seen = {entry['_id'] for entry in entries}
+        entries.extend(entry for entry in db[LEGACY_COLLECTION].find(query, projection) if entry['_id'] not in seen)
+    return entries
+
+
+def latest_user_entry_time(db, user_id):
+    """Creation time of the user's newest entry, or None"""
+    collections = (COLLECTION, LEGACY_COLLECTION) if _legacy_layout else (COLLECTION,)
+    latest = [
+        db[name].find_one(user_history_filter(user_id), {'createdAt': 1, 'date': 1}, sort=[('createdAt', -1)])
+        for name in collections
+    ]
+    return max((entry_time(entry) for entry in latest if entry), default=None)
+
+
+def insert_history_entries(db, entries):
+    """Insert entries in batches; time-series collections take large batches best"""
+    for start in range(0, len(entries), INSERT_BATCH_SIZE):
+        db[COLLECTION].insert_many(entries[start:start + INSERT_BATCH_SIZE], ordered=False)
+
+
+def format_history_entry(entry):
+    """History entry as returned by GET /api/investments/history"""
+    investment_id = entry['meta']['investmentId'] if 'meta' in entry else entry.get('investmentId')
+    created_at = entry.get('createdAt')
+    return {
+        'investmentId': str(investment_id),
+        'type': entry.get('type'),
+        'date': created_at.date().isoformat() if isinstance(created_at, datetime) else entry.get('date'),
+        'amount': float(entry.get('amount', 0)),
+        'balance': float(entry.get('balance', 0))
+    }
@@ -0,0 +1,247 @@
+"""Investment terms, closing and the nightly maturity sweep.
+
+Every investment is opened for a term of whole days (INVESTMENT_TERM_DAYS by
+default, at most INVESTMENT_MAX_TERM_DAYS) and carries its maturity date in
+`maturesAt`. Investments opened before terms existed have no `maturesAt` and
+stay open until their owner closes them.
+
+Closing is a conditional update: the investment only changes if it is still
+active, and the same update records the close price, so two concurrent closes
+(or a close racing the sweep) can never both pay out. The balance credit runs
+in the same transaction as the close. Transactions need a replica set or
+mongos; on a standalone server the writes run without one. A close credits
+only the principal: the ROI job adds each day's profit to the balance as it
+accrues.
+
+The sweep walks the (status, maturesAt) index for positions that are due,
+claims them in batches of MATURITY_SWEEP_BATCH with one update_many each and
+credits the owners with one bulk write per batch. Claimed rows are tagged
+with the sweep's id so only positions this sweep actually closed are paid.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+import os
+import time
+from bson.objectid import ObjectId
+from prometheus_client import Counter, Histogram
+from pymongo import ReturnDocument, UpdateOne
+from app_logging import get_logger
+from database import db, run_transaction
+from forex_prices import get_price, price_book
+from user_cache import invalidate_all_users
+from user_events import publish_user_events
+from portfolio import invalidate_portfolio_series
+
+logger = get_logger('investment_lifecycle')
+
+DEFAULT_TERM_DAYS = int(os.getenv('INVESTMENT_TERM_DAYS', '30'))
+MAX_TERM_DAYS = int(os.getenv('INVESTMENT_MAX_TERM_DAYS', '365'))
+SWEEP_BATCH_SIZE = int(os.getenv('MATURITY_SWEEP_BATCH', '1000'))
+
+SWEEP_DURATION = Histogram(
+    'maturity_sweep_duration_seconds', 'Time to close all matured investments',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+INVESTMENTS_CLOSED = Counter(
+    'investments_closed_total', 'Investments closed',
+    ['reason']
+)
+
+
+def parse_term_days(value):
+    """Term in days from request data; ValueError when out of range"""
+    term_days = DEFAULT_TERM_DAYS if value in (None, '') else int(value)
+    if not 1 <= term_days <= MAX_TERM_DAYS:
+        raise ValueError(f'Term must be between 1 and {MAX_TERM_DAYS} days')
+    return term_days
+
+
+def maturity_date(opened_at, term_days):
+    return opened_at + timedelta(days=term_days)
+
+
+def live_prices():
+    """Fresh price of every pair in this process' price book"""
+    prices = {}
+    for pair in price_book.snapshot():
+        price = get_price(pair)
+        if price is not None:
+            prices[pair] = price
+    return prices
+
+
+def close_price_expression(prices):
+    """Aggregation expression for a row's close price: live price, else its last mark"""
+    if not prices:
+        return '$currentPrice'
+    return {'$switch': {
+        'branches': [{'case': {'$eq': ['$forexPair', pair]}, 'then': price} for pair, price in prices.items()],
+        'default': '$currentPrice'
+    }}
+
+
+def close_update(prices, closed_at, reason, sweep_id=None):
+    """Pipeline update that closes an investment at the current price"""
+    close_price = close_price_expression(prices)
+    fields = {
+        'status': 'closed',
+        'closePrice': close_price,
+        'currentPrice': close_price,
+        'closedAt': closed_at,
+        'closeReason': reason
+    }
+    if sweep_id is not None:
+        fields['sweepId'] = sweep_id
+    return [{'$set': fields}, {'$unset': 'unrealizedPnl'}]
+
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def format_investment(inv, user_id):
+    """Investment document as returned by GET /api/investments"""
+    entry_price = inv.get('entryPrice', 0)
+    created_at = inv.get('createdAt', datetime.utcnow())
+    return {
+        'id': str(inv['_id']),
+        'userId': user_id,
+        'forexPair': inv.get('forexPair', ''),
+        'amount': float(inv.get('amount', 0)),
+        'dailyROI': float(inv.get('dailyROI', 0)),
+        'entryPrice': float(entry_price),
+        'currentPrice': float(inv.get('currentPrice', entry_price)),
+        'status': inv.get('status', 'active'),
+        'profit': float(inv.get('profit', 0)),
+        'unrealizedPnl': float(inv.get('unrealizedPnl', 0)),
+        'termDays': inv.get('termDays'),
+        'maturesAt': _isoformat(inv.get('maturesAt')),
+        'closedAt': _isoformat(inv.get('closedAt')),
+        'createdAt': created_at.isoformat() if isinstance(created_at, datetime) else str(created_at)
+    }
+
+
+def payout(investment):
+    """Principal returned on close; the ROI job already credited the profit day by day"""
+    return float(investment.get('amount', 0))
+
+
+def close_investment(db, investment_id, user_id, prices=None):
+    """Close one of the user's active investments and return its principal.
+
+    Returns (investment, balance) after the close, or None when the
+    investment does not exist, belongs to someone else or is not active.
+    """
+    prices = live_prices() if prices is None else prices
+    closed_at = datetime.utcnow()
+
+    def close(session):
+        investment = db.investments.find_one_and_update(
+            {'_id': ObjectId(investment_id), 'userId': ObjectId(user_id), 'status': 'active'},
+            close_update(prices, closed_at, 'manual'),
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if investment is None:
+            return None
+        user = db.users.find_one_and_update(
+            {'_id': investment['userId']},
+            {'$inc': {'balance': payout(investment)}},
+            projection={'balance': 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        return investment, user.get('balance', 0) if user else None
+
+    result = run_transaction(close)
+    if result is not None:
+        INVESTMENTS_CLOSED.labels('manual').inc()
+    return result
+
+
+def _due_batches(db, now, batch_size):
+    """_ids of matured active investments, batch by batch, off the maturity index"""
+    cursor = db.investments.find(
+        {'status': 'active', 'maturesAt': {'$lte': now}},
+        {'_id': 1},
+        batch_size=batch_size
+    )
+    batch = []
+    for inv in cursor:
+        batch.append(inv['_id'])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _close_batch(db, ids, prices, now, sweep_id):
+    """Close the still-active investments among `ids`; returns (closed investments, {userId: payout})"""
+    def close(session):
+        claimed = db.investments.update_many(
+            {'_id': {'$in': ids}, 'status': 'active'},
+            close_update(prices, now, 'matured', sweep_id),
+            session=session
+        )
+        if not claimed.modified_count:
+            return [], {}
+        closed = list(db.investments.find({'_id': {'$in': ids}, 'sweepId': sweep_id}, session=session))
+        credits = defaultdict(float)
+        for inv in closed:
+            credits[inv['userId']] += payout(inv)
+        db.users.bulk_write([
+            UpdateOne({'_id': user_id}, {'$inc': {'balance': total}})
+            for user_id, total in credits.items()
+        ], ordered=False, session=session)
+        return closed, credits
+
+    return run_transaction(close)
+
+
+def sweep_matured_investments(db, now=None, batch_size=SWEEP_BATCH_SIZE):
+    """Close every active investment whose maturity date has passed"""
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+    prices = live_prices()
+    sweep_id = ObjectId()
+    closed = 0
+    credited = defaultdict(float)
+
+    # Materialize the ids first so the sweep's own writes do not move rows under the cursor
+    for ids in list(_due_batches(db, now, batch_size)):
+        batch_closed, credits = _close_batch(db, ids, prices, now, sweep_id)
+        closed += len(batch_closed)
+        for user_id, total in credits.items():
+            credited[user_id] += total
+        publish_user_events(db, (
+            (inv['userId'], 'investment', {'action': 'matured', 'investment': format_investment(inv, str(inv['userId']))})
+            for inv in batch_closed
+        ))
+
+    if credited:
+        # One broadcast each instead of a bus message per credited user
+        invalidate_all_users()
+        invalidate_portfolio_series()
+    publish_user_events(db, (
+        (user_id, 'balance', {'delta': total, 'reason': 'maturity'})
+        for user_id, total in credited.items()
+    ))
+
+    elapsed = time.perf_counter() - started
+    SWEEP_DURATION.observe(elapsed)
+    INVESTMENTS_CLOSED.labels('matured').inc(closed)
+    logger.info('Maturity sweep completed', extra={
+        'closed': closed,
+        'users_credited': len(credited),
+        'seconds': round(elapsed, 3)
+    })
+    return closed
+
+
+def run_maturity_sweep():
+    """Scheduler entry point"""
+    try:
+        sweep_matured_investments(db)
+    except Exception:
+        logger.exception('Maturity sweep failed')
@@ -0,0 +1,285 @@
+"""Nightly ROI accrual and referral commission jobs.
+
+Importable without building the Flask app, so the scheduler process starts
+without loading routes, sessions or CORS.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+import os
+from pymongo import ReturnDocument, UpdateOne
+from app_logging import get_logger
+from commission_config import get_rates_at
+from database import db, run_transaction
+from investment_history import history_entry, insert_history_entries
+from leaderboard import record_leaderboard_earnings
+from referral_earnings import record_referral_earnings
+from user_cache import invalidate_all_users
+from user_events import publish_user_events
+
+logger = get_logger('jobs')
+
+ROI_BATCH_SIZE = int(os.getenv('ROI_BATCH_SIZE', '500'))
+
+def calculate_daily_referral_commissions():
+    """Calculate and distribute daily commissions based on referred users' investment earnings"""
+    try:
+        # Get yesterday's date (UTC)
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        yesterday_start = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
+        yesterday_end = yesterday_start + timedelta(days=1)
+        
+        # Rates in effect on the day being paid out
+        commission_rates = get_rates_at(db, yesterday_start)
+        if not commission_rates:
+            logger.warning('No commission rates found')
+            return
+            
+        daily_rates = commission_rates['daily_commission']
+        rate_version = commission_rates['version']
+        
+        # Track processed commissions to avoid duplicates
+        processed_commissions = set()
+        # Per-referrer totals, pushed to connected clients once at the end
+        referrer_totals = defaultdict(float)
+        # (referrer, referred, type) deltas for referral_earnings_summary
+        summary_totals = defaultdict(float)
+        
+        # Get all active investments from yesterday
+        active_investments = db.investments.find({
+            'status': 'active',
+            'createdAt': {'$lt': yesterday_end}
+        })
+        
+        for investment in active_investments:
+            user_id = investment['userId']
+            amount = investment['amount']
+            daily_roi = float(investment.get('dailyROI', 0))
+            daily_roi_earnings = amount * (daily_roi / 100)
+            
+            # Get user's referral chain
+            user = db.users.find_one({'_id': user_id})
+            if not user or not user.get('referredBy'):
+                continue
+                
+            # Process Level 1 (direct referrer)
+            level1_referrer_id = user['referredBy']
+            commission_key = f"{str(level1_referrer_id)}_{str(user_id)}_{yesterday.date()}"
+            
+            if commission_key not in processed_commissions:
+                level1_commission = daily_roi_earnings * daily_rates['level1']
+                
+                # Record commission with historical rate
+                db.referral_history.insert_one({
+                    'referrerId': level1_referrer_id,
+                    'referredId': user_id,
+                    'level': 1,
+                    'type': 'daily_commission',
+                    'amount': level1_commission,
+                    'rate': daily_rates['level1'],
+                    'rateVersion': rate_version,
+                    'baseAmount': daily_roi_earnings,
+                    'date': yesterday_start,
+                    'createdAt': datetime.utcnow()
+                })
+                
+                # Update user's earnings
+                db.users.update_one(
+                    {'_id': level1_referrer_id},
+                    {'$inc': {'referralEarnings': level1_commission}}
+                )
+                
+                processed_commissions.add(commission_key)
+                summary_totals[(level1_referrer_id, user_id, 'daily_commission')] += level1_commission
+                referrer_totals[level1_referrer_id] += level1_commission
+                
+                # Process Level 2
+                level1_user = db.users.find_one({'_id': level1_referrer_id})
+                if level1_user and level1_user.get('referredBy'):
+                    level2_referrer_id = level1_user['referredBy']
+                    level2_commission_key = f"{str(level2_referrer_id)}_{str(user_id)}_{yesterday.date()}"
+                    
+                    if level2_commission_key not in processed_commissions:
+                        level2_commission = daily_roi_earnings * daily_rates['level2']
+                        
+                        db.referral_history.insert_one({
+                            'referrerId': level2_referrer_id,
+                            'referredId': user_id,
+                            'level': 2,
+                            'type': 'daily_commission',
+                            'amount': level2_commission,
+                            'rate': daily_rates['level2'],
+                            'rateVersion': rate_version,
+                            'baseAmount': daily_roi_earnings,
+                            'date': yesterday_start,
+                            'createdAt': datetime.utcnow()
+                        })
+                        
+                        db.users.update_one(
+                            {'_id': level2_referrer_id},
+                            {'$inc': {'referralEarnings': level2_commission}}
+                        )
+                        
+                        processed_commissions.add(level2_commission_key)
+                        summary_totals[(level2_referrer_id, user_id, 'daily_commission')] += level2_commission
+                        referrer_totals[level2_referrer_id] += level2_commission
+                        
+                        # Process Level 3
+                        level2_user = db.users.find_one({'_id': level2_referrer_id})
+                        if level2_user and level2_user.get('referredBy'):
+                            level3_referrer_id = level2_user['referredBy']
+                            level3_commission_key = f"{str(level3_referrer_id)}_{str(user_id)}_{yesterday.date()}"
+                            
+                            if level3_commission_key not in processed_commissions:
+                                level3_commission = daily_roi_earnings * daily_rates['level3']
+                                
+                                db.referral_history.insert_one({
+                                    'referrerId': level3_referrer_id,
+                                    'referredId': user_id,
+                                    'level': 3,
+                                    'type': 'daily_commission',
+                                    'amount': level3_commission,
+                                    'rate': daily_rates['level3'],
+                                    'rateVersion': rate_version,
+                                    'baseAmount': daily_roi_earnings,
+                                    'date': yesterday_start,
+                                    'createdAt': datetime.utcnow()
+                                })
+                                
+                                db.users.update_one(
+                                    {'_id': level3_referrer_id},
+                                    {'$inc': {'referralEarnings': level3_commission}}
+                                )
+                                
+                                processed_commissions.add(level3_commission_key)
+                                summary_totals[(level3_referrer_id, user_id, 'daily_commission')] += level3_commission
+                                referrer_totals[level3_referrer_id] += level3_commission
+        
+        record_referral_earnings(db, summary_totals)
+        record_leaderboard_earnings(db, referrer_totals, yesterday_start)
+        
+        publish_user_events(db, (
+            (referrer_id, 'referral_reward', {
+                'type': 'daily_commission',
+                'date': yesterday_start.date().isoformat(),
+                'amount': total
+            })
+            for referrer_id, total in referrer_totals.items()
+        ))
+        
+        logger.info('Daily commission calculation completed', extra={'date': str(yesterday.date())})
+        
+    except Exception as e:
+        logger.exception('Error calculating daily commissions')
+        raise e
+
+def _accrue_roi_batch(investments, current_time):
+    """Credit one day of ROI to a batch of investments; returns {userId: amount credited}.
+
+    Each investment is claimed for the day with a conditional update stamping
+    roiDate, so a run that is re-started after a crash skips investments it
+    already paid. The claims, the balance credits and the earnings_daily
+    rollup are written in one transaction where the server supports them.
+    The history entries follow right after: time-series collections cannot
+    be written in a transaction.
+    """
+    day = current_time.date().isoformat()
+
+    def accrue(session):
+        totals = defaultdict(float)
+        entries = []
+        for investment in investments:
+            try:
+                user_id = investment['userId']
+                daily_earnings = float(investment.get('amount', 0)) * (float(investment.get('dailyROI', 0)) / 100)
+                updated = db.investments.find_one_and_update(
+                    {'_id': investment['_id'], 'status': 'active', 'roiDate': {'$ne': day}},
+                    {
+                        '$inc': {'profit': daily_earnings},
+                        '$set': {'lastProfitUpdate': current_time, 'roiDate': day}
+                    },
+                    projection={'profit': 1},
+                    return_document=ReturnDocument.AFTER,
+                    session=session
+                )
+                if updated is None:
+                    # Closed since it was read, or already paid today
+                    continue
+                entries.append(history_entry(
+                    user_id, investment['_id'], 'roi_earning', daily_earnings, current_time, float(updated['profit'])
+                ))
+                totals[user_id] += daily_earnings
+            except Exception as inv_error:
+                logger.exception('Error processing investment', extra={'investment_id': str(investment.get('_id'))})
+        if totals:
+            db.users.bulk_write([
+                UpdateOne({'_id': user_id}, {'$inc': {'balance': total}})
+                for user_id, total in totals.items()
+            ], ordered=False, session=session)
+            # Daily earnings rollup used by /api/investments/earnings
+            db.earnings_daily.bulk_write([
+                UpdateOne(
+                    {'userId': user_id, 'date': day},
+                    {'$inc': {'amount': total}, '$set': {'updatedAt': current_time}},
+                    upsert=True
+                )
+                for user_id, total in totals.items()
+            ], ordered=False, session=session)
+        return totals, entries
+
+    totals, entries = run_transaction(accrue)
+    insert_history_entries(db, entries)
+    return totals
+
+def calculate_daily_roi_earnings():
+    """Calculate and distribute daily ROI earnings for all active investments (weekdays only)"""
+    try:
+        current_time = datetime.utcnow()
+        
+        # Check if it's a weekend (5 = Saturday, 6 = Sunday)
+        if current_time.weekday() in [5, 6]:
+            logger.info('Skipping ROI calculation on a weekend', extra={'date': str(current_time.date())})
+            return
+            
+        # Active investments not yet paid today, in batches of ROI_BATCH_SIZE
+        cursor = db.investments.find(
+            {'status': 'active', 'roiDate': {'$ne': current_time.date().isoformat()}},
+            {'userId': 1, 'amount': 1, 'dailyROI': 1},
+            batch_size=ROI_BATCH_SIZE
+        )
+        logger.info('Starting daily ROI calculation', extra={'date': str(current_time.date())})
+        
+        # Per-user earnings, pushed to connected clients once at the end
+        daily_totals = defaultdict(float)
+        investments = 0
+        batch = []
+        for investment in cursor:
+            batch.append(investment)
+            if len(batch) >= ROI_BATCH_SIZE:
+                for user_id, total in _accrue_roi_batch(batch, current_time).items():
+                    daily_totals[user_id] += total
+                investments += len(batch)
+                batch = []
+        if batch:
+            for user_id, total in _accrue_roi_batch(batch, current_time).items():
+                daily_totals[user_id] += total
+            investments += len(batch)
+        
+        # Balances changed for everyone with an active investment
+        invalidate_all_users()
+        
+        # Connected clients learn about their new balance without polling
+        publish_user_events(db, (
+            (user_id, 'balance', {'delta': total, 'reason': 'roi'})
+            for user_id, total in daily_totals.items()
+        ))
+        
+        logger.info('Daily ROI calculation completed', extra={
+            'date': str(current_time.date()),
+            'investments': investments,
+            'users_credited': len(daily_totals)
+        })
+        return True
+        
+    except Exception as e:
+        logger.exception('Error calculating daily ROI')
+        return False
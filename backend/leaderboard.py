@@ -0,0 +1,303 @@
+"""Top referrers by referral earnings and downline size.
+
+`referral_leaderboard` holds one row per referrer per window period:
+
+    {'window': 'daily' | 'weekly' | 'all', 'period': '2024-05-17' | '2024-W20' | 'all',
+     'referrerId': ObjectId, 'earnings': float, 'downline': int}
+
+Rows are kept up to date incrementally: the reward and commission writers
+$inc earnings into the current period of every window, and
+sync_leaderboard_downline(), run every minute by the scheduler, folds users
+registered since its last run into their referrer's downline counts (direct
+referrals). Registration itself stays a single write. The sync resumes from
+the newest createdAt it has counted, re-reading DOWNLINE_SYNC_WINDOW before
+it and skipping the ids it counted there: createdAt is stamped by whichever
+worker registered the user, so neither it nor the ObjectId is strictly
+ordered by insertion across workers. Daily and weekly rows expire through a
+TTL index once their period is well over.
+
+Indexes on (window, period, earnings) and (window, period, downline) make
+the top K of a period an index scan of K rows. Each worker also caches the
+top LEADERBOARD_SIZE rows per window and ordering for
+LEADERBOARD_CACHE_SECONDS, so a leaderboard read is O(K) and usually served
+from memory.
+
+rebuild_leaderboard() (`python leaderboard.py rebuild`) recomputes the
+current periods from the earnings summary, the referral ledger and users.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from app_logging import get_logger
+from database import db
+from referral_earnings import COLLECTION as SUMMARY_COLLECTION
+
+logger = get_logger('leaderboard')
+
+COLLECTION = 'referral_leaderboard'
+WINDOWS = ('daily', 'weekly', 'all')
+ORDERINGS = ('earnings', 'downline')
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '100'))
+CACHE_SECONDS = float(os.getenv('LEADERBOARD_CACHE_SECONDS', '30'))
+DOWNLINE_SYNC_INTERVAL = int(os.getenv('LEADERBOARD_SYNC_INTERVAL', '60'))
+# Registrations stamped up to this long before the newest one counted can
+# still be inserted after it; each sync re-reads them
+DOWNLINE_SYNC_WINDOW = timedelta(seconds=int(os.getenv('LEADERBOARD_SYNC_WINDOW', '60')))
+DOWNLINE_COUNTER_ID = 'leaderboard_downline'
+# How long a period's rows are kept after the period starts
+RETENTION = {'daily': timedelta(days=8), 'weekly': timedelta(weeks=5)}
+
+
+def period_key(window, at):
+    if window == 'daily':
+        return at.date().isoformat()
+    if window == 'weekly':
+        year, week, _ = at.isocalendar()
+        return f'{year}-W{week:02d}'
+    return 'all'
+
+
+def period_start(window, at):
+    day = at.replace(hour=0, minute=0, second=0, microsecond=0)
+    if window == 'weekly':
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def _window_updates(referrer_id, inc, at, now=None):
+    """One upserting $inc per window for a referrer, into the periods containing `at`"""
+    updates = []
+    for window in WINDOWS:
+        on_insert = {}
+        if window in RETENTION:
+            on_insert['expiresAt'] = period_start(window, at) + RETENTION[window]
+        update = {'$inc': inc, '$set': {'updatedAt': now or at}}
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        updates.append(UpdateOne(
+            {'window': window, 'period': period_key(window, at), 'referrerId': referrer_id},
+            update,
+            upsert=True
+        ))
+    return updates
+
+
+def record_leaderboard_earnings(db, totals, at=None):
+    """Add {referrerId: amount}, earned at `at` (default now), to that period of every window.
+
+    The commission job pays out the previous day after midnight and passes
+    that day, so the earnings land in the periods they were earned in.
+    """
+    now = datetime.utcnow()
+    at = at or now
+    updates = [
+        update
+        for referrer_id, amount in totals.items() if amount
+        for update in _window_updates(referrer_id, {'earnings': amount}, at, now)
+    ]
+    if updates:
+        db[COLLECTION].bulk_write(updates, ordered=False)
+
+
+def _sync_state(last_created_at, counted, now):
+    """Counter document: newest createdAt counted and the users counted within the window before it"""
+    since = last_created_at - DOWNLINE_SYNC_WINDOW
+    return {
+        'lastCreatedAt': last_created_at,
+        'recentUsers': [
+            {'_id': user_id, 'createdAt': created_at}
+            for user_id, created_at in counted.items() if created_at >= since
+        ],
+        'updatedAt': now
+    }
+
+
+def sync_leaderboard_downline(db, now=None):
+    """Count users registered since the last sync towards their referrer's downline"""
+    now = now or datetime.utcnow()
+    state = db.counters.find_one({'_id': DOWNLINE_COUNTER_ID}) or {}
+    query = {'createdAt': {'$lte': now}}
+    if state.get('lastCreatedAt'):
+        query['createdAt']['$gte'] = state['lastCreatedAt'] - DOWNLINE_SYNC_WINDOW
+    # Counted by earlier syncs and still inside the re-read window
+    seen = {user['_id']: user['createdAt'] for user in state.get('recentUsers', [])}
+
+    last_created_at = state.get('lastCreatedAt')
+    counted = {}
+    counts = defaultdict(int)
+    for user in db.users.find(query, {'referredBy': 1, 'createdAt': 1}):
+        if user['_id'] in seen:
+            continue
+        counted[user['_id']] = user['createdAt']
+        if last_created_at is None or user['createdAt'] > last_created_at:
+            last_created_at = user['createdAt']
+        if user.get('referredBy'):
+            counts[(user['referredBy'], period_start('daily', user['createdAt']))] += 1
+    if not counted:
+        return 0
+
+    updates = [
+        update
+        for (referrer_id, day), count in counts.items()
+        for update in _window_updates(referrer_id, {'downline': count}, day, now)
+    ]
+    if updates:
+        db[COLLECTION].bulk_write(updates, ordered=False)
+    db.counters.update_one(
+        {'_id': DOWNLINE_COUNTER_ID},
+        {'$set': _sync_state(last_created_at, {**seen, **counted}, now)},
+        upsert=True
+    )
+    return sum(counts.values())
+
+
+def run_leaderboard_sync():
+    """Scheduler entry point"""
+    try:
+        sync_leaderboard_downline(db)
+    except Exception:
+        logger.exception('Leaderboard downline sync failed')
+
+
+class LeaderboardCache:
+    """Per-worker top LEADERBOARD_SIZE rows per (window, ordering), refreshed every CACHE_SECONDS"""
+
+    def __init__(self, size=LEADERBOARD_SIZE, ttl=CACHE_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def top(self, db, window, ordering, limit):
+        key = (window, ordering)
+        period = period_key(window, datetime.utcnow())
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry['period'] != period or time.monotonic() - entry['loadedAt'] > self.ttl:
+            entry = {'period': period, 'rows': self._load(db, window, period, ordering), 'loadedAt': time.monotonic()}
+            with self._lock:
+                self._entries[key] = entry
+        return entry['rows'][:limit]
+
+    def _load(self, db, window, period, ordering):
+        rows = list(db[COLLECTION].find(
+            {'window': window, 'period': period},
+            {'_id': 0, 'referrerId': 1, 'earnings': 1, 'downline': 1}
+        ).sort([(ordering, -1), ('referrerId', 1)]).limit(self.size))
+        if not rows:
+            return []
+        names = {
+            user['_id']: user.get('username', '')
+            for user in db.users.find({'_id': {'$in': [row['referrerId'] for row in rows]}}, {'username': 1})
+        }
+        return [
+            {
+                'rank': rank,
+                'userId': str(row['referrerId']),
+                'username': names.get(row['referrerId'], ''),
+                'earnings': round(float(row.get('earnings', 0)), 2),
+                'downline': int(row.get('downline', 0))
+            }
+            for rank, row in enumerate(rows, 1)
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+leaderboard_cache = LeaderboardCache()
+
+
+def get_leaderboard(db, window='all', ordering='earnings', limit=20):
+    """Top `limit` referrers of the current period of `window`"""
+    return leaderboard_cache.top(db, window, ordering, max(1, min(limit, LEADERBOARD_SIZE)))
+
+
+def _window_range(window, now):
+    if window == 'all':
+        return {}
+    start = period_start(window, now)
+    return {'$gte': start, '$lt': start + (timedelta(days=1) if window == 'daily' else timedelta(weeks=1))}
+
+
+def rebuild_leaderboard(db, now=None):
+    """Recompute the current period of every window; returns the number of rows written"""
+    now = now or datetime.utcnow()
+    written = 0
+    for window in WINDOWS:
+        period = period_key(window, now)
+        created = _window_range(window, now)
+        rows = defaultdict(lambda: {'earnings': 0.0, 'downline': 0})
+
+        if window == 'all':
+            earnings = db[SUMMARY_COLLECTION].aggregate([
+                {'$group': {'_id': '$referrerId', 'earnings': {'$sum': '$total'}}}
+            ], allowDiskUse=True)
+        else:
+            earnings = db.referral_history.aggregate([
+                # Daily commissions count on the day they were earned. Compacted
+                # buckets only hold rows far older than a week.
+                {'$match': {
+                    '$or': [{'date': created}, {'date': {'$exists': False}, 'createdAt': created}],
+                    'bucket': {'$exists': False}
+                }},
+                {'$group': {'_id': '$referrerId', 'earnings': {'$sum': '$amount'}}}
+            ], allowDiskUse=True)
+        for row in earnings:
+            rows[row['_id']]['earnings'] = row['earnings']
+
+        user_match = {'referredBy': {'$ne': None}}
+        if created:
+            user_match['createdAt'] = created
+        for row in db.users.aggregate([
+            {'$match': user_match},
+            {'$group': {'_id': '$referredBy', 'downline': {'$sum': 1}}}
+        ], allowDiskUse=True):
+            rows[row['_id']]['downline'] = row['downline']
+
+        db[COLLECTION].delete_many({'window': window, 'period': period})
+        documents = [
+            dict(values, window=window, period=period, referrerId=referrer_id, updatedAt=now)
+            for referrer_id, values in rows.items()
+        ]
+        for document in documents:
+            if window in RETENTION:
+                document['expiresAt'] = period_start(window, now) + RETENTION[window]
+        if documents:
+            db[COLLECTION].insert_many(documents, ordered=False)
+        written += len(documents)
+
+    # Registrations up to `now` are counted above; the sync takes over from here
+    recent = {
+        user['_id']: user['createdAt']
+        for user in db.users.find({'createdAt': {'$gte': now - DOWNLINE_SYNC_WINDOW, '$lte': now}}, {'createdAt': 1})
+    }
+    db.counters.update_one(
+        {'_id': DOWNLINE_COUNTER_ID},
+        {'$set': _sync_state(now, recent, now)},
+        upsert=True
+    )
+    leaderboard_cache.clear()
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+    from dotenv import load_dotenv
+    from app_logging import configure_logging
+    from database import get_db
+    parser = argparse.ArgumentParser(description='Referral leaderboard maintenance')
+    parser.add_argument('command', choices=['rebuild', 'sync'])
+    args = parser.parse_args()
+    load_dotenv()
+    configure_logging()
+    database = get_db()
+    if args.command == 'rebuild':
+        print(f'Rebuilt {rebuild_leaderboard(database)} leaderboard rows')
+    else:
+        print(f'Counted {sync_leaderboard_downline(database)} new referrals')
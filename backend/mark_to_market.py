@@ -0,0 +1,129 @@
+"""Periodic mark-to-market of every active investment.
+
+Revalues the whole book against the latest forex prices in one pass: a
+single projected query streams the active investments into NumPy columns,
+each row gets its pair's price by index into a per-pair price vector, and
+unrealized P&L is computed for all of them at once. Only rows whose price
+actually moved are written, in one unordered bulk write, so the cost is one
+read, a few array operations over the whole book and one bulk write, whatever
+the number of investments.
+
+Runs in the scheduler process every MARK_TO_MARKET_INTERVAL seconds
+(default 60). Pairs without a price newer than FOREX_PRICE_MAX_AGE are left
+untouched, and so are investments created before real entry prices were
+recorded: they carry the placeholder entryPrice 1.0, against which any P&L
+would be meaningless.
+"""
+from datetime import datetime
+import os
+import time
+import numpy as np
+from prometheus_client import Counter, Histogram
+from pymongo import UpdateOne
+from app_logging import get_logger
+from database import db
+from forex_prices import get_price
+
+logger = get_logger('mark_to_market')
+
+MARK_INTERVAL = int(os.getenv('MARK_TO_MARKET_INTERVAL', '60'))
+# Relative price change below which a stored mark is left as is
+PRICE_TOLERANCE = 1e-9
+# entryPrice stored by the app before it priced investments at creation
+PLACEHOLDER_ENTRY_PRICE = 1.0
+
+MARK_DURATION = Histogram(
+    'mark_to_market_duration_seconds', 'Time to revalue all active investments',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+INVESTMENTS_MARKED = Counter(
+    'mark_to_market_updates_total', 'Investments whose mark changed and was written'
+)
+
+
+def load_book(db):
+    """Active investments as parallel columns, with pairs encoded as indexes"""
+    ids = []
+    pair_codes = []
+    amounts = []
+    entries = []
+    currents = []
+    pairs = {}
+    cursor = db.investments.find(
+        {'status': 'active'},
+        {'forexPair': 1, 'amount': 1, 'entryPrice': 1, 'currentPrice': 1},
+        batch_size=10000
+    )
+    for inv in cursor:
+        pair = inv.get('forexPair')
+        code = pairs.get(pair)
+        if code is None:
+            code = pairs[pair] = len(pairs)
+        ids.append(inv['_id'])
+        pair_codes.append(code)
+        amounts.append(inv.get('amount') or 0)
+        entries.append(inv.get('entryPrice') or 0)
+        currents.append(inv.get('currentPrice') or 0)
+    return (
+        ids,
+        list(pairs),
+        np.array(pair_codes, dtype=np.int32),
+        np.array(amounts, dtype=np.float64),
+        np.array(entries, dtype=np.float64),
+        np.array(currents, dtype=np.float64)
+    )
+
+
+def revalue(pair_codes, amounts, entries, currents, pair_prices):
+    """Rows to update and their new price and unrealized P&L.
+
+    pair_prices holds one price per pair code, NaN where no price is known.
+    Rows without a real entry price are never revalued.
+    """
+    prices = pair_prices[pair_codes]
+    priced = ~np.isnan(prices) & (entries > 0) & (entries != PLACEHOLDER_ENTRY_PRICE)
+    moved = np.abs(prices - currents) > PRICE_TOLERANCE * np.abs(prices)
+    changed = np.flatnonzero(priced & moved)
+    pnl = amounts[changed] * (prices[changed] / entries[changed] - 1)
+    return changed, prices[changed], np.round(pnl, 2)
+
+
+def mark_to_market(db):
+    """Revalue every active investment against the latest prices"""
+    started = time.perf_counter()
+    ids, pairs, pair_codes, amounts, entries, currents = load_book(db)
+    if not ids:
+        return 0
+
+    pair_prices = np.array([get_price(pair) or np.nan for pair in pairs], dtype=np.float64)
+    changed, prices, pnl = revalue(pair_codes, amounts, entries, currents, pair_prices)
+
+    if len(changed):
+        now = datetime.utcnow()
+        db.investments.bulk_write([
+            UpdateOne(
+                # Skip rows closed since they were read
+                {'_id': ids[row], 'status': 'active'},
+                {'$set': {'currentPrice': price, 'unrealizedPnl': value, 'markedAt': now}}
+            )
+            for row, price, value in zip(changed.tolist(), prices.tolist(), pnl.tolist())
+        ], ordered=False)
+
+    elapsed = time.perf_counter() - started
+    MARK_DURATION.observe(elapsed)
+    INVESTMENTS_MARKED.inc(len(changed))
+    logger.info('Mark-to-market completed', extra={
+        'investments': len(ids),
+        'updated': len(changed),
+        'unpriced_pairs': [pair for pair, price in zip(pairs, pair_prices) if np.isnan(price)],
+        'seconds': round(elapsed, 3)
+    })
+    return len(changed)
+
+
+def run_mark_to_market():
+    """Scheduler entry point"""
+    try:
+        mark_to_market(db)
+    except Exception:
+        logger.exception('Mark-to-market failed')
@@ -0,0 +1,118 @@
+"""Prometheus request metrics shared across gunicorn workers.
+
+When PROMETHEUS_MULTIPROC_DIR is set (gunicorn_config.py sets it before any
+worker starts) every worker writes its samples to memory-mapped files in that
+directory and /metrics aggregates all of them, so a scrape sees the whole
+server rather than whichever worker answered. Without it, e.g. under
+`python app.py`, the in-process default registry is used.
+"""
+import os
+import time
+from flask import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
+from werkzeug.exceptions import HTTPException
+from instrumentation import internal_only
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+REQUEST_COUNT = Counter(
+    'http_requests_total', 'HTTP requests served',
+    ['method', 'route', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency, including streaming the body',
+    ['method', 'route'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 10)
+)
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes', 'HTTP response body size',
+    ['method', 'route'],
+    buckets=(100, 500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'HTTP requests currently being served',
+    ['method', 'route'],
+    multiprocess_mode='livesum'
+)
+
+
+class _MeteredBody:
+    """Wraps a WSGI response body to count bytes and record on close"""
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._on_close(self.size)
+
+
+class PrometheusMiddleware:
+    """WSGI middleware recording count, latency, size and in-flight requests"""
+
+    def __init__(self, wsgi_app, url_map):
+        self.wsgi_app = wsgi_app
+        self.url_map = url_map
+
+    def _route(self, environ):
+        try:
+            rule, _ = self.url_map.bind_to_environ(environ).match(return_rule=True)
+            return rule.rule
+        except HTTPException:
+            return UNMATCHED_ROUTE
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        route = self._route(environ)
+        started = time.perf_counter()
+        status = {'code': '500'}
+
+        def metered_start_response(status_line, headers, exc_info=None):
+            status['code'] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def record(size):
+            REQUEST_LATENCY.labels(method, route).observe(time.perf_counter() - started)
+            REQUEST_COUNT.labels(method, route, status['code']).inc()
+            RESPONSE_SIZE.labels(method, route).observe(size)
+            REQUESTS_IN_PROGRESS.labels(method, route).dec()
+
+        REQUESTS_IN_PROGRESS.labels(method, route).inc()
+        try:
+            body = self.wsgi_app(environ, metered_start_response)
+        except Exception:
+            record(0)
+            raise
+        return _MeteredBody(body, record)
+
+
+def metrics_registry():
+    """Registry aggregating every worker when running in multiprocess mode"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def init_metrics(app):
+    """Wrap the app in the metrics middleware and serve /metrics"""
+    app.wsgi_app = PrometheusMiddleware(app.wsgi_app, app.url_map)
+
+    @app.route('/metrics', methods=['GET'])
+    @internal_only
+    def prometheus_metrics():
+        return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
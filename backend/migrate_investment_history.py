@@ -0,0 +1,180 @@
+"""Move investment_history into a time-series collection.
+
+Existing entries live in a regular collection with a top-level userId
+(sometimes a string), investmentId and an ISO string `date`. This tool
+renames that collection to investment_history_legacy, creates the
+time-series investment_history (see investment_history.py) and copies the
+entries across in batches ordered by _id, converting userId to an ObjectId,
+moving both ids into `meta` and dropping `date`, which is derived from
+createdAt on read.
+
+Stop the scheduler while the rename happens, so the ROI job does not
+recreate a regular collection in between. The copy checkpoints its position
+in the `migrations` collection and can be stopped and resumed at any time;
+the app writes the new collection and reads both until the copy has
+completed. With --drop-legacy the legacy collection is dropped once every
+entry is copied.
+
+    python migrate_investment_history.py --batch-size 5000 --pause 0.1
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from investment_history import (
+    COLLECTION, LEGACY_COLLECTION, MIGRATION_ID, create_history_collection, entry_time, history_entry, is_timeseries
+)
+
+
+def get_checkpoint(db):
+    return db.migrations.find_one({'_id': MIGRATION_ID}) or {}
+
+
+def reset_checkpoint(db):
+    db.migrations.delete_one({'_id': MIGRATION_ID})
+
+
+def _object_id(value):
+    return ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else value
+
+
+def convert(row):
+    """Legacy history row as a time-series entry, keeping its _id"""
+    if isinstance(row.get('meta'), dict):
+        # Written in the new shape by the ROI job before the migration ran
+        return row
+    entry = history_entry(
+        _object_id(row.get('userId', row.get('user_id'))),
+        _object_id(row.get('investmentId')),
+        row.get('type', 'roi_earning'),
+        float(row.get('amount', 0)),
+        entry_time(row),
+        float(row.get('balance', 0))
+    )
+    entry['_id'] = row['_id']
+    return entry
+
+
+def prepare_collections(db, dry_run=False):
+    """Rename the regular collection aside and create the time-series one"""
+    names = db.list_collection_names()
+    if COLLECTION in names and not is_timeseries(db):
+        if LEGACY_COLLECTION in names:
+            raise RuntimeError(f'Both {COLLECTION} and {LEGACY_COLLECTION} are regular collections; '
+                               f'merge or drop one before migrating')
+        print(f"Renaming {COLLECTION} to {LEGACY_COLLECTION}{' (dry run)' if dry_run else ''}")
+        if dry_run:
+            return
+        db[COLLECTION].rename(LEGACY_COLLECTION)
+    if not dry_run:
+        create_history_collection(db)
+
+
+def _already_copied(db, rows):
+    """_ids of `rows` present in the target, from a batch cut short before its checkpoint"""
+    users = list({entry['meta']['userId'] for entry in rows})
+    return {
+        entry['_id'] for entry in db[COLLECTION].find(
+            {'meta.userId': {'$in': users}, '_id': {'$in': [entry['_id'] for entry in rows]}},
+            {'_id': 1}
+        )
+    }
+
+
+def migrate_investment_history(db, batch_size=5000, pause=0.1, max_batches=None, dry_run=False,
+                               drop_legacy=False):
+    """Copy legacy entries in batches, resuming from the last checkpoint"""
+    prepare_collections(db, dry_run)
+    source = LEGACY_COLLECTION if LEGACY_COLLECTION in db.list_collection_names() else COLLECTION
+    if source == COLLECTION and is_timeseries(db):
+        print('investment_history is already a time-series collection')
+        return 0
+
+    checkpoint = get_checkpoint(db)
+    last_id = checkpoint.get('lastId')
+    copied = checkpoint.get('copied', 0)
+    remaining = db[source].count_documents({'_id': {'$gt': last_id}} if last_id else {})
+    started = time.monotonic()
+    batches = 0
+    processed = 0
+    resumed = last_id is not None
+
+    print(f"Copying {remaining} investment history entries"
+          f"{f' from {last_id}' if last_id else ''}{' (dry run)' if dry_run else ''}")
+
+    while max_batches is None or batches < max_batches:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        rows = [convert(row) for row in db[source].find(query).sort('_id', 1).limit(batch_size)]
+        if not rows:
+            break
+
+        if not dry_run:
+            pending = rows
+            if resumed:
+                # The batch after a checkpoint may have been inserted before an interruption
+                seen = _already_copied(db, rows)
+                pending = [entry for entry in rows if entry['_id'] not in seen]
+                resumed = False
+            if pending:
+                db[COLLECTION].insert_many(pending, ordered=False)
+            copied += len(pending)
+            db.migrations.update_one(
+                {'_id': MIGRATION_ID},
+                {
+                    '$set': {'lastId': rows[-1]['_id'], 'copied': copied, 'updatedAt': datetime.utcnow()},
+                    '$setOnInsert': {'startedAt': datetime.utcnow()}
+                },
+                upsert=True
+            )
+        else:
+            copied += len(rows)
+
+        last_id = rows[-1]['_id']
+        batches += 1
+        processed += len(rows)
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0
+        print(f"Batch {batches}: {processed}/{remaining} processed ({copied} copied in total), "
+              f"last _id {last_id}, {rate:.0f} docs/s")
+
+        if pause:
+            time.sleep(pause)
+
+    done = dry_run or db[source].count_documents({'_id': {'$gt': last_id}} if last_id else {}) == 0
+    if done and not dry_run:
+        db.migrations.update_one(
+            {'_id': MIGRATION_ID},
+            {'$set': {'completedAt': datetime.utcnow()}},
+            upsert=True
+        )
+        if drop_legacy:
+            db.drop_collection(LEGACY_COLLECTION)
+            print(f'Dropped {LEGACY_COLLECTION}')
+    print(f"Migration {'complete' if done else 'paused'}: {copied} entries copied")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move investment_history into a time-series collection')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+    parser.add_argument('--max-batches', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--drop-legacy', action='store_true', help='Drop the legacy collection when done')
+    parser.add_argument('--reset', action='store_true', help='Discard the checkpoint and start over')
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/secure_auth_glass'))
+    db = client.get_default_database()
+
+    if args.reset:
+        reset_checkpoint(db)
+    migrate_investment_history(db, args.batch_size, args.pause, args.max_batches, args.dry_run, args.drop_legacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Rewrite legacy investment documents to the canonical field names.
+
+Older documents were written with snake_case fields (user_id, pair,
+entry_price, current_price, daily_roi, created_at). This tool moves them to
+the camelCase schema written by create_investment so the read path can use a
+single indexed equality query on userId.
+
+The migration runs in small batches ordered by _id, pauses between batches to
+keep load on the primary low, and checkpoints its position in the
+`migrations` collection so it can be stopped and resumed at any time.
+
+    python migrate_investments.py --batch-size 500 --pause 0.2
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+MIGRATION_ID = 'investments_canonical_fields'
+
+# Legacy field -> canonical field
+FIELD_MAP = {
+    'user_id': 'userId',
+    'pair': 'forexPair',
+    'entry_price': 'entryPrice',
+    'current_price': 'currentPrice',
+    'daily_roi': 'dailyROI',
+    'created_at': 'createdAt'
+}
+
+LEGACY_FILTER = {'$or': [{field: {'$exists': True}} for field in FIELD_MAP]}
+
+
+def _canonical_value(legacy, canonical):
+    """Keep an existing canonical value, otherwise take the legacy one"""
+    value = {'$ifNull': [f'${canonical}', f'${legacy}']}
+    converted = value
+    if canonical == 'userId':
+        converted = {'$cond': [{'$eq': [{'$type': value}, 'string']}, {'$toObjectId': value}, value]}
+    elif canonical == 'createdAt':
+        converted = {'$cond': [{'$eq': [{'$type': value}, 'string']}, {'$toDate': value}, value]}
+    elif canonical in ('entryPrice', 'currentPrice', 'dailyROI'):
+        converted = {'$toDouble': value}
+    # Leave the field absent rather than writing null when neither name is set
+    return {'$cond': [{'$in': [{'$type': value}, ['missing', 'null']]}, '$$REMOVE', converted]}
+
+
+# Update pipeline applied to every document of a batch in one command
+MIGRATION_PIPELINE = [
+    {'$set': {
+        canonical: _canonical_value(legacy, canonical)
+        for legacy, canonical in FIELD_MAP.items()
+    }},
+    {'$unset': list(FIELD_MAP)}
+]
+
+
+def get_checkpoint(db):
+    return db.migrations.find_one({'_id': MIGRATION_ID}) or {}
+
+
+def reset_checkpoint(db):
+    db.migrations.delete_one({'_id': MIGRATION_ID})
+
+
+def migrate_investments(db, batch_size=500, pause=0.2, max_batches=None, dry_run=False):
+    """Migrate legacy investments in batches, resuming from the last checkpoint"""
+    checkpoint = get_checkpoint(db)
+    last_id = checkpoint.get('lastId')
+    migrated = checkpoint.get('migrated', 0)
+    remaining = db.investments.count_documents(LEGACY_FILTER)
+    started = time.monotonic()
+    batches = 0
+    processed = 0
+
+    print(f"Migrating {remaining} legacy investments"
+          f"{f' from {last_id}' if last_id else ''}{' (dry run)' if dry_run else ''}")
+
+    while max_batches is None or batches < max_batches:
+        query = dict(LEGACY_FILTER)
+        if last_id is not None:
+            query = {'$and': [LEGACY_FILTER, {'_id': {'$gt': last_id}}]}
+
+        ids = [doc['_id'] for doc in db.investments.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+        if not ids:
+            break
+
+        if not dry_run:
+            result = db.investments.update_many({'_id': {'$in': ids}}, MIGRATION_PIPELINE)
+            migrated += result.modified_count
+            db.migrations.update_one(
+                {'_id': MIGRATION_ID},
+                {
+                    '$set': {'lastId': ids[-1], 'migrated': migrated, 'updatedAt': datetime.utcnow()},
+                    '$setOnInsert': {'startedAt': datetime.utcnow()}
+                },
+                upsert=True
+            )
+        else:
+            migrated += len(ids)
+
+        last_id = ids[-1]
+        batches += 1
+        processed += len(ids)
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0
+        print(f"Batch {batches}: {processed}/{remaining} processed ({migrated} migrated in total), "
+              f"last _id {last_id}, {rate:.0f} docs/s")
+
+        if pause:
+            time.sleep(pause)
+
+    done = db.investments.count_documents(LEGACY_FILTER) == 0
+    if done and not dry_run:
+        db.migrations.update_one(
+            {'_id': MIGRATION_ID},
+            {'$set': {'completedAt': datetime.utcnow()}},
+            upsert=True
+        )
+    print(f"Migration {'complete' if done else 'paused'}: {migrated} documents migrated")
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate legacy investment field names')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.2, help='Seconds to sleep between batches')
+    parser.add_argument('--max-batches', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--reset', action='store_true', help='Discard the checkpoint and start over')
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/secure_auth_glass'))
+    db = client.get_default_database()
+
+    if args.reset:
+        reset_checkpoint(db)
+    migrate_investments(db, args.batch_size, args.pause, args.max_batches, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Benchmark the nightly jobs end to end on synthetic datasets.
+
+For every size in --sizes and every job the benchmark seeds a fresh dataset
+with exactly that many investments (perf.seed, same seed each time), then
+runs calculate_daily_referral_commissions or calculate_daily_roi_earnings
+against it in its own child process so peak RSS belongs to one job. Jobs
+write to the data the others read (ROI credits balances and stamps
+investments), so no job runs on what an earlier one left behind. Per run it records wall time, Mongo commands
+(from the same RouteCommandListener the app uses), commands/sec,
+investments/sec and peak RSS, and appends the results, tagged with the commit,
+to a JSON history file.
+
+    python -m perf.bench_jobs --sizes 10000,100000,1000000
+    python -m perf.bench_jobs --sizes 10000 --jobs roi --history-file /tmp/roi.json
+
+The ROI job skips weekends, so jobs run as of --as-of (default: the most
+recent weekday). Refuses non-local databases unless --force is given.
+"""
+import argparse
+from datetime import date, datetime, timedelta
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from perf.seed import DEFAULT_URI, _is_local, seed
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_HISTORY_FILE = os.path.join(BACKEND_DIR, 'perf', 'results', 'jobs_history.json')
+DEFAULT_SIZES = '10000,100000,1000000'
+
+JOBS = {
+    'commissions': 'calculate_daily_referral_commissions',
+    'roi': 'calculate_daily_roi_earnings'
+}
+
+
+def last_weekday(today=None):
+    day = today or date.today()
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_job_in_this_process(job, as_of):
+    """Run one job against MONGODB_URI and return its measurements"""
+    import jobs
+    from database import get_db, init_indexes
+    from commission_config import init_commission_rates
+    from instrumentation import BACKGROUND_ROUTE, command_stats
+
+    # Pin the job's clock so the ROI job does not skip a weekend run
+    offset = datetime.combine(as_of, datetime.utcnow().time()) - datetime.utcnow()
+
+    class PinnedDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return datetime.utcnow() + offset
+
+    jobs.datetime = PinnedDatetime
+
+    database = get_db()
+    init_indexes(database)
+    init_commission_rates(database)
+    investments = database.investments.count_documents({'status': 'active'})
+    rss_before = _peak_rss_mb()
+    command_stats.reset()
+
+    started = time.perf_counter()
+    getattr(jobs, JOBS[job])()
+    wall = time.perf_counter() - started
+
+    stats = command_stats.snapshot().get(BACKGROUND_ROUTE, {'count': 0, 'commands': {}, 'total_ms': 0})
+    return {
+        'job': job,
+        'active_investments': investments,
+        'wall_seconds': round(wall, 3),
+        'mongo_ops': stats['count'],
+        'mongo_ops_by_command': stats['commands'],
+        'mongo_time_seconds': round(stats['total_ms'] / 1000, 3),
+        'ops_per_second': round(stats['count'] / wall, 1) if wall else None,
+        'investments_per_second': round(investments / wall, 1) if wall else None,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+
+def run_job(uri, job, as_of):
+    """Run one job in a child process so its peak RSS is its own"""
+    env = dict(os.environ)
+    env['MONGODB_URI'] = uri
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'perf.bench_jobs', '--child', job, '--as-of', as_of.isoformat()],
+        cwd=BACKEND_DIR, env=env
+    )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(path, entry):
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    history.append(entry)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=2)
+
+
+def print_results(results, previous=None):
+    baseline = {(r['size'], r['job']): r for r in (previous or {}).get('results', [])}
+    header = f"{'size':>9} {'job':<12}{'wall s':>9}{'ops':>10}{'ops/s':>10}{'inv/s':>10}{'peak MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        line = (f"{r['size']:>9} {r['job']:<12}{r['wall_seconds']:>9.2f}{r['mongo_ops']:>10}"
+                f"{r['ops_per_second'] or 0:>10.0f}{r['investments_per_second'] or 0:>10.0f}{r['peak_rss_mb']:>9.1f}")
+        base = baseline.get((r['size'], r['job']))
+        if base and base['wall_seconds']:
+            line += f"  wall {(r['wall_seconds'] - base['wall_seconds']) / base['wall_seconds'] * 100:+.1f}%"
+            line += f" vs {previous.get('commit') or 'previous'}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the nightly jobs on synthetic datasets')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma separated investment counts')
+    parser.add_argument('--jobs', default=','.join(JOBS), help='Comma separated subset of: ' + ', '.join(JOBS))
+    parser.add_argument('--investments-per-user', type=float, default=3.0)
+    parser.add_argument('--as-of', type=date.fromisoformat, default=last_weekday(), help='Date the jobs run on')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--history-file', default=DEFAULT_HISTORY_FILE)
+    parser.add_argument('--force', action='store_true', help='Allow a non-local database')
+    parser.add_argument('--child', choices=JOBS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_job_in_this_process(args.child, args.as_of)))
+        return
+
+    load_dotenv()
+    uri = os.getenv('LOADTEST_MONGODB_URI', DEFAULT_URI)
+    if not _is_local(uri) and not args.force:
+        parser.error(f'refusing to benchmark against non-local database {uri} without --force')
+    job_names = [name.strip() for name in args.jobs.split(',') if name.strip()]
+    for name in job_names:
+        if name not in JOBS:
+            parser.error(f'unknown job {name!r}')
+
+    db = MongoClient(uri).get_default_database()
+    results = []
+    for size in (int(value) for value in args.sizes.split(',')):
+        users = max(int(size / args.investments_per_user), 1)
+        for job in job_names:
+            seed(db, users=users, seed_value=args.seed, drop=True, total_investments=size)
+            result = run_job(uri, job, args.as_of)
+            result.update({'size': size, 'users': users})
+            results.append(result)
+
+    previous = None
+    if os.path.exists(args.history_file):
+        with open(args.history_file) as f:
+            history = json.load(f)
+        previous = history[-1] if history else None
+    print_results(results, previous)
+
+    append_history(args.history_file, {
+        'commit': git_commit(),
+        'recorded_at': datetime.utcnow().isoformat() + 'Z',
+        'as_of': args.as_of.isoformat(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'results': results
+    })
+    print(f'Appended to {args.history_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Micro-benchmarks for the response builders of the hottest routes.
+
+Replays realistic document shapes (what pymongo returns: ObjectIds,
+datetimes, ints where floats are expected) through the same formatting
+helpers the routes use, then through Flask's JSON provider, and reports:
+
+    ns/row          median time per row over --repeat runs
+    KiB peak/row    tracemalloc peak while building the response
+    blocks/row      allocations still alive in the finished response
+
+for the formatting step alone and for formatting plus JSON encoding. No
+database is needed.
+
+    python -m perf.bench_serialization --rows 1000 --output after.json --compare before.json
+"""
+import argparse
+from datetime import datetime, timedelta
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from bson.objectid import ObjectId
+from flask import Flask
+from app import format_investment, format_referral, format_session_user
+from commission_config import DEFAULT_FOREX_REWARDS
+from user_cache import USER_SNAPSHOT_FIELDS
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD_HASH = '$2b$12$' + 'x' * 53
+
+
+def make_user(rng, index, referred=True):
+    created_at = datetime(2024, 1, 1) + timedelta(seconds=rng.randrange(30000000))
+    return {
+        '_id': ObjectId(),
+        'username': f'user{index}',
+        'phone': f'+2547{index:08d}',
+        'password': PASSWORD_HASH,
+        'balance': rng.choice([0, round(rng.uniform(0, 50000), 2)]),
+        'referralCode': f'R{index:05X}',
+        'referredBy': ObjectId() if referred else None,
+        'isActive': True,
+        'createdAt': created_at,
+        'updatedAt': created_at,
+        '__v': 0
+    }
+
+
+def make_investment(rng, user_id):
+    return {
+        '_id': ObjectId(),
+        'userId': user_id,
+        'forexPair': rng.choice(list(DEFAULT_FOREX_REWARDS)),
+        # Stored as ints as often as floats; float() coercion is part of the cost
+        'amount': rng.choice([rng.randrange(100, 10000), round(rng.uniform(100, 10000), 2)]),
+        'dailyROI': rng.choice([2, 2.5, 3]),
+        'entryPrice': 1.0,
+        'currentPrice': round(rng.uniform(0.9, 1.1), 5),
+        'status': 'active' if rng.random() < 0.9 else 'closed',
+        'profit': round(rng.uniform(0, 500), 2),
+        'createdAt': datetime(2024, 1, 1) + timedelta(seconds=rng.randrange(30000000))
+    }
+
+
+def build_cases(rows, seed):
+    rng = random.Random(seed)
+    user_id = str(ObjectId())
+    investments = [make_investment(rng, ObjectId(user_id)) for _ in range(rows)]
+    users = [make_user(rng, i) for i in range(rows)]
+    snapshots = [{key: user[key] for key in ('_id', *USER_SNAPSHOT_FIELDS)} for user in users]
+    referrals = [
+        (make_user(rng, i), rng.randint(1, 3), rng.choice([0, 100, 300]), rng.uniform(0, 200), rng.randrange(20))
+        for i in range(rows)
+    ]
+    return {
+        'get_investments': (
+            investments, lambda inv: format_investment(inv, user_id), 'investments'),
+        'login': (users, format_session_user, 'user'),
+        'verify': (snapshots, format_session_user, 'user'),
+        'get_referral_history': (
+            referrals, lambda row: format_referral(*row), 'referrals')
+    }
+
+
+def _format_all(docs, formatter):
+    return [formatter(doc) for doc in docs]
+
+
+def _encode_all(docs, formatter, key, dumps):
+    return dumps({key: [formatter(doc) for doc in docs]})
+
+
+def _time_ns(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - started)
+    return statistics.median(samples)
+
+
+def _allocations(fn):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    del result
+    return peak - baseline, retained_blocks
+
+
+def run(rows, repeat, seed):
+    dumps = Flask(__name__).json.dumps
+    results = {}
+    for name, (docs, formatter, key) in build_cases(rows, seed).items():
+        for phase, fn in (
+            ('format', lambda: _format_all(docs, formatter)),
+            ('format+json', lambda: _encode_all(docs, formatter, key, dumps))
+        ):
+            fn()  # warm up
+            elapsed = _time_ns(fn, repeat)
+            peak_bytes, blocks = _allocations(fn)
+            results[f'{name} {phase}'] = {
+                'ns_per_row': round(elapsed / rows, 1),
+                'peak_kib_per_row': round(peak_bytes / rows / 1024, 3),
+                'blocks_per_row': round(blocks / rows, 2)
+            }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    base_results = (baseline or {}).get('results', {})
+    header = f"{'case':<34}{'ns/row':>10}{'KiB/row':>10}{'blocks/row':>12}"
+    print(header)
+    print('-' * len(header))
+    for name, row in results.items():
+        line = f"{name:<34}{row['ns_per_row']:>10.0f}{row['peak_kib_per_row']:>10.3f}{row['blocks_per_row']:>12.2f}"
+        base = base_results.get(name)
+        if base and base['ns_per_row']:
+            line += f"  {(row['ns_per_row'] - base['ns_per_row']) / base['ns_per_row'] * 100:+.1f}% ns"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark response formatting and JSON encoding')
+    parser.add_argument('--rows', type=int, default=1000, help='Rows per response')
+    parser.add_argument('--repeat', type=int, default=50, help='Timed runs per case (median is reported)')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='Write results as JSON')
+    parser.add_argument('--compare', help='Earlier JSON results to compare against')
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'recorded_at': datetime.utcnow().isoformat() + 'Z',
+                'rows': args.rows,
+                'repeat': args.repeat,
+                'results': results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
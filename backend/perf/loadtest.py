@@ -0,0 +1,355 @@
+"""Drive the API with concurrent virtual users and report per-endpoint latency.
+
+Each virtual user logs in as one of the users created by perf.seed and then
+runs scenarios picked at random from --mix until --duration is up:
+
+    dashboard          verify + investments + earnings + history, as the UI does
+    invest             POST /api/investments
+    referral_stats     GET /api/referral/stats
+    referral_history   GET /api/referral/history
+    register           a brand-new user registering (with a seeded referral code)
+
+Requests made during --warmup are not recorded. The report lists count, RPS,
+p50/p95/p99, mean and error rate per endpoint; --output writes it as JSON
+(with the commit it was measured on) and --compare prints the change against
+an earlier report, so runs on two commits can be diffed directly.
+
+    python -m perf.seed --users 10000 --drop
+    python -m perf.loadtest --spawn-server --concurrency 200 --duration 60 --output before.json
+
+--spawn-server starts gunicorn with gunicorn_config.py (gevent workers) and
+a forex price producer against LOADTEST_MONGODB_URI; otherwise --base-url
+must point at a running server that uses the seeded database.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+from collections import defaultdict
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from urllib.parse import urlparse
+import gevent
+from gevent.pool import Pool
+from perf.seed import DEFAULT_PASSWORD, DEFAULT_URI, FOREX_PAIRS, phone_for, referral_code_for
+
+DEFAULT_MIX = 'dashboard=50,invest=5,referral_stats=20,referral_history=20,register=5'
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Stats:
+    def __init__(self):
+        self.recording = False
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.started = None
+        self.stopped = None
+
+    def start(self):
+        self.recording = True
+        self.started = time.monotonic()
+
+    def stop(self):
+        self.recording = False
+        self.stopped = time.monotonic()
+
+    def record(self, name, seconds, ok):
+        if not self.recording:
+            return
+        self.latencies[name].append(seconds)
+        if not ok:
+            self.errors[name] += 1
+
+    def report(self):
+        elapsed = max((self.stopped or time.monotonic()) - self.started, 1e-9)
+        endpoints = {}
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            endpoints[name] = {
+                'count': len(values),
+                'rps': round(len(values) / elapsed, 2),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                'mean_ms': round(sum(values) / len(values) * 1000, 2),
+                'error_rate': round(self.errors[name] / len(values), 4)
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'total_requests': total,
+            'total_rps': round(total / elapsed, 2),
+            'endpoints': endpoints
+        }
+
+
+class VirtualUser:
+    """One keep-alive connection with its own session cookie"""
+
+    def __init__(self, base_url, stats, timeout):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.stats = stats
+        self.timeout = timeout
+        self.cookies = {}
+        self.conn = None
+
+    def _connect(self):
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, name=None):
+        name = name or f'{method} {path}'
+        headers = {'Accept': 'application/json'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+
+        started = time.perf_counter()
+        status = 0
+        payload = None
+        try:
+            if self.conn is None:
+                self._connect()
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            raw = response.read()
+            status = response.status
+            for header in response.headers.get_all('Set-Cookie') or []:
+                key, _, value = header.split(';', 1)[0].partition('=')
+                self.cookies[key.strip()] = value.strip()
+            if raw:
+                try:
+                    payload = json.loads(raw)
+                except ValueError:
+                    payload = None
+        except (OSError, http.client.HTTPException):
+            # Drop the broken keep-alive connection and reconnect next time
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+        self.stats.record(name, time.perf_counter() - started, 200 <= status < 400)
+        return status, payload
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def scenario_dashboard(user, ctx):
+    user.request('GET', '/api/auth/verify')
+    user.request('GET', '/api/investments')
+    user.request('GET', '/api/investments/earnings')
+    user.request('GET', '/api/investments/history')
+
+
+def scenario_invest(user, ctx):
+    user.request('POST', '/api/investments', {
+        'pair': ctx['rng'].choice(FOREX_PAIRS),
+        'amount': round(ctx['rng'].uniform(10, 100), 2),
+        'dailyROI': 2.0
+    })
+
+
+def scenario_referral_stats(user, ctx):
+    user.request('GET', '/api/referral/stats')
+
+
+def scenario_referral_history(user, ctx):
+    user.request('GET', '/api/referral/history')
+
+
+def scenario_register(user, ctx):
+    # A throwaway connection so the virtual user keeps its own session
+    newcomer = VirtualUser(ctx['base_url'], user.stats, user.timeout)
+    try:
+        newcomer.request('POST', '/api/auth/register', {
+            'username': f'lt-{uuid.uuid4().hex[:12]}',
+            'phone': f'+2549{uuid.uuid4().int % 10 ** 11:011d}',
+            'password': ctx['password'],
+            'referralCode': referral_code_for(ctx['rng'].randrange(ctx['users']))
+        })
+    finally:
+        newcomer.close()
+
+
+SCENARIOS = {
+    'dashboard': scenario_dashboard,
+    'invest': scenario_invest,
+    'referral_stats': scenario_referral_stats,
+    'referral_history': scenario_referral_history,
+    'register': scenario_register
+}
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name!r}; choose from {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_virtual_user(index, args, mix, stats, deadline):
+    rng = random.Random(args.seed + index)
+    ctx = {'rng': rng, 'base_url': args.base_url, 'password': args.password, 'users': args.users}
+    user = VirtualUser(args.base_url, stats, args.timeout)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    try:
+        status, _ = user.request('POST', '/api/auth/login', {
+            'phone': phone_for(rng.randrange(args.users)),
+            'password': args.password
+        })
+        if status != 200:
+            return
+        while time.monotonic() < deadline:
+            SCENARIOS[rng.choices(names, weights)[0]](user, ctx)
+            if args.think_time:
+                gevent.sleep(rng.expovariate(1 / args.think_time))
+    finally:
+        user.close()
+
+
+def wait_for_server(base_url, timeout):
+    parsed = urlparse(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=2)
+            conn.request('GET', '/api/auth/verify')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.5)
+    raise RuntimeError(f'server at {base_url} did not come up within {timeout}s')
+
+
+def spawn_server(base_url):
+    """gunicorn with gunicorn_config.py plus the forex price producer the invest scenario needs"""
+    parsed = urlparse(base_url)
+    env = dict(os.environ)
+    env['MONGODB_URI'] = os.getenv('LOADTEST_MONGODB_URI', DEFAULT_URI)
+    env.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/secure-auth-loadtest-metrics')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:create_app()', '-c', 'gunicorn_config.py',
+         '--bind', f'{parsed.hostname}:{parsed.port or 80}',
+         '--error-logfile', '-', '--access-logfile', '/dev/null'],
+        cwd=BACKEND_DIR, env=env
+    )
+    producer = subprocess.Popen([sys.executable, 'forex_prices.py'], cwd=BACKEND_DIR, env=env)
+    return [server, producer]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    base_endpoints = (baseline or {}).get('endpoints', {})
+    header = f"{'endpoint':<40}{'count':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'err%':>7}"
+    print(header)
+    print('-' * len(header))
+    for name, row in report['endpoints'].items():
+        print(f"{name:<40}{row['count']:>8}{row['rps']:>9.1f}{row['p50_ms']:>9.1f}"
+              f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['error_rate'] * 100:>7.2f}")
+        base = base_endpoints.get(name)
+        if base:
+            deltas = []
+            for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if base[key]:
+                    deltas.append(f"{key} {(row[key] - base[key]) / base[key] * 100:+.1f}%")
+            print(f"{'':<4}vs {baseline.get('commit') or 'baseline'}: {', '.join(deltas)}")
+    print(f"\n{report['total_requests']} requests in {report['elapsed_seconds']}s "
+          f"({report['total_rps']} req/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the API against a seeded database')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=50, help='Virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to record after warm-up')
+    parser.add_argument('--warmup', type=float, default=10, help='Seconds to run before recording')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help='scenario=weight,...')
+    parser.add_argument('--users', type=int, default=1000, help='Seeded users to log in as (perf.seed --users)')
+    parser.add_argument('--password', default=DEFAULT_PASSWORD)
+    parser.add_argument('--think-time', type=float, default=0, help='Mean pause between scenarios in seconds')
+    parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--spawn-server', action='store_true', help='Start gunicorn with gunicorn_config.py')
+    parser.add_argument('--output', help='Write the report as JSON')
+    parser.add_argument('--compare', help='Earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    processes = spawn_server(args.base_url) if args.spawn_server else []
+    try:
+        wait_for_server(args.base_url, 60)
+        stats = Stats()
+        deadline = time.monotonic() + args.warmup + args.duration
+        pool = Pool(args.concurrency)
+        for index in range(args.concurrency):
+            pool.spawn(run_virtual_user, index, args, args.mix, stats, deadline)
+        gevent.sleep(args.warmup)
+        stats.start()
+        pool.join()
+        stats.stop()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    report = stats.report()
+    if not report['total_requests']:
+        print('No requests recorded; check that logins succeed against the seeded database '
+              '(--users and --password must match perf.seed)', file=sys.stderr)
+    report.update({
+        'commit': git_commit(),
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'base_url': args.base_url,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'mix': args.mix,
+            'users': args.users,
+            'think_time': args.think_time,
+            'spawned_server': args.spawn_server
+        }
+    })
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Seed a local mongod with a synthetic, reproducible dataset.
+
+Users join one at a time and pick their referrer by preferential attachment
+(probability proportional to direct referrals + 1, mixed with a uniform pick
+by --attachment), which gives the power-law fan-out of a real referral
+programme; only users shallower than --max-depth can refer. Every user
+shares the same password so the load test can log in as anyone, and phone
+numbers follow phone_for(i).
+
+    python -m perf.seed --users 10000 --investments-per-user 3 --drop
+
+Refuses to touch anything but a local database unless --force is given.
+"""
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+import os
+import random
+import time
+from urllib.parse import urlparse
+import bcrypt
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from commission_config import DEFAULT_FOREX_REWARDS, init_commission_rates
+from forex_prices import BASE_PRICES
+from investment_history import create_history_collection, history_entry
+from rebuild_referral_earnings import rebuild_referral_earnings_summary
+
+DEFAULT_PASSWORD = 'loadtest-password'
+DEFAULT_URI = 'mongodb://localhost:27017/secure_auth_glass_loadtest'
+FOREX_PAIRS = list(DEFAULT_FOREX_REWARDS)
+BATCH_SIZE = 5000
+# Everything seed() writes plus everything the app and the benchmarked jobs
+# write on top of it, so --drop leaves no state from an earlier run
+SEEDED_COLLECTIONS = (
+    'users', 'investments', 'investment_history', 'investment_history_legacy', 'transactions',
+    'referral_history', 'referral_history_archive', 'referral_earnings_summary',
+    'referral_earnings_summary_rebuild', 'earnings_daily', 'referral_leaderboard', 'commission_rates',
+    'counters', 'migrations', 'cache_invalidations', 'user_events'
+)
+
+
+def phone_for(index):
+    return f'+2547{index:08d}'
+
+
+def referral_code_for(index):
+    return f'L{index:06X}'
+
+
+def _is_local(uri):
+    host = urlparse(uri).hostname or ''
+    return host in ('localhost', '127.0.0.1', '::1')
+
+
+def build_referral_tree(rng, users, root_fraction, attachment, max_depth):
+    """Referrer index (or None) and depth for every user.
+
+    With probability `attachment` a referrer is drawn proportionally to
+    (direct referrals + 1), otherwise uniformly; both draws are O(1) so
+    million-user trees stay cheap to build.
+    """
+    referrers = [None] * users
+    depths = [0] * users
+    eligible = []
+    # Each eligible user appears once per direct referral, plus once
+    attachment_pool = []
+
+    for i in range(users):
+        if eligible and rng.random() >= root_fraction:
+            pool = attachment_pool if rng.random() < attachment else eligible
+            parent = pool[rng.randrange(len(pool))]
+            referrers[i] = parent
+            depths[i] = depths[parent] + 1
+            attachment_pool.append(parent)
+        if depths[i] < max_depth:
+            eligible.append(i)
+            attachment_pool.append(i)
+    return referrers, depths
+
+
+def _flush(collection, docs):
+    if docs:
+        collection.insert_many(docs, ordered=False)
+        docs.clear()
+
+
+def investment_counts(rng, users, investments_per_user, total=None):
+    """Investments per user: exponential around the mean, or exactly `total` spread at random"""
+    if total is None:
+        if investments_per_user <= 0:
+            return [0] * users
+        return [int(rng.expovariate(1 / investments_per_user)) for _ in range(users)]
+    counts = [0] * users
+    for _ in range(total):
+        counts[rng.randrange(users)] += 1
+    return counts
+
+
+def seed(db, users=1000, investments_per_user=2.0, root_fraction=0.05, attachment=0.8,
+         max_depth=6, history_days=0, seed_value=42, password=DEFAULT_PASSWORD, drop=False,
+         total_investments=None):
+    rng = random.Random(seed_value)
+    started = time.monotonic()
+    now = datetime.utcnow()
+
+    if drop:
+        for name in SEEDED_COLLECTIONS:
+            db.drop_collection(name)
+    init_commission_rates(db)
+    create_history_collection(db)
+
+    # One hash shared by every synthetic user keeps seeding fast
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    referrers, depths = build_referral_tree(rng, users, root_fraction, attachment, max_depth)
+    user_ids = [ObjectId() for _ in range(users)]
+
+    batch = []
+    for i in range(users):
+        created_at = now - timedelta(days=rng.uniform(1, 180))
+        batch.append({
+            '_id': user_ids[i],
+            'username': f'loaduser{i}',
+            'phone': phone_for(i),
+            'password': password_hash,
+            'balance': round(rng.uniform(1000, 100000), 2),
+            'referralCode': referral_code_for(i),
+            'referredBy': user_ids[referrers[i]] if referrers[i] is not None else None,
+            'isActive': True,
+            'createdAt': created_at,
+            'updatedAt': created_at,
+            '__v': 0
+        })
+        if len(batch) >= BATCH_SIZE:
+            _flush(db.users, batch)
+    _flush(db.users, batch)
+
+    investments = []
+    history = []
+    rewards = []
+    investment_count = 0
+    counts = investment_counts(rng, users, investments_per_user, total_investments)
+    for i in range(users):
+        rewarded_pairs = set()
+        for _ in range(counts[i]):
+            pair = rng.choice(FOREX_PAIRS)
+            amount = round(rng.uniform(100, 10000), 2)
+            daily_roi = rng.choice([1.5, 2.0, 2.5, 3.0])
+            created_at = now - timedelta(days=rng.uniform(1, 90))
+            investment_id = ObjectId()
+            entry_price = round(BASE_PRICES[pair] * rng.uniform(0.98, 1.02), 5)
+            investments.append({
+                '_id': investment_id,
+                'userId': user_ids[i],
+                'forexPair': pair,
+                'amount': amount,
+                'dailyROI': daily_roi,
+                'entryPrice': entry_price,
+                'currentPrice': entry_price,
+                'status': 'active' if rng.random() < 0.9 else 'closed',
+                'profit': 0,
+                'createdAt': created_at
+            })
+            investment_count += 1
+            for day in range(history_days):
+                accrued_at = now - timedelta(days=day + 1)
+                history.append(history_entry(
+                    user_ids[i], investment_id, 'roi_earning', amount * daily_roi / 100, accrued_at,
+                    amount * daily_roi / 100 * (history_days - day)
+                ))
+            if referrers[i] is not None and pair not in rewarded_pairs:
+                rewarded_pairs.add(pair)
+                rewards.append({
+                    'referrerId': user_ids[referrers[i]],
+                    'referredId': user_ids[i],
+                    'type': 'one_time_reward',
+                    'forexPair': pair,
+                    'amount': DEFAULT_FOREX_REWARDS[pair],
+                    'createdAt': created_at
+                })
+        if len(investments) >= BATCH_SIZE:
+            _flush(db.investments, investments)
+        if len(history) >= BATCH_SIZE:
+            _flush(db.investment_history, history)
+        if len(rewards) >= BATCH_SIZE:
+            _flush(db.referral_history, rewards)
+    _flush(db.investments, investments)
+    _flush(db.investment_history, history)
+    _flush(db.referral_history, rewards)
+    rebuild_referral_earnings_summary(db)
+
+    summary = {
+        'users': users,
+        'investments': investment_count,
+        'max_depth': max(depths) if depths else 0,
+        'max_fanout': max(Counter(r for r in referrers if r is not None).values(), default=0),
+        'seconds': round(time.monotonic() - started, 2)
+    }
+    print(f"Seeded {summary['users']} users and {summary['investments']} investments "
+          f"(max depth {summary['max_depth']}, max fan-out {summary['max_fanout']}) "
+          f"in {summary['seconds']}s")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a synthetic dataset for load tests and benchmarks')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--investments-per-user', type=float, default=2.0, help='Mean of an exponential distribution')
+    parser.add_argument('--investments', type=int, help='Exact number of investments instead of a per-user mean')
+    parser.add_argument('--root-fraction', type=float, default=0.05, help='Share of users who joined without a referrer')
+    parser.add_argument('--attachment', type=float, default=0.8,
+                        help='Share of referrers picked by preferential attachment (0 = uniform)')
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--history-days', type=int, default=0, help='ROI accrual rows per investment')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--password', default=DEFAULT_PASSWORD)
+    parser.add_argument('--drop', action='store_true', help='Drop the seeded collections first')
+    parser.add_argument('--force', action='store_true', help='Allow a non-local MONGODB_URI')
+    args = parser.parse_args()
+
+    load_dotenv()
+    uri = os.getenv('LOADTEST_MONGODB_URI', DEFAULT_URI)
+    if not _is_local(uri) and not args.force:
+        parser.error(f'refusing to seed non-local database {uri} without --force')
+
+    db = MongoClient(uri).get_default_database()
+    seed(db, args.users, args.investments_per_user, args.root_fraction, args.attachment,
+         args.max_depth, args.history_days, args.seed, args.password, args.drop, args.investments)
+
+
+if __name__ == '__main__':
+    main()
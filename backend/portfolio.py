@@ -0,0 +1,177 @@
+"""Portfolio value time series used by the dashboard chart"""
+from collections import OrderedDict
+from datetime import datetime
+import threading
+from bson.objectid import ObjectId
+from invalidation_bus import publish_invalidation, register_invalidation_handler
+from investment_history import find_user_history, latest_user_entry_time
+
+DEFAULT_SERIES_POINTS = 200
+MAX_SERIES_POINTS = 1000
+MIN_SERIES_POINTS = 3
+EPOCH = datetime(1970, 1, 1)
+
+# Per-worker cache of downsampled series, keyed by user id
+SERIES_CACHE_SIZE = 5000
+_series_cache = OrderedDict()
+_series_cache_lock = threading.Lock()
+
+
+def _event_time(doc, field='createdAt'):
+    """Timestamp of a document, falling back to its ObjectId creation time"""
+    value = doc.get(field)
+    if isinstance(value, datetime):
+        return value
+    return doc['_id'].generation_time.replace(tzinfo=None)
+
+
+def lttb(points, threshold, value=lambda p: p[1]):
+    """Downsample points (sorted by x = p[0]) with Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept; every bucket in between
+    contributes the point forming the largest triangle with the previously
+    selected point and the average of the next bucket, which preserves peaks
+    and troughs of the series.
+    """
+    length = len(points)
+    if threshold >= length or threshold < MIN_SERIES_POINTS:
+        return list(points)
+
+    sampled = [points[0]]
+    bucket_size = (length - 2) / (threshold - 2)
+    selected = 0
+
+    for i in range(threshold - 2):
+        # Average point of the next bucket
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, length)
+        next_count = next_end - next_start
+        avg_x = sum(points[j][0] for j in range(next_start, next_end)) / next_count
+        avg_y = sum(value(points[j]) for j in range(next_start, next_end)) / next_count
+
+        # Pick the point in the current bucket with the largest triangle area
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax = points[selected][0]
+        ay = value(points[selected])
+        max_area = -1
+        max_index = start
+        for j in range(start, end):
+            area = abs(
+                (ax - avg_x) * (value(points[j]) - ay)
+                - (ax - points[j][0]) * (avg_y - ay)
+            )
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        sampled.append(points[max_index])
+        selected = max_index
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def build_portfolio_series(db, user_id):
+    """Reconstruct (timestamp_ms, balance, invested) points for a user"""
+    user_oid = ObjectId(user_id)
+    events = []
+
+    # Completed deposits and withdrawals move the cash balance
+    for t in db.transactions.find(
+        {'user_id': str(user_id), 'status': 'completed'},
+        {'type': 1, 'amount': 1, 'createdAt': 1}
+    ):
+        amount = float(t.get('amount', 0))
+        if t.get('type') == 'withdraw':
+            amount = -amount
+        events.append((_event_time(t), amount, 0.0))
+
+    # Opening an investment moves cash into the invested bucket, closing it moves
+    # the principal back; profit reaches the balance through the daily accruals below
+    for inv in db.investments.find(
+        {'userId': user_oid},
+        {'amount': 1, 'createdAt': 1, 'closedAt': 1}
+    ):
+        amount = float(inv.get('amount', 0))
+        events.append((_event_time(inv), -amount, amount))
+        if isinstance(inv.get('closedAt'), datetime):
+            events.append((inv['closedAt'], amount, -amount))
+
+    # Daily ROI accruals are credited straight to the balance
+    for entry in find_user_history(db, user_oid, {'type': 'roi_earning'}, {'amount': 1, 'createdAt': 1}):
+        events.append((_event_time(entry), float(entry.get('amount', 0)), 0.0))
+
+    events.sort(key=lambda e: e[0])
+
+    points = []
+    balance = 0.0
+    invested = 0.0
+    for timestamp, balance_delta, invested_delta in events:
+        balance += balance_delta
+        invested += invested_delta
+        x = int((timestamp - EPOCH).total_seconds() * 1000)
+        # Collapse events sharing a timestamp into a single point
+        if points and points[-1][0] == x:
+            points[-1] = (x, balance, invested)
+        else:
+            points.append((x, balance, invested))
+    return points
+
+
+def _latest_accrual(db, user_id):
+    """Creation time of the user's latest ROI accrual, used as the cache stamp"""
+    return latest_user_entry_time(db, user_id)
+
+
+def get_portfolio_series(db, user_id, points=DEFAULT_SERIES_POINTS):
+    """Downsampled portfolio series for a user, cached until the next accrual"""
+    points = max(MIN_SERIES_POINTS, min(int(points), MAX_SERIES_POINTS))
+    user_id = str(user_id)
+    stamp = _latest_accrual(db, user_id)
+
+    with _series_cache_lock:
+        cached = _series_cache.get(user_id)
+        if cached and cached['stamp'] == stamp and points in cached['series']:
+            _series_cache.move_to_end(user_id)
+            return cached['series'][points]
+
+    full_series = build_portfolio_series(db, user_id)
+    sampled = lttb(full_series, points, value=lambda p: p[1] + p[2])
+    series = [
+        {
+            'timestamp': datetime.utcfromtimestamp(x / 1000).isoformat(),
+            'balance': round(balance, 2),
+            'invested': round(invested, 2),
+            'value': round(balance + invested, 2)
+        }
+        for x, balance, invested in sampled
+    ]
+
+    with _series_cache_lock:
+        cached = _series_cache.get(user_id)
+        if not cached or cached['stamp'] != stamp:
+            cached = {'stamp': stamp, 'series': {}}
+            _series_cache[user_id] = cached
+        cached['series'][points] = series
+        _series_cache.move_to_end(user_id)
+        while len(_series_cache) > SERIES_CACHE_SIZE:
+            _series_cache.popitem(last=False)
+
+    return series
+
+
+def _apply_invalidation(key):
+    with _series_cache_lock:
+        if key is None:
+            _series_cache.clear()
+        else:
+            _series_cache.pop(key, None)
+
+
+register_invalidation_handler('portfolio_series', _apply_invalidation)
+
+
+def invalidate_portfolio_series(user_id=None):
+    """Drop cached series for one user, or for everyone, in every worker"""
+    publish_invalidation('portfolio_series', None if user_id is None else str(user_id))
@@ -0,0 +1,105 @@
+"""Recompute referral_earnings_summary from the referral_history ledger.
+
+The referrer ids in the ledger are split into --partitions ranges of similar
+size with $bucketAuto, and --workers threads aggregate one range at a time
+into a staging collection with $merge. When every range is done the staging
+collection replaces the live summary in one rename, so readers never see a
+half-built summary, and the summary is marked as built.
+
+Rewards credited while the rebuild runs land in the old summary and are lost
+by the swap; run it when the commission job is not running and re-run it if
+in doubt.
+
+    python rebuild_referral_earnings.py --workers 8
+    python rebuild_referral_earnings.py --dry-run
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from referral_earnings import COLLECTION, mark_summary_built, summary_pipeline
+
+STAGING_COLLECTION = COLLECTION + '_rebuild'
+
+
+def referrer_ranges(db, partitions):
+    """[(min, max, last)] referrerId ranges covering every referrer.
+
+    $bucketAuto bounds are [min, max) except for the last bucket, whose max
+    is its largest referrerId, so only the last range includes its max.
+    """
+    buckets = list(db.referral_history.aggregate([
+        {'$match': {'referrerId': {'$ne': None}}},
+        {'$group': {'_id': '$referrerId'}},
+        {'$bucketAuto': {'groupBy': '$_id', 'buckets': partitions}}
+    ], allowDiskUse=True))
+    return [
+        (bucket['_id']['min'], bucket['_id']['max'], index == len(buckets) - 1)
+        for index, bucket in enumerate(buckets)
+    ]
+
+
+def rebuild_range(db, low, high, last, target):
+    started = time.monotonic()
+    match = {'referrerId': {'$gte': low, '$lte' if last else '$lt': high}}
+    # Rows without a referred user would give $merge a null key
+    pipeline = summary_pipeline(dict(match, **{'$or': [
+        {'referredId': {'$ne': None}}, {'userId': {'$ne': None}}
+    ]}))
+    if target is not None:
+        pipeline.append({'$merge': {
+            'into': target,
+            'on': ['referrerId', 'referredId'],
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert'
+        }})
+        list(db.referral_history.aggregate(pipeline, allowDiskUse=True))
+        rows = db[target].count_documents(match)
+    else:
+        rows = sum(1 for _ in db.referral_history.aggregate(pipeline, allowDiskUse=True))
+    return rows, time.monotonic() - started
+
+
+def rebuild_referral_earnings_summary(db, workers=4, partitions=None, dry_run=False):
+    """Rebuild the summary from the ledger; returns the number of summary rows"""
+    started = time.monotonic()
+    ranges = referrer_ranges(db, partitions or workers * 4)
+    target = None if dry_run else STAGING_COLLECTION
+    if target is not None:
+        db.drop_collection(target)
+        db[target].create_index([('referrerId', 1), ('referredId', 1)], unique=True)
+
+    print(f"Rebuilding {COLLECTION} from {len(ranges)} referrer ranges with {workers} workers"
+          f"{' (dry run)' if dry_run else ''}")
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(rebuild_range, db, low, high, last, target) for low, high, last in ranges]
+        for done, future in enumerate(futures, 1):
+            rows, seconds = future.result()
+            total += rows
+            print(f"Range {done}/{len(ranges)}: {rows} rows in {seconds:.1f}s")
+
+    if target is not None:
+        db[target].rename(COLLECTION, dropTarget=True)
+        mark_summary_built(db)
+    print(f"Rebuilt {total} summary rows in {time.monotonic() - started:.1f}s")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild referral_earnings_summary from referral_history')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--partitions', type=int, default=None, help='Referrer ranges (default: 4 per worker)')
+    parser.add_argument('--dry-run', action='store_true', help='Aggregate without writing')
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/secure_auth_glass'))
+    db = client.get_default_database()
+    rebuild_referral_earnings_summary(db, args.workers, args.partitions, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
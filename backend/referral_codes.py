@@ -0,0 +1,86 @@
+"""Collision-free referral code allocation.
+
+Codes come from a global counter instead of random draws, so registration
+never has to check whether a code is taken. Each process reserves a block of
+REFERRAL_CODE_BLOCK numbers at a time with one atomic $inc on the `counters`
+collection and hands them out from memory, so the counter costs one round
+trip per block, not per registration.
+
+Every number is passed through a bijective scramble of the 30-bit space,
+so consecutive users do not get guessable neighbouring codes, and is then
+written in Crockford Base32 (no I, L, O or U). 32^6 = 2^30, so codes stay
+six characters long for the first billion users. A unique index on
+users.referralCode is the backstop against codes handed out before the
+allocator existed.
+"""
+import os
+import threading
+from pymongo import ReturnDocument
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+CODE_LENGTH = 6
+CODE_BITS = 30
+CODE_MASK = (1 << CODE_BITS) - 1
+# Odd multiplier and xor mask: n -> ((n ^ XOR) * MUL) mod 2^30 is a bijection
+SCRAMBLE_XOR = 0x2A5F3C1
+SCRAMBLE_MUL = 0x1F3A5B7
+
+COUNTER_ID = 'referral_code'
+BLOCK_SIZE = int(os.getenv('REFERRAL_CODE_BLOCK', '1000'))
+
+
+def scramble(n):
+    """Bijective on [0, 2^30); larger numbers keep their high bits"""
+    high, low = n >> CODE_BITS, n & CODE_MASK
+    return (high << CODE_BITS) | (((low ^ SCRAMBLE_XOR) * SCRAMBLE_MUL) & CODE_MASK)
+
+
+def encode(n, length=CODE_LENGTH):
+    chars = []
+    while n or len(chars) < length:
+        n, digit = divmod(n, 32)
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def referral_code(n):
+    return encode(scramble(n))
+
+
+class ReferralCodeAllocator:
+    """Hands out counter values from blocks reserved in Mongo"""
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self._pid = None
+
+    def _reserve(self, db):
+        counter = db.counters.find_one_and_update(
+            {'_id': COUNTER_ID},
+            {'$inc': {'next': self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._end = counter['next']
+        self._next = self._end - self.block_size
+        self._pid = os.getpid()
+
+    def allocate(self, db):
+        with self._lock:
+            # A forked child must not reuse its parent's block
+            if self._next >= self._end or self._pid != os.getpid():
+                self._reserve(db)
+            n = self._next
+            self._next += 1
+        return referral_code(n)
+
+
+allocator = ReferralCodeAllocator()
+
+
+def allocate_referral_code(db):
+    """A referral code no other user has been or will be given by the allocator"""
+    return allocator.allocate(db)
@@ -0,0 +1,159 @@
+"""Nightly compaction of old daily commission rows in referral_history.
+
+The commission job writes up to three ledger rows per investor per day. Rows
+older than REFERRAL_HISTORY_COMPACT_AFTER_DAYS (default 90) are folded into
+one bucket row per (referrerId, referredId, month) and moved to the cold
+`referral_history_archive` collection.
+
+A bucket keeps the shape of the rows it replaces: it is a `daily_commission`
+row whose `amount` is the sum of the folded rows, so anything that sums the
+ledger by type (the summary rebuild, for one) reads the same totals before
+and after compaction. Bucket rows are marked with `bucket: true` and also
+carry `month`, the number of folded `rows` and the first and last `date`.
+
+Each batch of COMPACTION_BATCH rows is archived, bucketed and deleted in one
+transaction where the server supports them. Buckets are always recomputed
+from everything archived for their month, so a batch interrupted part way
+(possible on a standalone server, which has no transactions) is simply
+redone by the next run without counting any row twice, and a later run that
+reaches the same month extends the existing bucket.
+"""
+from datetime import datetime, timedelta
+import os
+import time
+from prometheus_client import Counter, Histogram
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from app_logging import get_logger
+from database import db, run_transaction
+
+logger = get_logger('referral_compaction')
+
+ARCHIVE_COLLECTION = 'referral_history_archive'
+COMPACT_AFTER_DAYS = int(os.getenv('REFERRAL_HISTORY_COMPACT_AFTER_DAYS', '90'))
+BATCH_SIZE = int(os.getenv('COMPACTION_BATCH', '5000'))
+DUPLICATE_KEY = 11000
+
+COMPACTION_DURATION = Histogram(
+    'referral_compaction_duration_seconds', 'Time to compact old referral_history rows',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+)
+ROWS_COMPACTED = Counter(
+    'referral_history_rows_compacted_total', 'Daily commission rows folded into monthly buckets'
+)
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def compactable_filter(cutoff):
+    return {'type': 'daily_commission', 'bucket': {'$exists': False}, 'date': {'$lt': cutoff}}
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def bucket_updates(db, rows, now, session=None):
+    """Upserts setting each bucket a batch touches to the totals of its archived rows.
+
+    Buckets are recomputed from the archive rather than incremented, so
+    repeating a batch after an interruption leaves them unchanged.
+    """
+    keys = {(row['referrerId'], row['referredId'], month_start(row['date'])) for row in rows}
+    months = [month for _, _, month in keys]
+    totals = db[ARCHIVE_COLLECTION].aggregate([
+        {'$match': {
+            'referrerId': {'$in': list({key[0] for key in keys})},
+            'referredId': {'$in': list({key[1] for key in keys})},
+            'date': {'$gte': min(months), '$lt': _next_month(max(months))}
+        }},
+        {'$group': {
+            '_id': {
+                'referrerId': '$referrerId',
+                'referredId': '$referredId',
+                'month': {'$dateFromParts': {'year': {'$year': '$date'}, 'month': {'$month': '$date'}}}
+            },
+            'amount': {'$sum': '$amount'},
+            'rows': {'$sum': 1},
+            'first': {'$min': '$date'},
+            'last': {'$max': '$date'},
+            'level': {'$first': '$level'}
+        }}
+    ], session=session)
+    updates = []
+    for bucket in totals:
+        key = (bucket['_id']['referrerId'], bucket['_id']['referredId'], bucket['_id']['month'])
+        if key not in keys:
+            continue
+        referrer_id, referred_id, month = key
+        updates.append(UpdateOne(
+            {'referrerId': referrer_id, 'referredId': referred_id, 'month': month, 'bucket': True},
+            {
+                '$set': {
+                    'amount': bucket['amount'],
+                    'rows': bucket['rows'],
+                    'date': bucket['first'],
+                    'lastDate': bucket['last'],
+                    'compactedAt': now
+                },
+                '$setOnInsert': {'type': 'daily_commission', 'level': bucket['level'], 'createdAt': now}
+            },
+            upsert=True
+        ))
+    return updates
+
+
+def _archive(db, rows, session):
+    """Copy raw rows to the archive; rows already there from an interrupted run are skipped"""
+    try:
+        db[ARCHIVE_COLLECTION].insert_many(rows, ordered=False, session=session)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+            raise
+
+
+def _compact_batch(db, rows, now):
+    def compact(session):
+        # Archive first: every step after it can be repeated without changing the result
+        _archive(db, rows, session)
+        updates = bucket_updates(db, rows, now, session)
+        if updates:
+            db.referral_history.bulk_write(updates, ordered=False, session=session)
+        db.referral_history.delete_many({'_id': {'$in': [row['_id'] for row in rows]}}, session=session)
+
+    run_transaction(compact)
+
+
+def compact_referral_history(db, older_than_days=COMPACT_AFTER_DAYS, batch_size=BATCH_SIZE, now=None):
+    """Fold daily commission rows dated before the cutoff into monthly buckets"""
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+    cutoff = (now - timedelta(days=older_than_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    compacted = 0
+
+    while True:
+        rows = list(db.referral_history.find(compactable_filter(cutoff)).sort('date', 1).limit(batch_size))
+        if not rows:
+            break
+        _compact_batch(db, rows, now)
+        compacted += len(rows)
+        ROWS_COMPACTED.inc(len(rows))
+
+    elapsed = time.perf_counter() - started
+    COMPACTION_DURATION.observe(elapsed)
+    logger.info('Referral history compaction completed', extra={
+        'cutoff': cutoff.isoformat(),
+        'rows': compacted,
+        'seconds': round(elapsed, 3)
+    })
+    return compacted
+
+
+def run_referral_compaction():
+    """Scheduler entry point"""
+    try:
+        compact_referral_history(db)
+    except Exception:
+        logger.exception('Referral history compaction failed')
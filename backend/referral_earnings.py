@@ -0,0 +1,143 @@
+"""Per-referrer running totals of referral earnings.
+
+`referral_history` is the ledger: one row per one-time reward and per daily
+commission. Reading earnings from it means summing a referrer's whole
+history on every request, so the writers of ledger rows also $inc a summary
+row in `referral_earnings_summary`, one per (referrerId, referredId), holding
+the one-time and daily totals. Earnings reads are then a single indexed
+fetch of a referrer's summary rows.
+
+The summary can always be recomputed from the ledger with
+rebuild_referral_earnings.py, which also records in `migrations` that it has
+been built. A database whose ledger predates the summary has no such record:
+a process that starts against it reads earnings from the ledger itself, so
+existing referrers do not read 0, and switches to the summary on its next
+start after the rebuild.
+"""
+from datetime import datetime
+from pymongo import UpdateOne
+from app_logging import get_logger
+
+logger = get_logger('referral_earnings')
+
+COLLECTION = 'referral_earnings_summary'
+MIGRATION_ID = 'referral_earnings_summary'
+
+# Set at startup while the summary has not been built from the ledger
+_read_ledger = False
+
+# Ledger type -> summary field
+TYPE_FIELDS = {
+    'one_time_reward': 'oneTimeRewards',
+    'daily_commission': 'dailyCommissions'
+}
+
+
+def _amount_of(reward_type):
+    return {'$sum': {'$cond': [{'$eq': ['$type', reward_type]}, '$amount', 0]}}
+
+
+def summary_pipeline(match):
+    """Ledger rows matching `match`, folded into summary rows"""
+    return [
+        {'$match': match},
+        {'$group': {
+            # Older one-time rewards recorded the referred user as userId. Compacted
+            # monthly buckets are daily_commission rows carrying their summed amount.
+            '_id': {'referrerId': '$referrerId', 'referredId': {'$ifNull': ['$referredId', '$userId']}},
+            'oneTimeRewards': _amount_of('one_time_reward'),
+            'dailyCommissions': _amount_of('daily_commission'),
+            'total': {'$sum': '$amount'}
+        }},
+        {'$project': {
+            '_id': 0,
+            'referrerId': '$_id.referrerId',
+            'referredId': '$_id.referredId',
+            'oneTimeRewards': 1,
+            'dailyCommissions': 1,
+            'total': 1,
+            'updatedAt': '$$NOW'
+        }}
+    ]
+
+
+def mark_summary_built(db):
+    db.migrations.update_one(
+        {'_id': MIGRATION_ID},
+        {'$set': {'completedAt': datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def ensure_referral_earnings_summary(db):
+    """Read from the ledger until the summary has been built once"""
+    global _read_ledger
+    if db.migrations.find_one({'_id': MIGRATION_ID}, {'_id': 1}):
+        _read_ledger = False
+    elif db.referral_history.find_one({}, {'_id': 1}) is None:
+        # Nothing to build from: the writers keep the summary complete from here on
+        mark_summary_built(db)
+        _read_ledger = False
+    else:
+        _read_ledger = True
+        logger.warning('referral_earnings_summary has not been built; reading referral_history until '
+                       'rebuild_referral_earnings.py has run')
+
+
+def _summary_inc(referrer_id, referred_id, reward_type, amount, now):
+    return (
+        {'referrerId': referrer_id, 'referredId': referred_id},
+        {
+            '$inc': {TYPE_FIELDS[reward_type]: amount, 'total': amount},
+            '$set': {'updatedAt': now}
+        }
+    )
+
+
+def summary_update(referrer_id, referred_id, reward_type, amount, now=None):
+    """Upserting $inc of one (referrer, referred) row by a ledger amount"""
+    return UpdateOne(*_summary_inc(referrer_id, referred_id, reward_type, amount, now or datetime.utcnow()), upsert=True)
+
+
+def record_referral_earning(db, referrer_id, referred_id, reward_type, amount):
+    db[COLLECTION].update_one(
+        *_summary_inc(referrer_id, referred_id, reward_type, amount, datetime.utcnow()), upsert=True
+    )
+
+
+def record_referral_earnings(db, totals):
+    """Apply {(referrerId, referredId, type): amount} in one bulk write"""
+    if not totals:
+        return
+    now = datetime.utcnow()
+    db[COLLECTION].bulk_write([
+        summary_update(referrer_id, referred_id, reward_type, amount, now)
+        for (referrer_id, referred_id, reward_type), amount in totals.items()
+    ], ordered=False)
+
+
+def get_referral_earnings(db, referrer_id):
+    """{referredId: {'oneTimeRewards', 'dailyCommissions'}} for one referrer"""
+    if _read_ledger:
+        rows = db.referral_history.aggregate(summary_pipeline({'referrerId': referrer_id}))
+    else:
+        rows = db[COLLECTION].find(
+            {'referrerId': referrer_id},
+            {'_id': 0, 'referredId': 1, 'oneTimeRewards': 1, 'dailyCommissions': 1}
+        )
+    return {
+        row['referredId']: {
+            'oneTimeRewards': row.get('oneTimeRewards', 0),
+            'dailyCommissions': row.get('dailyCommissions', 0)
+        }
+        for row in rows
+    }
+
+
+def get_referral_earnings_total(db, referrer_id):
+    source, amount = ('referral_history', '$amount') if _read_ledger else (COLLECTION, '$total')
+    result = list(db[source].aggregate([
+        {'$match': {'referrerId': referrer_id}},
+        {'$group': {'_id': None, 'total': {'$sum': amount}}}
+    ]))
+    return result[0]['total'] if result else 0
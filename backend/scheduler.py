@@ -1,7 +1,14 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from app import calculate_daily_referral_commissions, calculate_daily_roi_earnings
+from apscheduler.triggers.interval import IntervalTrigger
+from investment_lifecycle import run_maturity_sweep
+from jobs import calculate_daily_referral_commissions, calculate_daily_roi_earnings
+from leaderboard import DOWNLINE_SYNC_INTERVAL, run_leaderboard_sync
+from referral_compaction import run_referral_compaction
+from mark_to_market import MARK_INTERVAL, run_mark_to_market
 import logging
+import os
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +37,50 @@ def start_scheduler():
             replace_existing=True
         )
         
+        # Close matured investments after the day's ROI has been credited
+        scheduler.add_job(
+            run_maturity_sweep,
+            trigger=CronTrigger(hour=0, minute=30),
+            id='maturity_sweep',
+            name='Close matured investments',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
+        # Fold old daily commission rows into monthly buckets once the night's rows are in
+        scheduler.add_job(
+            run_referral_compaction,
+            trigger=CronTrigger(hour=1, minute=0),
+            id='referral_history_compaction',
+            name='Compact referral history',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
+        # Count new registrations towards their referrer's leaderboard downline
+        scheduler.add_job(
+            run_leaderboard_sync,
+            trigger=IntervalTrigger(seconds=DOWNLINE_SYNC_INTERVAL),
+            id='leaderboard_downline_sync',
+            name='Sync leaderboard downline counts',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
+        # Revalue open investments against live prices
+        scheduler.add_job(
+            run_mark_to_market,
+            trigger=IntervalTrigger(seconds=MARK_INTERVAL),
+            id='mark_to_market',
+            name='Mark open investments to market',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
         # Start the scheduler
         scheduler.start()
         logger.info("Scheduler started successfully with ROI and commission jobs")
@@ -37,3 +88,19 @@ def start_scheduler():
     except Exception as e:
         logger.error(f"Error starting scheduler: {str(e)}")
         raise
+
+if __name__ == '__main__':
+    # Standalone scheduler process: jobs only, no Flask app
+    from dotenv import load_dotenv
+    from app_logging import configure_logging
+    from database import get_db, init_process
+    from forex_prices import start_price_producer
+    load_dotenv()
+    configure_logging()
+    init_process()
+    start_scheduler()
+    # The scheduler is a singleton, so it also hosts the one forex price producer
+    if os.getenv('FOREX_PRICE_PRODUCER', '1') == '1':
+        start_price_producer(get_db())
+    while True:
+        time.sleep(3600)
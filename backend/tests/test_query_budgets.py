@@ -0,0 +1,82 @@
+"""Route query budgets, checked against a real MongoDB.
+
+Uses MONGODB_TEST_URI (default: a local secure_auth_glass_test database) and
+is skipped when no server answers there. Budgets are strict in these tests,
+so a route that issues more commands than it declares fails with
+QueryBudgetExceeded.
+"""
+import os
+import sys
+from datetime import datetime
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+TEST_URI = os.getenv('MONGODB_TEST_URI', 'mongodb://localhost:27017/secure_auth_glass_test')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['MONGODB_URI'] = TEST_URI
+os.environ['MONGO_QUERY_BUDGET_STRICT'] = '1'
+
+
+@pytest.fixture(scope='module')
+def mongo():
+    probe = MongoClient(TEST_URI, serverSelectionTimeoutMS=1000)
+    try:
+        probe.admin.command('ping')
+    except PyMongoError:
+        pytest.skip(f'MongoDB is not reachable at {TEST_URI}')
+    finally:
+        probe.close()
+    from database import get_client, get_db
+    database = get_db()
+    yield database
+    get_client().drop_database(database.name)
+
+
+@pytest.fixture(scope='module')
+def app(mongo):
+    from app import create_app
+    # No init_process() here: the first request runs it, outside its budget
+    app = create_app()
+    app.testing = True
+    # The test client talks plain http to localhost
+    app.config['SESSION_COOKIE_DOMAIN'] = None
+    app.config['SESSION_COOKIE_SECURE'] = False
+    return app
+
+
+@pytest.fixture
+def user_id(mongo):
+    now = datetime.utcnow()
+    result = mongo.users.insert_one({
+        'username': 'budget-test',
+        'phone': f'+1555{now.microsecond:06d}',
+        'password': b'not-a-hash',
+        'balance': 0,
+        'referralCode': f'BT{now.microsecond:06d}',
+        'referredBy': None,
+        'isActive': True,
+        'createdAt': now,
+        'updatedAt': now
+    })
+    yield str(result.inserted_id)
+    mongo.users.delete_one({'_id': result.inserted_id})
+
+
+@pytest.fixture
+def client(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    return client
+
+
+def test_update_profile_within_budget_on_cold_cache(client):
+    from user_cache import user_cache
+    user_cache.clear()
+
+    response = client.put('/api/users/profile', json={'username': 'renamed'})
+
+    assert response.status_code == 200
+    assert response.get_json()['user']['username'] == 'renamed'
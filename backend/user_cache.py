@@ -0,0 +1,119 @@
+"""Per-worker cache of projected user snapshots.
+
+login_required and /api/auth/verify need the current user on every request
+but never the password hash or anything else outside USER_SNAPSHOT_FIELDS.
+Snapshots are kept in an LRU for a short TTL (USER_CACHE_TTL seconds,
+USER_CACHE_SIZE entries) and dropped explicitly by every code path that
+changes a balance, so the TTL only bounds staleness for writes made by other
+processes.
+Invalidations are broadcast to the other workers over the invalidation bus.
+
+Snapshots must not be used for balance checks that guard a write; read the
+user document (or use a conditional update) there instead.
+"""
+from collections import OrderedDict
+import os
+import threading
+import time
+from bson.objectid import ObjectId
+from prometheus_client import Counter
+from invalidation_bus import publish_invalidation, register_invalidation_handler
+
+USER_SNAPSHOT_FIELDS = {
+    'username': 1,
+    'phone': 1,
+    'balance': 1,
+    'referralCode': 1,
+    'referredBy': 1,
+    'isActive': 1,
+    'createdAt': 1,
+    'updatedAt': 1
+}
+
+USER_CACHE_REQUESTS = Counter(
+    'user_cache_requests_total', 'User snapshot cache lookups',
+    ['result']
+)
+USER_CACHE_INVALIDATIONS = Counter(
+    'user_cache_invalidations_total', 'User snapshot cache invalidations',
+    ['scope']
+)
+
+
+class UserSnapshotCache:
+    """LRU of user snapshots with a fixed time to live"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with one is not stored
+        self._generation = 0
+
+    def get(self, db, user_id):
+        key = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                USER_CACHE_REQUESTS.labels('hit').inc()
+                return entry[1]
+            generation = self._generation
+
+        USER_CACHE_REQUESTS.labels('miss').inc()
+        snapshot = db.users.find_one({'_id': ObjectId(key)}, USER_SNAPSHOT_FIELDS)
+        if snapshot is None:
+            return None
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, snapshot)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        USER_CACHE_INVALIDATIONS.labels('user').inc()
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(str(user_id), None)
+
+    def clear(self):
+        USER_CACHE_INVALIDATIONS.labels('all').inc()
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+user_cache = UserSnapshotCache(
+    max_size=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USER_CACHE_TTL', '5'))
+)
+
+
+def get_user_snapshot(db, user_id):
+    """Projected user document, served from the cache when fresh"""
+    return user_cache.get(db, user_id)
+
+
+def _apply_invalidation(key):
+    if key is None:
+        user_cache.clear()
+    else:
+        user_cache.invalidate(key)
+
+
+register_invalidation_handler('user', _apply_invalidation)
+
+
+def invalidate_user(user_id):
+    """Drop one user's snapshot in every worker after a write that changes it"""
+    publish_invalidation('user', str(user_id))
+
+
+def invalidate_all_users():
+    """Drop every snapshot in every worker, e.g. after a job that touched many balances"""
+    publish_invalidation('user')
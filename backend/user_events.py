@@ -0,0 +1,241 @@
+"""Per-user event channel streamed to the browser over SSE.
+
+Write paths and jobs call publish_user_event() when a user's balance, one of
+their investments or their referral rewards change. Events are appended to
+the capped `user_events` collection, so every worker on every node sees
+them. Each worker tails that collection from one background thread and hands
+events to the streams of users connected to it.
+
+Every stream has a bounded queue (USER_EVENTS_QUEUE_SIZE events). A client
+that falls that far behind gets a `resync` event instead of the dropped
+ones and should refetch its state. Event ids are the ObjectIds of the
+stored events. A reconnecting client sends Last-Event-ID and gets the events
+it missed replayed, as long as the capped collection still holds them;
+otherwise it also gets `resync`.
+
+Events come from every worker, and ObjectIds minted by different processes
+are not ordered by insertion, so nothing here compares event ids: the hub
+tails in insertion order with capped_tail, and a replay orders events by
+their record id, which in a capped collection follows insertion order.
+"""
+from collections import deque
+from datetime import datetime
+import json
+import os
+import threading
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from prometheus_client import Counter, Gauge
+from pymongo import ASCENDING
+from pymongo.errors import CollectionInvalid, PyMongoError
+from app_logging import get_logger
+from capped_tail import RESUME_WINDOW, tail_capped
+
+logger = get_logger('user_events')
+
+COLLECTION = 'user_events'
+CAPPED_SIZE_BYTES = 64 * 1024 * 1024
+CAPPED_MAX_DOCS = 500000
+QUEUE_SIZE = int(os.getenv('USER_EVENTS_QUEUE_SIZE', '100'))
+REPLAY_LIMIT = 500
+STREAM_HEARTBEAT = 15
+PUBLISH_BATCH_SIZE = 1000
+
+USER_EVENTS_PUBLISHED = Counter(
+    'user_events_published_total', 'User events published',
+    ['type']
+)
+USER_EVENTS_DROPPED = Counter(
+    'user_events_dropped_total', 'User events dropped from full stream queues'
+)
+USER_EVENT_STREAMS = Gauge(
+    'user_event_streams', 'Connected user event streams',
+    multiprocess_mode='livesum'
+)
+
+
+def _event_doc(user_id, event_type, data):
+    return {'userId': str(user_id), 'type': event_type, 'data': data, 'ts': datetime.utcnow()}
+
+
+def publish_user_event(db, user_id, event_type, data):
+    """Append one event for a user; failures are logged, never raised"""
+    try:
+        db[COLLECTION].insert_one(_event_doc(user_id, event_type, data))
+        USER_EVENTS_PUBLISHED.labels(event_type).inc()
+    except PyMongoError:
+        logger.exception('Failed to publish user event', extra={'user_id': str(user_id), 'type': event_type})
+
+
+def publish_user_events(db, events):
+    """Append many (user_id, type, data) events, e.g. at the end of a job"""
+    batch = []
+    for user_id, event_type, data in events:
+        batch.append(_event_doc(user_id, event_type, data))
+        if len(batch) >= PUBLISH_BATCH_SIZE:
+            _insert_batch(db, batch)
+            batch = []
+    if batch:
+        _insert_batch(db, batch)
+
+
+def _insert_batch(db, batch):
+    try:
+        db[COLLECTION].insert_many(batch, ordered=False)
+        for doc in batch:
+            USER_EVENTS_PUBLISHED.labels(doc['type']).inc()
+    except PyMongoError:
+        logger.exception('Failed to publish user events', extra={'events': len(batch)})
+
+
+class EventStream:
+    """One connected client: a bounded queue and a wake-up event"""
+
+    def __init__(self, user_id, max_size=QUEUE_SIZE):
+        self.user_id = user_id
+        self.max_size = max_size
+        self.queue = deque()
+        self.overflowed = False
+        self._ready = threading.Event()
+
+    def push(self, event):
+        if len(self.queue) >= self.max_size:
+            # Drop the backlog; the client refetches its state on resync
+            USER_EVENTS_DROPPED.inc(len(self.queue) + 1)
+            self.queue.clear()
+            self.overflowed = True
+        else:
+            self.queue.append(event)
+        self._ready.set()
+
+    def drain(self, timeout):
+        """Queued events (and whether any were dropped), waiting up to `timeout`"""
+        if not self.queue and not self.overflowed:
+            self._ready.wait(timeout)
+        self._ready.clear()
+        events, self.queue = self.queue, deque()
+        overflowed, self.overflowed = self.overflowed, False
+        return events, overflowed
+
+
+class UserEventHub:
+    """Tails user_events and dispatches to the streams connected to this process"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def subscribe(self, user_id):
+        stream = EventStream(str(user_id))
+        with self._lock:
+            self._streams.setdefault(stream.user_id, set()).add(stream)
+        USER_EVENT_STREAMS.inc()
+        return stream
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            streams = self._streams.get(stream.user_id)
+            if streams is not None:
+                streams.discard(stream)
+                if not streams:
+                    del self._streams[stream.user_id]
+        USER_EVENT_STREAMS.dec()
+
+    def dispatch(self, event):
+        streams = self._streams.get(event['userId'])
+        if streams:
+            for stream in list(streams):
+                stream.push(event)
+
+    def start(self, db):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        ensure_user_events_collection(db)
+        self._thread = threading.Thread(target=self._tail, args=(db[COLLECTION],), name='user-events', daemon=True)
+        self._thread.start()
+
+    def _tail(self, collection):
+        tail_capped(collection, self._receive)
+
+    def _receive(self, event):
+        # Only users connected to this worker matter
+        if event.get('userId') in self._streams:
+            self.dispatch(event)
+
+
+user_event_hub = UserEventHub()
+
+
+def ensure_user_events_collection(db):
+    try:
+        db.create_collection(COLLECTION, capped=True, size=CAPPED_SIZE_BYTES, max=CAPPED_MAX_DOCS)
+    except CollectionInvalid:
+        pass
+    db[COLLECTION].create_index([('userId', ASCENDING), ('ts', ASCENDING)])
+
+
+def start_user_events(db):
+    user_event_hub.start(db)
+
+
+def _format_event(event):
+    return (f"id: {event['_id']}\nevent: {event['type']}\n"
+            f"data: {json.dumps(event['data'], default=str)}\n\n")
+
+
+def _replay(db, user_id, last_event_id):
+    """Events inserted after last_event_id, or None if they are no longer all available"""
+    try:
+        last_id = ObjectId(last_event_id)
+    except (InvalidId, TypeError):
+        return None
+    last = db[COLLECTION].find_one({'_id': last_id}, {'ts': 1}, show_record_id=True)
+    if last is None:
+        # Already overwritten by the capped collection, or never stored
+        return None
+    events = []
+    # Events inserted after the last one can be stamped slightly before it
+    for event in db[COLLECTION].find(
+        {'userId': str(user_id), 'ts': {'$gte': last['ts'] - RESUME_WINDOW}}, show_record_id=True
+    ):
+        if event['$recordId'] > last['$recordId']:
+            events.append(event)
+            if len(events) > REPLAY_LIMIT:
+                return None
+    return sorted(events, key=lambda event: event['$recordId'])
+
+
+def stream_user_events(db, user_id, last_event_id=None, hub=user_event_hub, heartbeat=STREAM_HEARTBEAT):
+    """SSE body for one user: replay after last_event_id, then live events"""
+    # Subscribe before replaying so nothing published in between is lost
+    stream = hub.subscribe(user_id)
+    try:
+        yield 'retry: 3000\n\n'
+        # Replayed events can also arrive live; each is sent once
+        delivered = set()
+        if last_event_id:
+            replayed = _replay(db, user_id, last_event_id)
+            if replayed is None:
+                yield 'event: resync\ndata: {}\n\n'
+            else:
+                for event in replayed:
+                    delivered.add(event['_id'])
+                    yield _format_event(event)
+
+        while True:
+            events, overflowed = stream.drain(heartbeat)
+            if overflowed:
+                yield 'event: resync\ndata: {}\n\n'
+            if not events and not overflowed:
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                if event['_id'] in delivered:
+                    delivered.discard(event['_id'])
+                    continue
+                yield _format_event(event)
+    finally:
+        hub.unsubscribe(stream)
@@ -1,5 +1,5 @@
 import { useEffect, useState } from 'react';
-import { userApi, transactionApi, investmentApi } from '@/services/api';
+import { userApi, transactionApi, investmentApi, eventsApi } from '@/services/api';
 import BalanceCard from './BalanceCard';
 import TransactionTable from './TransactionTable';
 import PortfolioChart from './PortfolioChart';
@@ -51,6 +51,7 @@ export function Dashboard() {
   const [investmentHistory, setInvestmentHistory] = useState<InvestmentHistory[]>([]);
   const [isLoading, setIsLoading] = useState(true);
   const [currentPage, setCurrentPage] = useState(1);
+  const [reloadKey, setReloadKey] = useState(0);
   const { toast } = useToast();
   const navigate = useNavigate();
 
@@ -82,6 +83,44 @@ export function Dashboard() {
     };
 
     fetchData();
+  }, [toast, reloadKey]);
+
+  // Balance, investment and referral updates pushed by the server
+  useEffect(() => {
+    const source = new EventSource(eventsApi.streamUrl(), { withCredentials: true });
+
+    source.addEventListener('balance', ((event: MessageEvent) => {
+      const { balance, delta } = JSON.parse(event.data);
+      setUserData((prev) => prev && {
+        ...prev,
+        balance: typeof balance === 'number' ? balance : prev.balance + delta
+      });
+    }) as EventListener);
+
+    source.addEventListener('investment', ((event: MessageEvent) => {
+      const { action, investment } = JSON.parse(event.data);
+      if (!investment?.id) {
+        // Nothing to merge: refetch instead
+        setReloadKey((key) => key + 1);
+        return;
+      }
+      setInvestments((prev) => action === 'created'
+        ? (prev.some((inv) => inv.id === investment.id) ? prev : [investment, ...prev])
+        : prev.map((inv) => inv.id === investment.id ? { ...inv, ...investment } : inv));
+    }) as EventListener);
+
+    source.addEventListener('referral_reward', ((event: MessageEvent) => {
+      const { amount } = JSON.parse(event.data);
+      toast({
+        title: 'Referral reward',
+        description: `You earned ${Number(amount).toFixed(2)} from your referrals`,
+      });
+    }) as EventListener);
+
+    // Events were missed (queue overflow or replay window exceeded): refetch
+    source.addEventListener('resync', () => setReloadKey((key) => key + 1));
+
+    return () => source.close();
   }, [toast]);
 
   const handleClosePosition = async (investmentId: string) => {
@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react';
 import ForexPairCard from './ForexPairCard';
 import { useToast } from '@/hooks/use-toast';
-import { investmentApi } from '@/services/api';
+import { forexApi, investmentApi } from '@/services/api';
 
 interface ForexPair {
   pair: string;
@@ -127,19 +127,25 @@ export default function ForexGrid() {
     });
   };
 
-  // In a real app, you would fetch real-time forex data here
+  // Live prices pushed by the backend price service
   useEffect(() => {
-    const interval = setInterval(() => {
-      setForexPairs(pairs => 
-        pairs.map(pair => ({
-          ...pair,
-          previousPrice: pair.price,
-          price: pair.price + (Math.random() - 0.5) * 0.001
-        }))
+    const source = new EventSource(forexApi.streamUrl(), { withCredentials: true });
+
+    const applyTicks = (event: MessageEvent) => {
+      const ticks: { pair: string; price: number }[] = JSON.parse(event.data);
+      const latest = new Map(ticks.map((tick) => [tick.pair, tick.price]));
+      setForexPairs(pairs =>
+        pairs.map(pair => {
+          const price = latest.get(pair.pair);
+          return price === undefined ? pair : { ...pair, previousPrice: pair.price, price };
+        })
       );
-    }, 5000);
+    };
+
+    source.addEventListener('snapshot', applyTicks as EventListener);
+    source.addEventListener('ticks', applyTicks as EventListener);
 
-    return () => clearInterval(interval);
+    return () => source.close();
   }, []);
 
   return (
@@ -105,8 +105,28 @@ export const investmentApi = {
   },
 };
 
+// Portfolio API
+export const portfolioApi = {
+  getSeries: (points?: number) =>
+    fetchApi(`/api/portfolio/series${points ? `?points=${points}` : ''}`),
+};
+
+// Per-user events (Server-Sent Events): balance, investment, referral_reward, resync
+export const eventsApi = {
+  streamUrl: () => `${API_URL}/api/events/stream`,
+};
+
+// Forex prices API
+export const forexApi = {
+  getPrices: () => fetchApi('/api/forex/prices'),
+  // Server-Sent Events: a `snapshot` event, then coalesced `ticks` events
+  streamUrl: () => `${API_URL}/api/forex/stream`,
+};
+
 // Referral API
 export const referralApi = {
   getStats: () => fetchApi('/api/referral/stats'),
   getHistory: () => fetchApi('/api/referral/history'),
+  getLeaderboard: (window: 'daily' | 'weekly' | 'all' = 'all', sort: 'earnings' | 'downline' = 'earnings', limit = 20) =>
+    fetchApi(`/api/referral/leaderboard?window=${window}&sort=${sort}&limit=${limit}`),
 };